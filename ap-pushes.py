@@ -4,9 +4,11 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
+import calendar
 import datetime
 import logging
 
+import builds
 import utils
 
 logging.basicConfig()
@@ -16,7 +18,7 @@ parser = argparse.ArgumentParser(description="Count pushes to a repository on a
 parser.add_argument("--date",
                     dest="date",
                     default=None,
-                    help="start date CCYY-MM-DD. (default: today's date).")
+                    help="start date CCYY-MM-DD in UTC. (default: today's date).")
 parser.add_argument("--repo",
                     dest="repo",
                     default="mozilla-central",
@@ -26,29 +28,35 @@ args = parser.parse_args()
 
 start_date = args.date
 if not args.date:
-    start_date = datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d')
-
-pushes_base_url = 'https://hg.mozilla.org/'
-
-if args.repo in 'mozilla-beta,mozilla-aurora,mozilla-release':
-    pushes_base_url += 'releases/'
-elif args.repo not in 'mozilla-central,try':
-    pushes_base_url += 'integration/'
-
-pushes_base_url += args.repo + '/json-pushes?startdate=%s&enddate=%s'
+    start_date = datetime.datetime.strftime(datetime.datetime.utcnow(), '%Y-%m-%d')
 
 start = datetime.datetime.strptime(start_date, '%Y-%m-%d')
 end = start + datetime.timedelta(days=1)
-end_date = datetime.datetime.strftime(end, '%Y-%m-%d')
-
-pushes_url = pushes_base_url % (start_date, end_date)
-pushes_json = utils.get_remote_json(pushes_url)
-if pushes_json:
-    keys = pushes_json.keys()
-    keys.sort()
-    print int(keys[-1]) - int(keys[0]) + 1
-
-
-
-
 
+# Count the pushes in the local pushlog mirror shared with Autophone
+# if it mirrors the repository and covers the date, otherwise fetch
+# the day's pushes.
+pushes = None
+if args.repo in builds.REPO_URLS:
+    pushes = builds.pushlog().get_pushes(args.repo,
+                                         calendar.timegm(start.timetuple()),
+                                         calendar.timegm(end.timetuple()) - 1)
+if pushes is not None:
+    print len(pushes)
+else:
+    pushes_base_url = 'https://hg.mozilla.org/'
+
+    if args.repo in 'mozilla-beta,mozilla-aurora,mozilla-release':
+        pushes_base_url += 'releases/'
+    elif args.repo not in 'mozilla-central,try':
+        pushes_base_url += 'integration/'
+
+    pushes_base_url += args.repo + '/json-pushes?startdate=%s&enddate=%s'
+
+    end_date = datetime.datetime.strftime(end, '%Y-%m-%d')
+    pushes_url = pushes_base_url % (start_date, end_date)
+    pushes_json = utils.get_remote_json(pushes_url)
+    if pushes_json:
+        keys = pushes_json.keys()
+        keys.sort()
+        print int(keys[-1]) - int(keys[0]) + 1
@@ -20,6 +20,7 @@ import subprocess
 import sys
 import threading
 import traceback
+import urlparse
 
 # Capture the python logger class before mozlog changes it.
 LOGGER_CLASS = logging.getLoggerClass()
@@ -32,6 +33,7 @@ from manifestparser import TestManifest
 import builds
 import buildserver
 import jobs
+import metadatacache
 import utils
 
 from adb import ADBHost
@@ -44,6 +46,7 @@ from options import AutophoneOptions
 from phonestatus import PhoneStatus
 from phonetest import PhoneTest
 from process_states import ProcessStates
+from s3 import S3UploadIndex
 from worker import PhoneWorker
 
 class PhoneData(object):
@@ -65,6 +68,39 @@ class PhoneData(object):
         return '%s' % self.__dict__
 
 
+class AutophoneStatus(object):
+    """Immutable, versioned snapshot of the state of Autophone and the
+    status of each of its workers.
+
+    AutoPhone publishes a new snapshot while holding its lock whenever
+    the state may have changed. Read only commands are answered from
+    the most recently published snapshot without taking the lock.
+    """
+    def __init__(self, version, state, workers):
+        self.version = version
+        self.state = state
+        # workers is a dict of PhoneWorkerStatus indexed by phone id
+        # which must not be modified once the snapshot is published.
+        self.workers = workers
+
+    def report(self):
+        response = 'state: %s (status version %d)\n' % (self.state,
+                                                        self.version)
+        phoneids = self.workers.keys()
+        phoneids.sort()
+        for i in phoneids:
+            response += self.workers[i].report()
+        return response
+
+    def device_report(self, phoneid):
+        response = ''
+        for worker in self.workers.values():
+            if phoneid.lower() == 'all' or worker.serial == phoneid or \
+               worker.phoneid == phoneid:
+                response += worker.report()
+        return response
+
+
 class AutoPhone(object):
 
     class CmdTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
@@ -111,6 +147,7 @@ class AutoPhone(object):
                               allow_duplicates=options.allow_duplicate_jobs)
         self.phone_workers = {}  # indexed by phone id
         self.lock = threading.RLock()
+        self.status = AutophoneStatus(0, self.state, {})
         self._tests = []
         self._devices = {} # dict indexed by device names found in devices ini file
         self.server = None
@@ -124,6 +161,11 @@ class AutoPhone(object):
         self.treeherder_thread = None
         self.logging_server = LogRecordServer(autophone=self)
         self.logging_server_thread = None
+        self.prefetcher = None
+        if options.build_cache_prefetch_threads and not options.override_build_dir:
+            self.prefetcher = buildserver.BuildPrefetcher(
+                port=options.build_cache_port,
+                num_threads=options.build_cache_prefetch_threads)
 
         CONSOLE_LOGGER.info('Starting autophone.')
 
@@ -141,6 +183,7 @@ class AutoPhone(object):
         self.state = ProcessStates.RUNNING
         for worker in self.phone_workers.values():
             worker.start()
+        self.publish_status()
 
         if options.enable_pulse:
             self.pulse_monitor = AutophonePulseMonitor(
@@ -200,6 +243,9 @@ class AutoPhone(object):
         self.logging_server_thread.daemon = True
         self.logging_server_thread.start()
 
+        if self.prefetcher:
+            self.prefetcher.start()
+
         if self.options.treeherder_url:
             self.treeherder_thread = threading.Thread(
                 target=self.treeherder.serve_forever,
@@ -313,12 +359,10 @@ class AutoPhone(object):
             if worker.last_status_msg.phone_status == PhoneStatus.DISCONNECTED:
                 self.unrecoverable_error = True
 
-            # Do not check the last timestamp of a worker that
-            # is currently downloading a build due to the size
-            # of the downloads and the unknown network speed.
+            # Workers fetching a build update their status with the
+            # progress events streamed by the build cache server.
             elapsed = datetime.datetime.now(tz=pytz.utc) - worker.last_status_msg.timestamp
-            if worker.last_status_msg.phone_status != PhoneStatus.FETCHING and \
-               elapsed > datetime.timedelta(seconds=self.options.maximum_heartbeat):
+            if elapsed > datetime.timedelta(seconds=self.options.maximum_heartbeat):
                 CONSOLE_LOGGER.warning('check_for_unrecoverable_errors: '
                                        'Purging hung phone %s', worker.phone.id)
                 msg_subj = '%s Purging hung phone %s' % (utils.host(),
@@ -344,6 +388,7 @@ class AutoPhone(object):
                 if self.state == ProcessStates.RUNNING and self.pulse_monitor and \
                    not self.pulse_monitor.is_alive():
                     self.pulse_monitor.start()
+                self.publish_status()
                 # Temporarily release the lock while we are waiting
                 # for a message from the workers.
                 self.lock_release()
@@ -389,6 +434,8 @@ class AutoPhone(object):
             if self.pulse_monitor:
                 self.pulse_monitor.stop()
                 self.pulse_monitor = None
+            if self.prefetcher:
+                self.prefetcher.stop()
             if self.server:
                 self.server.shutdown()
             if self.server_thread:
@@ -449,6 +496,14 @@ class AutoPhone(object):
         build_url = job_data['build']
         tests = job_data['tests']
 
+        # Expected number of jobs ahead of the build in the job
+        # queues and the union of the needs of its new tests for
+        # prefetching the build.
+        prefetch_position = None
+        prefetch_unittests = False
+        prefetch_names = set()
+        prefetch_paths = set()
+
         phoneids = set([test.phone.id for test in tests])
         for phoneid in phoneids:
             p = self.phone_workers[phoneid]
@@ -501,15 +556,85 @@ class AutoPhone(object):
                             enable_unittests)
                 p.new_job()
 
+                if self.options.lifo or 'try' in build_url:
+                    position = 0
+                else:
+                    position = self.jobs.jobs_pending(phoneid) - 1
+                if prefetch_position is None or position < prefetch_position:
+                    prefetch_position = position
+                prefetch_unittests = prefetch_unittests or enable_unittests
+                for t in new_tests:
+                    prefetch_names.update(t.get_test_package_names())
+                    paths = t.get_test_package_paths()
+                    if paths is None or prefetch_paths is None:
+                        prefetch_paths = None
+                    else:
+                        prefetch_paths.update(paths)
+
+        if (self.prefetcher and prefetch_position is not None and
+            urlparse.urlparse(build_url).scheme.startswith('http')):
+            self.prefetcher.schedule(build_url,
+                                     prefetch_position,
+                                     enable_unittests=prefetch_unittests,
+                                     test_package_names=prefetch_names,
+                                     test_package_paths=prefetch_paths,
+                                     builder_type=job_data['builder_type'])
+
+    def publish_status(self):
+        """Publish a new status snapshot. Must be called with the lock
+        held. The published snapshot is replaced rather than modified
+        so that readers always see a consistent snapshot."""
+        workers = {}
+        for phoneid, worker in self.phone_workers.iteritems():
+            workers[phoneid] = worker.status_snapshot()
+        self.status = AutophoneStatus(self.status.version + 1,
+                                      self.state,
+                                      workers)
+
     def route_cmd(self, data):
-        response = ''
+        response = self._route_status_cmd(data)
+        if response is not None:
+            return response
         self.lock_acquire(data=data)
         try:
             response = self._route_cmd(data)
+            self.publish_status()
         finally:
             self.lock_release(data=data)
         return response
 
+    def _route_status_cmd(self, data):
+        """Answer read only commands from the published status snapshot
+        without taking the lock. Returns None for all other commands."""
+        data = data.strip()
+        cmd, space, params = data.partition(' ')
+        cmd = cmd.lower()
+        status = self.status
+        if cmd == 'autophone-status':
+            return status.report() + 'ok'
+        if cmd == 'device-status':
+            phoneid, space, params = params.partition(' ')
+            response = status.device_report(phoneid)
+            if not response:
+                return 'error: phone not found'
+            return response + '\nok'
+        if cmd == 'autophone-upload-stats':
+            response = ''
+            try:
+                days = int(params) if params else 7
+            except ValueError:
+                return 'error: invalid number of days %s' % params
+            if self.options.s3_upload_bucket and self.options.s3_dedupe_ttl > 0:
+                for day, hits, saved in S3UploadIndex().savings(days):
+                    response += '%s: %d uploads skipped, %d bytes saved\n' % (
+                        day, hits, saved)
+            return response + 'ok'
+        if cmd == 'autophone-metadata-stats':
+            return metadatacache.metadata_cache().report() + 'ok'
+        if cmd == 'autophone-http-stats':
+            return utils.http_sessions().report() + 'ok'
+        return None
+
     def _route_cmd(self, data):
         # There is not currently any way to get proper responses for commands
         # that interact with workers, since communication between the main
@@ -571,13 +696,6 @@ class AutoPhone(object):
             LOGGER.info(params)
         elif cmd == 'autophone-triggerjobs':
             response = self.trigger_jobs(params)
-        elif cmd == 'autophone-status':
-            response = 'state: %s\n' % self.state
-            phoneids = self.phone_workers.keys()
-            phoneids.sort()
-            for i in phoneids:
-                response += self.phone_workers[i].status()
-            response += 'ok'
         elif cmd == 'autophone-help':
             response = '''
 Autophone command help:
@@ -601,6 +719,18 @@ autophone-shutdown
 autophone-status
     Generate a status report for each device.
 
+autophone-metadata-stats
+    Report the hits and misses of the Taskcluster and Treeherder
+    metadata cache.
+
+autophone-http-stats
+    Report the requests, failures, retries and response times for
+    each host contacted by the autophone process.
+
+autophone-upload-stats [<days>]
+    Report the number of S3 uploads skipped and bytes saved by the
+    upload index for each of the last <days> days. Defaults to 7.
+
 autophone-stop
     Immediately stop autophone and all worker processes; may be
     delayed by pending download.
@@ -1181,6 +1311,12 @@ def autophone_runner(options):
     # will prevent disclosure of sensitive data.
     utils.recordSensitiveData(options.sensitive_data)
 
+    # Configure the http sessions before the workers are forked so
+    # that they inherit the retry settings.
+    utils.configure_http_sessions(attempts=options.http_retry_attempts,
+                                  backoff_base=options.http_backoff_base,
+                                  backoff_max=options.http_backoff_max)
+
     loglevel = e = None
     try:
         loglevel = getattr(logging, options.loglevel)
@@ -1250,7 +1386,11 @@ def autophone_runner(options):
             override_build_dir=options.override_build_dir,
             build_cache_size=options.build_cache_size,
             build_cache_expires=options.build_cache_expires,
-            treeherder_url=options.treeherder_url)
+            build_cache_max_bytes=options.build_cache_max_bytes,
+            build_cache_min_free_bytes=options.build_cache_min_free_bytes,
+            treeherder_url=options.treeherder_url,
+            fetch_threads=options.build_cache_fetch_threads,
+            peers=options.build_cache_peers)
     except builds.BuildCacheException, e:
         print '''%s
 
@@ -1264,9 +1404,17 @@ unpacked tests package for the build.
         ''' % e
         raise
 
+    scrubber = None
+    if options.build_cache_scrub_interval and not options.override_build_dir:
+        scrubber = builds.BuildCacheScrubber(
+            build_cache, interval=options.build_cache_scrub_interval)
+        scrubber.start()
+
     build_cache_server = buildserver.BuildCacheServer(
         ('127.0.0.1', options.build_cache_port),
-        buildserver.BuildCacheHandler)
+        buildserver.BuildCacheHandler,
+        max_downloads=options.build_cache_max_downloads,
+        prefetch_rate=options.build_cache_prefetch_rate)
     build_cache_server.build_cache = build_cache
     build_cache_server_thread = threading.Thread(
         target=build_cache_server.serve_forever,
@@ -1274,6 +1422,18 @@ unpacked tests package for the build.
     build_cache_server_thread.daemon = True
     build_cache_server_thread.start()
 
+    peer_server = None
+    if options.build_cache_peer_port:
+        CONSOLE_LOGGER.info('Starting build-cache peer server on port %d.',
+                            options.build_cache_peer_port)
+        peer_server = buildserver.BuildCachePeerServer(
+            ('0.0.0.0', options.build_cache_peer_port), build_cache.cache_dir)
+        peer_server_thread = threading.Thread(
+            target=peer_server.serve_forever,
+            name='BuildCachePeerThread')
+        peer_server_thread.daemon = True
+        peer_server_thread.start()
+
     autophone = AutoPhone(loglevel, options)
 
     signal.signal(signal.SIGTERM, sigterm_handler)
@@ -1306,6 +1466,11 @@ unpacked tests package for the build.
     CONSOLE_LOGGER.info('Shutting down build-cache server...')
     build_cache_server.shutdown()
     build_cache_server_thread.join()
+    if peer_server:
+        peer_server.shutdown()
+        peer_server_thread.join()
+    if scrubber:
+        scrubber.stop()
     CONSOLE_LOGGER.info('Done.')
     return 0
 
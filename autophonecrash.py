@@ -7,15 +7,21 @@
 # http://dxr.mozilla.org/mozilla-central/source/build/mobile/remoteautomation.py
 # http://developer.android.com/training/articles/perf-anr.html
 
+import errno
 import glob
 import os
 import subprocess
 import re
 import shutil
+import sqlite3
 import sys
 import tempfile
+import time
+import zipfile
 from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 
+import builds
 import utils
 from adb import ADBError
 from phonestatus import TestStatus
@@ -23,6 +29,12 @@ from phonestatus import TestStatus
 TRACES = "/data/anr/traces.txt"
 TOMBSTONES = "/data/tombstones"
 
+# Matches the size and modification time of a file in the output of
+# ls -l for both toolbox and toybox, e.g.
+# -rw-rw-rw- system   system        1 2017-06-01 12:00 traces.txt
+# -rw-rw-rw- 1 system system        1 2017-06-01 12:00 traces.txt
+LS_ENTRY_RE = re.compile(r"\s(\d+)\s+(\d{4}-\d\d-\d\d \d\d:\d\d(?::\d\d)?)\s+(.*)$")
+
 StackInfo = namedtuple("StackInfo",
                        ["minidump_path",
                         "signature",
@@ -33,7 +45,72 @@ StackInfo = namedtuple("StackInfo",
                         "extra"])
 
 
+class StackwalkCache(object):
+    """Cache of the minidump_stackwalk results for the crashes of a
+    build kept in a SQLite database in the build's directory. Results
+    are keyed by the crash key returned by
+    AutophoneCrashProcessor._get_dump_info() so that a crash which
+    recurs across retries of a test is only symbolicated once.
+
+    Since the cache is only an optimization, database errors are
+    logged and treated as misses.
+    """
+
+    def __init__(self, build_dir, filename='stackwalk.sqlite'):
+        self.filename = os.path.join(build_dir, filename)
+
+    def _conn(self):
+        conn = sqlite3.connect(self.filename, timeout=30)
+        conn.execute('create table if not exists stackwalk ('
+                     'crash_key text primary key, '
+                     'signature text, '
+                     'stdout text, '
+                     'retcode integer)')
+        return conn
+
+    def get(self, crash_key):
+        """Return a tuple of the signature, stdout and return code of
+        the cached result for crash_key or None."""
+        logger = utils.getLogger()
+        conn = None
+        try:
+            conn = self._conn()
+            return conn.execute('select signature, stdout, retcode '
+                                'from stackwalk where crash_key=?',
+                                (crash_key,)).fetchone()
+        except sqlite3.Error:
+            logger.exception('StackwalkCache.get(%s)', crash_key)
+        finally:
+            if conn:
+                conn.close()
+        return None
+
+    def put(self, crash_key, signature, stdout, retcode):
+        logger = utils.getLogger()
+        conn = None
+        try:
+            conn = self._conn()
+            conn.execute('insert or replace into stackwalk values (?, ?, ?, ?)',
+                         (crash_key, signature, stdout.decode('utf-8', 'replace'),
+                          retcode))
+            conn.commit()
+        except sqlite3.Error:
+            logger.exception('StackwalkCache.put(%s)', crash_key)
+        finally:
+            if conn:
+                conn.close()
+
+
 class AutophoneCrashProcessor(object):
+    # Maximum number of minidump_stackwalk processes run concurrently.
+    STACKWALK_PROCESSES = 4
+    # Maximum number of distinct crashes processed per call to
+    # get_crashes.
+    MAX_DUMPS = 10
+    # Maximum number of dump files examined per call to get_crashes
+    # to find the distinct crashes.
+    MAX_DUMP_FILES = 5 * MAX_DUMPS
+
     def __init__(self, adbdevice, remote_profile_dir, upload_dir, app_name):
         """Initialize an AutophoneCrashProcessor object.
 
@@ -53,6 +130,9 @@ class AutophoneCrashProcessor(object):
         self.upload_dir = upload_dir
         self._dump_files = None
         self.app_name = app_name
+        # Fingerprints of the artifacts collected from each location
+        # by get_errors.
+        self._fingerprints = {}
 
     @property
     def remote_dump_dir(self):
@@ -139,10 +219,82 @@ class AutophoneCrashProcessor(object):
         else:
             logger.warning("%s does not exist; tombstone check skipped", TOMBSTONES)
 
-    def get_java_exception(self):
+    def _get_artifact_locations(self):
+        """Return a list of (name, remote path) tuples of the locations
+        on the device where ANRs, tombstones and crash dumps are
+        written."""
+        locations = [('traces', TRACES), ('tombstones', TOMBSTONES)]
+        if self.remote_dump_dir:
+            locations.append(('minidumps', self.remote_dump_dir))
+        locations.append(('pending', self.remote_pending_crashreports_dir))
+        return locations
+
+    def collect_fingerprints(self, root=True):
+        """Return a tuple of a dict and the logcat lines read from the
+        device in a single shell invocation.
+
+        The dict maps the name of each location returned by
+        _get_artifact_locations() to None if it does not exist or to
+        its fingerprint, a tuple of (name, size, mtime) tuples of the
+        files it contains. An empty ANR traces file is not content
+        since delete_anr_traces() leaves a single newline in it.
+        """
+        # Run the commands via sh -c so that they all run as root when
+        # requested. The script must not contain quotes or variables
+        # since it may be wrapped in double quotes by su -c.
+        script = []
+        for name, path in self._get_artifact_locations():
+            script.append('echo @@%s' % name)
+            script.append('ls -l %s' % path)
+        script.append('echo @@logcat')
+        script.append('logcat -v time -d dalvikvm:I ConnectivityService:S '
+                      'WifiMonitor:S WifiStateTracker:S wpa_supplicant:S '
+                      'NetworkStateTracker:S')
+        output = self.adb.shell_output("sh -c '%s'" % '; '.join(script),
+                                       root=root)
+        sections = {}
+        lines = None
+        for line in output.splitlines():
+            if line.startswith('@@') and line[2:] in ('traces', 'tombstones',
+                                                      'minidumps', 'pending',
+                                                      'logcat'):
+                lines = sections[line[2:]] = []
+            elif lines is not None:
+                lines.append(line)
+        logcat = sections.pop('logcat', [])
+        fingerprints = {}
+        for name, lines in sections.iteritems():
+            if [line for line in lines if 'No such file' in line]:
+                fingerprints[name] = None
+                continue
+            entries = []
+            for line in lines:
+                if not line.strip() or line.startswith('total '):
+                    continue
+                match = LS_ENTRY_RE.search(line)
+                if not match:
+                    # Unknown output such as a permission error is
+                    # treated as content so that it is collected.
+                    entries.append((line, None, None))
+                elif name != 'traces' or int(match.group(1)) > 1:
+                    entries.append((match.group(3), int(match.group(1)),
+                                    match.group(2)))
+            fingerprints[name] = tuple(sorted(entries))
+        return fingerprints, logcat
+
+    def _changed(self, fingerprints, name):
+        """Return True if the location name has content which differs
+        from the content last collected from it."""
+        fingerprint = fingerprints.get(name)
+        return bool(fingerprint) and fingerprint != self._fingerprints.get(name)
+
+    def get_java_exception(self, logcat=None):
         """Returns a summary of the first fatal Java exception found in
         logcat output.
 
+        :param logcat: list of logcat lines. If None, logcat is read
+            from the device.
+
         Example:
         {
           'reason': 'java-exception',
@@ -153,7 +305,8 @@ class AutophoneCrashProcessor(object):
         logre = re.compile(r".*\): \t?(.*)")
         exception = None
 
-        logcat = self.adb.get_logcat()
+        if logcat is None:
+            logcat = self.adb.get_logcat()
 
         for i, line in enumerate(logcat):
             # Logs will be of form:
@@ -183,14 +336,101 @@ class AutophoneCrashProcessor(object):
                 break
         return exception
 
-    def _process_dump_file(self, path, extra, symbols_path, stackwalk_binary):
+    def _get_dump_info(self, path, stackwalk_binary):
+        """Return a tuple of the list of (debug_file, debug_identifier)
+        tuples of the modules loaded in the process which wrote the
+        minidump at path and the crash key of the dump or None if the
+        crash could not be determined. The crash key is made of the
+        crash reason, the crash address and the module and module
+        offset of the top frame of the crashing thread. Dumps with the
+        same crash key are the same crash.
+
+        The modules and the crash are read from the machine readable
+        output of minidump_stackwalk run without symbols which
+        contains lines of the form
+        Module|filename|version|debug_file|debug_identifier|base|end|main
+        Crash|reason|address|crashing_thread
+        thread|frame|module|function|source_file|line|offset
+        """
+        logger = utils.getLogger()
+        p = subprocess.Popen([stackwalk_binary, '-m', path],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        (out, err) = p.communicate()
+        if p.returncode != 0:
+            logger.warning('AutophoneCrashProcessor._get_dump_info: '
+                           '%s returned %s: %s', path, p.returncode, err)
+        modules = []
+        crash = None
+        top_frames = {}
+        for line in out.splitlines():
+            fields = line.split('|')
+            if len(fields) >= 5 and fields[0] == 'Module' and fields[3] and fields[4]:
+                modules.append((fields[3], fields[4]))
+            elif len(fields) >= 4 and fields[0] == 'Crash':
+                crash = fields[1:4]
+            elif len(fields) >= 7 and fields[1] == '0':
+                top_frames[fields[0]] = (fields[2], fields[6])
+        crash_key = None
+        if crash and crash[2] in top_frames:
+            crash_key = '|'.join(crash[:2] + list(top_frames[crash[2]]))
+        return modules, crash_key
+
+    def _extract_symbols(self, symbols_zip_path, modules):
+        """Extract the symbol files for modules, a list of
+        (debug_file, debug_identifier) tuples, from the zip file at
+        symbols_zip_path into the symbols directory beside it and
+        return the path to the symbols directory.
+
+        The symbols zip file and the symbols directory are laid out
+        as a symbol server, i.e. debug_file/debug_identifier/file.sym.
+        Symbol files which have already been extracted are reused and
+        files are renamed into place so that concurrent extractions by
+        other workers never see partial files.
+        """
+        symbols_dir = os.path.join(os.path.dirname(symbols_zip_path), 'symbols')
+        prefixes = tuple(['%s/%s/' % module for module in modules])
+        with zipfile.ZipFile(symbols_zip_path) as symbols_zipfile:
+            for info in symbols_zipfile.infolist():
+                if (not info.filename.startswith(prefixes) or
+                    info.filename.endswith('/') or
+                    '..' in info.filename.split('/')):
+                    continue
+                dest = os.path.join(symbols_dir, *info.filename.split('/'))
+                if os.path.exists(dest):
+                    continue
+                try:
+                    os.makedirs(os.path.dirname(dest))
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                tmpf = tempfile.NamedTemporaryFile(dir=os.path.dirname(dest),
+                                                   delete=False)
+                try:
+                    with tmpf:
+                        shutil.copyfileobj(symbols_zipfile.open(info), tmpf)
+                    os.rename(tmpf.name, dest)
+                except:
+                    os.unlink(tmpf.name)
+                    raise
+        if not os.path.exists(symbols_dir):
+            os.makedirs(symbols_dir)
+        return symbols_dir
+
+    def _process_dump_file(self, path, extra, symbols_path, stackwalk_binary,
+                           modules=None):
         """Process a single dump file using stackwalk_binary, and return a
         tuple containing properties of the crash dump.
 
         :param path: Path to the minidump file to analyse
         :param extra: Path to the extra file to analyse.
-        :param symbols_path: Path to the directory containing symbols.
+        :param symbols_path: Path to the directory containing symbols
+            or to a zip file containing them. Only the symbols for the
+            modules referenced by the dump are extracted from a zip
+            file.
         :param stackwalk_binary: Path to the minidump_stackwalk binary.
+        :param modules: The modules referenced by the dump as returned
+            by _get_dump_info() if already known.
         :return: A StackInfo tuple with the fields::
                    minidump_path: Path of the dump file
                    signature: The top frame of the stack trace, or None if it
@@ -214,6 +454,18 @@ class AutophoneCrashProcessor(object):
         err = None
         retcode = None
         if symbols_path and stackwalk_binary and os.path.exists(stackwalk_binary):
+            if symbols_path.endswith('.zip'):
+                start = time.time()
+                if modules is None:
+                    modules = self._get_dump_info(path, stackwalk_binary)[0]
+                try:
+                    symbols_path = self._extract_symbols(symbols_path, modules)
+                except (IOError, OSError, zipfile.BadZipfile), e:
+                    errors.append("Error extracting symbols from %s: %s" %
+                                  (symbols_path, e))
+                logger.info('AutophoneCrashProcessor._process_dump_file: '
+                            'extracting symbols for %d modules added %.1f seconds',
+                            len(modules), time.time() - start)
             # run minidump_stackwalk
             p = subprocess.Popen([stackwalk_binary, path, symbols_path],
                                  stdout=subprocess.PIPE,
@@ -259,16 +511,21 @@ class AutophoneCrashProcessor(object):
                          errors,
                          extra)
 
-    def get_crashes(self, symbols_path, stackwalk_binary, clean=True, root=True):
+    def get_crashes(self, symbols_path, stackwalk_binary, clean=True, root=True,
+                    fingerprints=None):
         """Returns a list of crash summaries for any crash dumps found on the device.
 
         Note that the crash dumps are deleted as a side effect.
 
-        :param symbols_path: path on host to the directory
+        :param symbols_path: path on host to the directory or zip file
             containing the symbols for the Firefox build being tested.
         :param stackwalk_binary: path on host to the
             minidump_stackwalk binary to be used to parse the dump files.
         :param clean: If True, remove dump files from the device after processing.
+        :param fingerprints: dict returned by collect_fingerprints().
+            If specified, the ANR traces and tombstones are not
+            checked and the crash dumps are only pulled from the
+            locations which have changed.
 
         Example:
         [
@@ -281,12 +538,15 @@ class AutophoneCrashProcessor(object):
         ]
         """
         logger = utils.getLogger()
-        self.check_for_anr_traces()
-        self.check_for_tombstones()
+        if fingerprints is None:
+            self.check_for_anr_traces()
+            self.check_for_tombstones()
 
         crashes = []
         if not self.remote_dump_dir or \
-           not self.adb.is_dir(self.remote_dump_dir, root=root):
+           (fingerprints is not None and fingerprints.get('minidumps') is None) or \
+           (fingerprints is None and
+            not self.adb.is_dir(self.remote_dump_dir, root=root)):
             # If crash reporting is enabled (MOZ_CRASHREPORTER=1), the
             # minidumps directory is automatically created when Fennec
             # (first) starts, so its lack of presence is a hint that
@@ -294,16 +554,26 @@ class AutophoneCrashProcessor(object):
             logger.warning("No crash directory (%s) "
                            "found on remote device", self.remote_dump_dir)
             return crashes
+        if fingerprints is not None:
+            pull_dumps = self._changed(fingerprints, 'minidumps')
+            pull_pending = self._changed(fingerprints, 'pending')
+            if not pull_dumps and not pull_pending:
+                return crashes
+        else:
+            pull_dumps = True
+            pull_pending = self.adb.is_dir(self.remote_pending_crashreports_dir,
+                                           root=root)
         # Create a temporary directory to hold the dump files from the
         # device.  This will allow us to accumulate a number of
         # crashes into the upload directory while ensuring that we
         # only process them once.
         temp_upload_dir = tempfile.mkdtemp()
-        self.adb.chmod(self.remote_dump_dir, recursive=True, root=root)
-        self.adb.pull(self.remote_dump_dir, temp_upload_dir)
-        if clean:
-            self.adb.rm(self.remote_dump_dir + "/*", force=True, root=True)
-        if self.adb.is_dir(self.remote_pending_crashreports_dir, root=root):
+        if pull_dumps:
+            self.adb.chmod(self.remote_dump_dir, recursive=True, root=root)
+            self.adb.pull(self.remote_dump_dir, temp_upload_dir)
+            if clean:
+                self.adb.rm(self.remote_dump_dir + "/*", force=True, root=True)
+        if pull_pending:
             self.adb.chmod(self.remote_pending_crashreports_dir, recursive=True,
                            root=root)
             self.adb.pull(self.remote_pending_crashreports_dir, temp_upload_dir)
@@ -311,26 +581,111 @@ class AutophoneCrashProcessor(object):
                 self.adb.rm(self.remote_pending_crashreports_dir + "/*", force=True, root=True)
         dump_files = [(path, os.path.splitext(path)[0] + '.extra') for path in
                       glob.glob(os.path.join(temp_upload_dir, '*.dmp'))]
-        max_dumps = 10
-        if len(dump_files) > max_dumps:
-            logger.warning("Found %d dump files -- limited to %d!", len(dump_files), max_dumps)
-            del dump_files[max_dumps:]
         logger.debug('AutophoneCrashProcessor.dump_files: %s', dump_files)
         for path, extra in dump_files:
-            try:
-                if os.path.exists(path):
-                    shutil.copy(path, self.upload_dir)
-            except:
-                logger.exception('Attempting to copy %s to upload directory %s',
-                                 path, self.upload_dir)
-            try:
-                if os.path.exists(extra):
-                    shutil.copy(extra, self.upload_dir)
-            except:
-                logger.exception('Attempting to copy %s to upload directory %s',
-                                 extra, self.upload_dir)
-            info = self._process_dump_file(path, extra, symbols_path, stackwalk_binary)
+            for filename in (path, extra):
+                try:
+                    if os.path.exists(filename):
+                        shutil.copy(filename, self.upload_dir)
+                except:
+                    logger.exception('Attempting to copy %s to upload directory %s',
+                                     filename, self.upload_dir)
+        if dump_files:
+            crashes = self._process_dump_files(dump_files, symbols_path,
+                                               stackwalk_binary)
+        try:
+            shutil.rmtree(temp_upload_dir)
+        except:
+            logger.exception('Attempting to remove upload directory %s',
+                             temp_upload_dir)
+        return crashes
+
+    def _process_dump_files(self, dump_files, symbols_path, stackwalk_binary):
+        """Return the list of crash summaries for dump_files, a list of
+        (path, extra) tuples.
+
+        At most MAX_DUMP_FILES dumps are examined. Dumps of the same
+        crash, as identified by their crash key, are reported once.
+        minidump_stackwalk is run concurrently for at most
+        STACKWALK_PROCESSES dumps at a time and its results are cached
+        per build so that crashes seen by earlier retries are not
+        processed again.
+        """
+        logger = utils.getLogger()
+        if len(dump_files) > self.MAX_DUMP_FILES:
+            logger.warning("Found %d dump files -- limited to %d!",
+                           len(dump_files), self.MAX_DUMP_FILES)
+            dump_files = dump_files[:self.MAX_DUMP_FILES]
+        can_walk = (symbols_path and stackwalk_binary and
+                    os.path.exists(stackwalk_binary))
+        pool = ThreadPool(min(self.STACKWALK_PROCESSES, len(dump_files)))
+        try:
+            if can_walk:
+                dump_infos = pool.map(
+                    lambda dump_file: self._get_dump_info(dump_file[0],
+                                                          stackwalk_binary),
+                    dump_files)
+            else:
+                dump_infos = [(None, None)] * len(dump_files)
+            # Group the dumps by crash key preserving the order in
+            # which the crashes were first seen. Dumps whose crash could
+            # not be determined are never grouped.
+            groups = []
+            groups_by_key = {}
+            for dump_file, (modules, crash_key) in zip(dump_files, dump_infos):
+                if crash_key is None:
+                    groups.append((crash_key, modules, [dump_file]))
+                elif crash_key in groups_by_key:
+                    groups_by_key[crash_key][2].append(dump_file)
+                else:
+                    groups_by_key[crash_key] = (crash_key, modules, [dump_file])
+                    groups.append(groups_by_key[crash_key])
+            if len(groups) > self.MAX_DUMPS:
+                logger.warning("Found %d distinct crashes -- limited to %d!",
+                               len(groups), self.MAX_DUMPS)
+                del groups[self.MAX_DUMPS:]
+
+            cache = None
+            if can_walk:
+                cache = StackwalkCache(os.path.dirname(symbols_path.rstrip('/')))
+
+            def process(group):
+                crash_key, modules, group_files = group
+                path, extra = group_files[0]
+                cached = cache.get(crash_key) if cache and crash_key else None
+                if cached:
+                    logger.info('AutophoneCrashProcessor._process_dump_files: '
+                                'using cached result for %s', crash_key)
+                    signature, out, retcode = cached
+                    return StackInfo(path, signature, out, None, retcode, [],
+                                     extra)
+                info = self._process_dump_file(path, extra, symbols_path,
+                                               stackwalk_binary, modules=modules)
+                if (cache and crash_key and info.stackwalk_retcode == 0 and
+                    not info.stackwalk_stderr and not info.stackwalk_errors):
+                    cache.put(crash_key, info.signature, info.stackwalk_stdout,
+                              info.stackwalk_retcode)
+                return info
+
+            infos = pool.map(process, groups)
+        finally:
+            pool.close()
+            pool.join()
+        if cache:
+            # Count the extracted symbols and the cached results
+            # towards the byte budget of the build cache.
+            builds.record_build_artifacts(os.path.dirname(cache.filename),
+                                          ['symbols',
+                                           os.path.basename(cache.filename)])
+
+        crashes = []
+        for (crash_key, modules, group_files), info in zip(groups, infos):
             stackwalk_output = ["Crash dump filename: %s" % info.minidump_path]
+            if len(group_files) > 1:
+                stackwalk_output.append(
+                    "Identical crash dumps: %s" %
+                    ', '.join([os.path.basename(path)
+                               for path, extra in group_files[1:]]))
             if info.stackwalk_stderr:
                 stackwalk_output.append("stderr from minidump_stackwalk:")
                 stackwalk_output.append(info.stackwalk_stderr)
@@ -346,11 +701,6 @@ class AutophoneCrashProcessor(object):
                  'signature': signature,
                  'stackwalk_output': '\n'.join(stackwalk_output),
                  'stackwalk_errors': '\n'.join(info.stackwalk_errors)})
-        try:
-            shutil.rmtree(temp_upload_dir)
-        except:
-            logger.exception('Attempting to remove upload directory %s',
-                             temp_upload_dir)
         return crashes
 
     def get_errors(self, symbols_path, stackwalk_binary, clean=True):
@@ -360,7 +710,7 @@ class AutophoneCrashProcessor(object):
         The ANR trace and tombstones are copied from the device to the
         upload_dir before being deleted from the device.
 
-        :param symbols_path: path on host to the directory
+        :param symbols_path: path on host to the directory or zip file
             containing the symbols for the Firefox build being tested.
         :param stackwalk_binary: path on host to the
             minidump_stackwalk binary to be used to parse the dump files.
@@ -389,9 +739,25 @@ class AutophoneCrashProcessor(object):
              'stackwalk_errors': '...'
            }
         """
+        logger = utils.getLogger()
+        fingerprints, logcat = self.collect_fingerprints()
         errors = []
-        java_exception = self.get_java_exception()
+        java_exception = self.get_java_exception(logcat=logcat)
         if java_exception:
             errors.append(java_exception)
-        errors.extend(self.get_crashes(symbols_path, stackwalk_binary, clean=clean))
+        if self._changed(fingerprints, 'traces'):
+            self.check_for_anr_traces()
+        if fingerprints.get('tombstones') is None:
+            logger.warning("%s does not exist; tombstone check skipped", TOMBSTONES)
+        elif self._changed(fingerprints, 'tombstones'):
+            self.check_for_tombstones()
+        errors.extend(self.get_crashes(symbols_path, stackwalk_binary, clean=clean,
+                                       fingerprints=fingerprints))
+        # Remember what was collected so that content which was not
+        # removed from the device is not collected again. The ANR
+        # traces and tombstones are always removed once collected.
+        if clean:
+            self._fingerprints = {}
+        else:
+            self._fingerprints = dict(fingerprints, traces=None, tombstones=None)
         return errors
@@ -9,7 +9,6 @@ import threading
 import time
 
 from kombu import Connection, Exchange, Queue
-import taskcluster
 
 import utils
 from builds import get_treeherder_tier
@@ -140,7 +139,6 @@ class AutophonePulseMonitor(object):
                                      routing_key='primary.#.#.#.#.#.%s.#.#.#' % platform,
                                      durable=durable_queues,
                                      auto_delete=not durable_queues))
-        self.taskcluster_queue = taskcluster.queue.Queue()
         if treeherder_url:
             jobaction_exchange = Exchange(name=jobaction_exchange_name, type='topic')
             self.queues.append(Queue(name='queue/%s/%s' % (userid, jobaction_queue_name),
@@ -2,11 +2,13 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import Queue
 import calendar
 import datetime
 import json
 import os
 import re
+import threading
 import time
 import urlparse
 
@@ -46,8 +48,35 @@ class TestState(object):
     RUNNING = 'running'
 
 
+class FailureClass(object):
+    CONNECTION = 'connection'
+    REQUEST = 'request'
+    SERVER = 'server'
+
+
 class AutophoneTreeherder(object):
 
+    # Queued submissions for the same project are coalesced into a
+    # single post of at most COALESCE_MAX_JOBS jobs and
+    # COALESCE_MAX_BYTES bytes. While other submissions for its
+    # project keep arriving, a submission is held for up to
+    # COALESCE_MAX_AGE seconds waiting for them to join it.
+    COALESCE_MAX_JOBS = 50
+    COALESCE_MAX_BYTES = 1024 * 1024
+    COALESCE_MAX_AGE = 10
+    # Interval in seconds between reports of the post rate.
+    REPORT_INTERVAL = 600
+    # Each project's submissions are posted in order by at most one of
+    # SENDER_THREADS threads at a time so that a failing project does
+    # not delay the others. Server and connection failures back off
+    # the whole project while a submission rejected by Treeherder is
+    # parked on its own so that the rest of its project is still
+    # posted. After CIRCUIT_FAILURES consecutive server or connection
+    # failures, posting to Treeherder is suspended for retry_wait
+    # seconds after which a single post is attempted before resuming.
+    SENDER_THREADS = 3
+    CIRCUIT_FAILURES = 5
+
     def __init__(self, worker_subprocess, options, jobs, s3_bucket=None,
                  mailer=None):
         assert options, "options is required."
@@ -70,30 +99,55 @@ class AutophoneTreeherder(object):
         self.client_id = self.options.treeherder_client_id
         self.secret = self.options.treeherder_secret
         self.retry_wait = self.options.treeherder_retry_wait
-
-        self.client = TreeherderClient(server_url=self.url,
-                                       client_id=self.client_id,
-                                       secret=self.secret)
+        self.coalesce_max_jobs = self.options.treeherder_coalesce_max_jobs
+        self.coalesce_max_bytes = self.options.treeherder_coalesce_max_bytes
+        self.coalesce_max_age = self.options.treeherder_coalesce_max_age
+        self.sender_threads = self.options.treeherder_sender_threads
+        self.circuit_failures = self.options.treeherder_circuit_failures
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset_stats()
 
         logger.debug('AutophoneTreeherder: %s', self)
 
     def __str__(self):
         # Do not publish sensitive information
         whitelist = ('url',
-                     'retry_wait')
+                     'retry_wait',
+                     'coalesce_max_jobs',
+                     'coalesce_max_bytes',
+                     'coalesce_max_age',
+                     'sender_threads',
+                     'circuit_failures')
         d = {}
         for attr in whitelist:
             d[attr] = getattr(self, attr)
         return '%s' % d
 
+    @property
+    def client(self):
+        # Each sender thread uses its own TreeherderClient.
+        if not hasattr(self.local, 'client'):
+            self.local.client = TreeherderClient(server_url=self.url,
+                                                 client_id=self.client_id,
+                                                 secret=self.secret)
+        return self.local.client
+
     def post_request(self, machine, project, job_collection, attempts, last_attempt):
+        """Post job_collection to Treeherder.
+
+        Returns None if the post succeeded, otherwise the class of the
+        failure: FailureClass.REQUEST if Treeherder rejected the
+        request, FailureClass.SERVER if Treeherder or its proxy
+        failed, or FailureClass.CONNECTION for any other error.
+        """
         logger = utils.getLogger()
         logger.debug('AutophoneTreeherder.post_request: %s, attempt=%d, last=%s',
                      job_collection.__dict__, attempts, last_attempt)
 
         try:
             self.client.post_collection(project, job_collection)
-            return True
+            return None
         except Exception, e:
             logger.exception('Error submitting request to Treeherder, attempt=%d, last=%s',
                              attempts, last_attempt)
@@ -117,7 +171,12 @@ class AutophoneTreeherder(object):
                         last_attempt,
                         request_len,
                         response_json))
-        return False
+            response = getattr(e, 'response', None)
+            if response is None:
+                return FailureClass.CONNECTION
+            if response.status_code >= 500 or response.status_code == 429:
+                return FailureClass.SERVER
+            return FailureClass.REQUEST
 
     def queue_request(self, machine, project, job_collection):
         logger = utils.getLogger()
@@ -457,31 +516,185 @@ class AutophoneTreeherder(object):
 
         self.queue_request(machine, project, tjc)
 
-    def serve_forever(self):
+    def reset_stats(self):
+        self.stats_start = time.time()
+        self.stats = {'posts': 0, 'submissions': 0, 'jobs': 0, 'failures': 0}
+
+    def report_stats(self):
+        """Periodically log the rate of posts to Treeherder along with
+        the rate of submissions which would have been posted
+        individually without coalescing."""
+        elapsed = time.time() - self.stats_start
+        if elapsed < self.REPORT_INTERVAL:
+            return
         logger = utils.getLogger()
-        while not self.shutdown_requested:
-            wait_seconds = 1    # avoid busy loop
-            job = self.jobs.get_next_treeherder_job()
-            if job:
-                tjc = TreeherderJobCollection()
-                for data in job['job_collection']:
-                    tj = TreeherderJob(data)
-                    tjc.add(tj)
-                if self.post_request(job['machine'], job['project'], tjc,
-                                     job['attempts'], job['last_attempt']):
-                    self.jobs.treeherder_job_completed(job['id'])
-                    wait_seconds = 0
-                else:
+        minutes = elapsed / 60
+        with self.lock:
+            logger.info('AutophoneTreeherder: %.1f posts/minute, '
+                        '%.1f submissions/minute, %.1f jobs/minute, '
+                        '%d failed posts over the last %.0f minutes',
+                        self.stats['posts'] / minutes,
+                        self.stats['submissions'] / minutes,
+                        self.stats['jobs'] / minutes,
+                        self.stats['failures'],
+                        minutes)
+            self.reset_stats()
+
+    def _dispatchable(self, project, now):
+        """Return True if the next submissions for project may be
+        posted. Must be called with self.lock held."""
+        if project in self.busy_projects:
+            return False
+        if self.backoff.get(project, 0) > now:
+            return False
+        if self.consecutive_failures >= self.circuit_failures:
+            # The circuit is open until circuit_open_until after which
+            # a single post is allowed through to test the server.
+            if now < self.circuit_open_until or self.busy_projects:
+                return False
+        return True
+
+    def _send(self, jobs):
+        """Post the coalesced submissions in jobs and update the backoff
+        and circuit breaker state according to the result."""
+        logger = utils.getLogger()
+        self.jobs.treeherder_jobs_attempted(jobs)
+        tjc = TreeherderJobCollection()
+        for job in jobs:
+            for data in job['job_collection']:
+                tj = TreeherderJob(data)
+                tjc.add(tj)
+        job = jobs[0]
+        project = job['project']
+        failure_class = self.post_request(job['machine'], project, tjc,
+                                          job['attempts'], job['last_attempt'])
+        if not failure_class:
+            self.jobs.treeherder_jobs_completed(jobs)
+        job_ids = [job['id'] for job in jobs]
+        with self.lock:
+            now = time.time()
+            if not failure_class:
+                self.stats['posts'] += 1
+                self.stats['submissions'] += len(jobs)
+                self.stats['jobs'] += len(tjc.data)
+                self.backoff.pop(project, None)
+                for job_id in job_ids:
+                    self.parked.pop(job_id, None)
+                    self.isolated.discard(job_id)
+                if self.consecutive_failures >= self.circuit_failures:
+                    logger.info('AutophoneTreeherder: closing circuit')
+                self.consecutive_failures = 0
+            elif failure_class == FailureClass.REQUEST:
+                # Treeherder rejected the request. Retry each of the
+                # submissions on its own to find the rejected one and
+                # park it without delaying the rest of its project.
+                self.stats['failures'] += 1
+                self.isolated.update(job_ids)
+                if len(jobs) == 1:
                     attempts = int(job['attempts'])
                     wait_seconds = min(self.retry_wait * attempts, 3600)
-                    logger.debug('AutophoneTreeherder waiting for %d seconds after '
-                                 'failed attempt %d',
-                                 wait_seconds, attempts)
-            if wait_seconds > 0:
-                for i in range(wait_seconds):
-                    if self.shutdown_requested:
-                        break
-                    time.sleep(1)
+                    self.parked[job['id']] = now + wait_seconds
+                    logger.debug('AutophoneTreeherder parking submission %s '
+                                 'for %d seconds after rejected attempt %d '
+                                 'for %s', job['id'], wait_seconds, attempts,
+                                 project)
+            else:
+                self.stats['failures'] += 1
+                attempts = int(job['attempts'])
+                wait_seconds = min(self.retry_wait * attempts, 3600)
+                self.backoff[project] = now + wait_seconds
+                logger.debug('AutophoneTreeherder waiting for %d seconds after '
+                             'failed %s attempt %d for %s',
+                             wait_seconds, failure_class, attempts, project)
+                self.consecutive_failures += 1
+                if self.consecutive_failures >= self.circuit_failures:
+                    self.circuit_open_until = now + self.retry_wait
+                    logger.warning('AutophoneTreeherder: opening circuit for '
+                                   '%d seconds after %d consecutive failures',
+                                   self.retry_wait,
+                                   self.consecutive_failures)
+            self.busy_projects.discard(project)
+
+    def _sender(self, send_queue):
+        while True:
+            jobs = send_queue.get()
+            if jobs is None:
+                break
+            try:
+                self._send(jobs)
+            except Exception:
+                utils.getLogger().exception('AutophoneTreeherder._sender')
+                with self.lock:
+                    self.busy_projects.discard(jobs[0]['project'])
+
+    def serve_forever(self):
+        """Dispatch the queued submissions of each project to a pool of
+        sender threads. Each project has independent backoff state so
+        that a failing project does not delay the submissions of the
+        others, submissions rejected by Treeherder are parked
+        individually, while repeated server failures open a circuit
+        breaker which suspends all posts."""
+        self.busy_projects = set()
+        # Time until which each project is backed off after a server
+        # or connection failure.
+        self.backoff = {}
+        # Time until which each rejected submission id is parked and
+        # the ids of the submissions which are posted on their own.
+        self.parked = {}
+        self.isolated = set()
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0
+        send_queue = Queue.Queue()
+        senders = []
+        for i in range(self.sender_threads):
+            sender = threading.Thread(target=self._sender, args=(send_queue,),
+                                      name='TreeherderSender-%d' % i)
+            sender.daemon = True
+            sender.start()
+            senders.append(sender)
+
+        # The id of the newest submission queued for each project as
+        # of the previous poll.
+        newest_ids = {}
+        while not self.shutdown_requested:
+            # Hold new submissions while others for the same project
+            # are still arriving until the oldest has waited
+            # coalesce_max_age seconds for them to join it. A lone
+            # submission, or one whose project received nothing new
+            # since the previous poll, is posted immediately. Retries
+            # are posted as soon as their backoff has expired.
+            oldest = (datetime.datetime.utcnow() -
+                      datetime.timedelta(seconds=self.coalesce_max_age)).isoformat()
+            queues = self.jobs.get_treeherder_queues()
+            previous_newest_ids = newest_ids
+            newest_ids = dict([(project, newest_id)
+                               for project, submissions, newest_id in queues])
+            for project, submissions, newest_id in queues:
+                with self.lock:
+                    now = time.time()
+                    if not self._dispatchable(project, now):
+                        continue
+                    parked_ids = set([job_id for job_id, until
+                                      in self.parked.iteritems() if until > now])
+                    isolated_ids = set(self.isolated)
+                jobs = self.jobs.get_next_treeherder_jobs(
+                    self.coalesce_max_jobs, self.coalesce_max_bytes,
+                    project=project, exclude_ids=parked_ids,
+                    isolate_ids=isolated_ids)
+                if jobs and (jobs[0]['attempts'] > 0 or
+                             submissions == 1 or
+                             previous_newest_ids.get(project) == newest_id or
+                             jobs[0]['last_attempt'] <= oldest):
+                    with self.lock:
+                        self.busy_projects.add(project)
+                    send_queue.put(jobs)
+            self.report_stats()
+            time.sleep(1)    # avoid busy loop
+
+        for sender in senders:
+            send_queue.put(None)
+        for sender in senders:
+            sender.join()
 
     def shutdown(self):
         self.shutdown_requested = True
@@ -4,24 +4,35 @@
 
 import ConfigParser
 import base64
+import calendar
 import datetime
+import errno
+import functools
 import glob
 import json
 import os
 import re
 import shutil
+import sqlite3
 import tempfile
+import threading
+import time
 import urllib
 import urlparse
+import uuid
 import zipfile
 
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
 import slugid
-import taskcluster
-from thclient import TreeherderClient
+
+import requests
 
 from bs4 import BeautifulSoup
 from requests import HTTPError
 
+import metadatacache
 import utils
 
 from build_dates import (TIMESTAMP, DIRECTORY_DATE, DIRECTORY_DATETIME,
@@ -75,17 +86,18 @@ def get_revision_datetimes(repo, first_revision, last_revision):
 
     returns: first_datetime, last_datetime.
     """
-    prefix = '%sjson-pushes?changeset=' % REPO_URLS[repo]
-    first = utils.get_remote_json('%s%s' % (prefix, first_revision))
-    if first:
-        first_timestamp = first[first.keys()[0]]['date']
-    else:
-        first_timestamp = None
-    last = utils.get_remote_json('%s%s' % (prefix, last_revision))
-    if last:
-        last_timestamp = last[last.keys()[0]]['date']
-    else:
-        last_timestamp = None
+    def get_push_timestamp(revision):
+        push = pushlog().get_push(repo, revision)
+        if push:
+            return push['date']
+        pushes = utils.get_remote_json('%sjson-pushes?changeset=%s' %
+                                       (REPO_URLS[repo], revision))
+        if pushes:
+            return pushes[pushes.keys()[0]]['date']
+        return None
+
+    first_timestamp = get_push_timestamp(first_revision)
+    last_timestamp = get_push_timestamp(last_revision)
 
     if first_timestamp and last_timestamp:
         first_datetime = convert_timestamp_to_date(first_timestamp)
@@ -130,15 +142,21 @@ def get_treeherder_job(repo, job_guid):
         # Note this uses the production instance of Treeherder which
         # should be alright since we are looking up build jobs which
         # will always be available on the production instance.
-        client = TreeherderClient()
-        jobs = client.get_jobs(repo, job_guid=job_guid)
+        def get_job():
+            client = metadatacache.treeherder_client()
+            jobs = client.get_jobs(repo, job_guid=job_guid)
 
-        if len(jobs) == 0 or len(jobs) > 1:
-            logger.warning('get_treeherder_job: job_guid: %s returned %s jobs',
-                           job_guid, len(jobs))
+            if len(jobs) == 0 or len(jobs) > 1:
+                logger.warning('get_treeherder_job: job_guid: %s returned %s jobs',
+                               job_guid, len(jobs))
 
-        if len(jobs) > 0:
-            job = jobs[0]
+            if len(jobs) > 0:
+                return jobs[0]
+            return None
+
+        job = metadatacache.metadata_cache().memoize(
+            metadatacache.MetadataKind.TREEHERDER_JOB,
+            '%s/%s' % (repo, job_guid), get_job)
     except:
         pass
 
@@ -170,11 +188,18 @@ def get_push_revisions(repo, parameters):
     To query by date range, use      {'startdate': 'date1', 'enddate': 'date2'}
     To query by a single revision use {'changeset': 'rev'}
 
+    The local Pushlog mirror is used if it can answer the query,
+    otherwise json-pushes is queried.
     """
     def cmp_push(x, y):
         return x['date'] - y['date']
 
     logger = utils.getLogger()
+    revisions = pushlog().get_revisions(repo, parameters)
+    if revisions is not None:
+        logger.debug('get_push_revisions: %s %s: found in pushlog mirror',
+                     repo, parameters)
+        return revisions
     revisions = []
     pushlog_url = (REPO_URLS[repo] +
                    'json-pushes?tipsonly=1&' +
@@ -196,6 +221,243 @@ def get_push_revisions(repo, parameters):
             revisions.append(pushlog_json[push_id]['changesets'][-1])
     return revisions
 
+
+class Pushlog(object):
+    """Local mirror of the hg pushlogs of the repositories.
+
+    The pushes (pushid, date, user and changesets) of each repository
+    are kept in a SQLite database shared by the Autophone processes.
+    The mirror of a repository initially contains the pushes of the
+    last INITIAL_DAYS days and is brought up to date by fetching only
+    the pushes newer than the last pushid seen, at most once every
+    SYNC_INTERVAL seconds unless a changeset is not found.
+
+    The query methods return None if the mirror can not answer the
+    query, in which case the caller should fall back to json-pushes.
+    """
+
+    INITIAL_DAYS = 7
+    SYNC_INTERVAL = 60
+    BATCH_SIZE = 500
+
+    def __init__(self, filename='pushlog.sqlite',
+                 initial_days=INITIAL_DAYS,
+                 sync_interval=SYNC_INTERVAL):
+        self.filename = filename
+        self.initial_days = initial_days
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+
+    def _conn(self):
+        conn = sqlite3.connect(self.filename, timeout=30)
+        conn.execute('create table if not exists pushes ('
+                     'repo text, '
+                     'pushid integer, '
+                     'date integer, '
+                     'user text, '
+                     'tip text, '
+                     'primary key (repo, pushid))')
+        conn.execute('create index if not exists pushes_date '
+                     'on pushes (repo, date)')
+        conn.execute('create table if not exists changesets ('
+                     'repo text, '
+                     'changeset text, '
+                     'pushid integer, '
+                     'primary key (repo, changeset))')
+        conn.execute('create table if not exists mirrors ('
+                     'repo text primary key, '
+                     'start_date integer, '
+                     'last_pushid integer, '
+                     'synced real)')
+        return conn
+
+    def _fetch(self, repo, parameters):
+        """Return the pushes and last pushid of the version 2
+        json-pushes response for the parameters or None."""
+        logger = utils.getLogger()
+        url = (REPO_URLS[repo] + 'json-pushes?version=2&' +
+               '&'.join(['%s=%s' % (parameter, urllib.quote(str(value)))
+                         for (parameter, value) in sorted(parameters.items())]))
+        response = utils.get_remote_json(url)
+        if not response or 'pushes' not in response:
+            logger.warning('Pushlog: %s not found.', url)
+            return None
+        return response['pushes'], response['lastpushid']
+
+    def _store(self, conn, repo, pushes):
+        for pushid, push in pushes.iteritems():
+            conn.execute('insert or replace into pushes values (?, ?, ?, ?, ?)',
+                         (repo, int(pushid), push['date'], push['user'],
+                          push['changesets'][-1]))
+            conn.executemany('insert or replace into changesets values (?, ?, ?)',
+                             [(repo, changeset, int(pushid))
+                              for changeset in push['changesets']])
+
+    def sync(self, repo, force=False):
+        """Fetch the pushes to repo which are newer than the last
+        pushid in the mirror. Unless force is True, the mirror is not
+        synced if it was synced in the last sync_interval
+        seconds. Returns True if the mirror is up to date. Only the
+        repositories in REPO_URLS are mirrored."""
+        logger = utils.getLogger()
+        if repo not in REPO_URLS:
+            return False
+        with self.lock:
+            conn = None
+            try:
+                conn = self._conn()
+                now = time.time()
+                row = conn.execute('select last_pushid, synced from mirrors '
+                                   'where repo=?', (repo,)).fetchone()
+                if row and not force and now - row[1] < self.sync_interval:
+                    return True
+                if not row:
+                    start_date = int(now) - self.initial_days*24*60*60
+                    start = datetime.datetime.utcfromtimestamp(start_date)
+                    result = self._fetch(repo, {
+                        'startdate': start.strftime('%Y-%m-%d %H:%M:%S')})
+                    if result is None:
+                        return False
+                    pushes, last_pushid = result
+                    self._store(conn, repo, pushes)
+                    conn.execute('insert into mirrors values (?, ?, ?, ?)',
+                                 (repo, start_date, last_pushid, now))
+                    conn.commit()
+                    logger.debug('Pushlog.sync: %s: mirrored %d pushes',
+                                 repo, len(pushes))
+                    return True
+                last_pushid = row[0]
+                while True:
+                    result = self._fetch(repo, {
+                        'startID': last_pushid,
+                        'endID': last_pushid + self.BATCH_SIZE})
+                    if result is None:
+                        return False
+                    pushes, repo_last_pushid = result
+                    self._store(conn, repo, pushes)
+                    if pushes:
+                        last_pushid = max([int(pushid) for pushid in pushes])
+                    done = not pushes or last_pushid >= repo_last_pushid
+                    # The mirror is only marked as synced once it has
+                    # caught up so that a failed sync leaves it stale.
+                    if done:
+                        conn.execute('update mirrors set last_pushid=?, synced=? '
+                                     'where repo=?', (last_pushid, now, repo))
+                    else:
+                        conn.execute('update mirrors set last_pushid=? '
+                                     'where repo=?', (last_pushid, repo))
+                    conn.commit()
+                    logger.debug('Pushlog.sync: %s: mirrored %d pushes',
+                                 repo, len(pushes))
+                    if done:
+                        return True
+            except sqlite3.Error:
+                logger.exception('Pushlog.sync(%s)', repo)
+                return False
+            finally:
+                if conn:
+                    conn.close()
+
+    def _query(self, sql, parameters):
+        logger = utils.getLogger()
+        conn = None
+        try:
+            conn = self._conn()
+            return conn.execute(sql, parameters).fetchall()
+        except sqlite3.Error:
+            logger.exception('Pushlog: %s %s', sql, parameters)
+            return None
+        finally:
+            if conn:
+                conn.close()
+
+    def _get_push(self, repo, changeset):
+        # Changesets may be abbreviated to 12 characters.
+        rows = self._query('select pushes.pushid, pushes.date, pushes.tip '
+                           'from changesets join pushes '
+                           'on changesets.repo=pushes.repo and '
+                           'changesets.pushid=pushes.pushid '
+                           'where changesets.repo=? and '
+                           'changesets.changeset>=? and changesets.changeset<?',
+                           (repo, changeset, changeset + 'g'))
+        if rows:
+            pushid, date, tip = rows[0]
+            return {'pushid': pushid, 'date': date, 'tip': tip}
+        return None
+
+    def get_push(self, repo, changeset):
+        """Return a dict with the pushid, date and tip revision of the
+        push of changeset to repo or None."""
+        self.sync(repo)
+        push = self._get_push(repo, changeset)
+        if not push and self.sync(repo, force=True):
+            push = self._get_push(repo, changeset)
+        return push
+
+    def get_pushes(self, repo, start_date, end_date):
+        """Return the list of (pushid, date, tip) tuples of the pushes
+        to repo from start_date through end_date in seconds since
+        the epoch in push date order or None if the mirror can not be
+        synced or does not cover start_date through end_date."""
+        if not self.sync(repo):
+            return None
+        rows = self._query('select start_date, synced from mirrors '
+                           'where repo=?', (repo,))
+        if not rows or start_date < rows[0][0]:
+            return None
+        # A mirror synced in the last sync_interval seconds is as
+        # current as get_push assumes and covers any end_date up to
+        # now. An end_date in the future covers the pushes to date.
+        if min(end_date, time.time()) > rows[0][1] + self.sync_interval:
+            return None
+        return self._query('select pushid, date, tip from pushes '
+                           'where repo=? and date>=? and date<=? '
+                           'order by date, pushid',
+                           (repo, start_date, end_date))
+
+    def get_revisions(self, repo, parameters):
+        """Return the list of tip revisions for the json-pushes
+        parameters accepted by get_push_revisions in push date order
+        or None if the mirror can not answer the query."""
+        if 'changeset' in parameters:
+            push = self.get_push(repo, parameters['changeset'])
+            if push:
+                return [push['tip']]
+        elif 'fromchange' in parameters and 'tochange' in parameters:
+            from_push = self.get_push(repo, parameters['fromchange'])
+            to_push = self.get_push(repo, parameters['tochange'])
+            if from_push and to_push:
+                rows = self._query('select tip from pushes '
+                                   'where repo=? and pushid>? and pushid<=? '
+                                   'order by date, pushid',
+                                   (repo, from_push['pushid'], to_push['pushid']))
+                if rows is not None:
+                    return [row[0] for row in rows]
+        elif 'startdate' in parameters and 'enddate' in parameters:
+            pushes = self.get_pushes(
+                repo,
+                calendar.timegm(time.strptime(parameters['startdate'],
+                                              '%Y-%m-%d %H:%M:%S')),
+                calendar.timegm(time.strptime(parameters['enddate'],
+                                              '%Y-%m-%d %H:%M:%S')))
+            if pushes is not None:
+                return [tip for (pushid, date, tip) in pushes]
+        return None
+
+
+_PUSHLOG = None
+
+
+def pushlog():
+    """Return the process wide Pushlog."""
+    global _PUSHLOG
+
+    if not _PUSHLOG:
+        _PUSHLOG = Pushlog(os.path.join(utils.autophone_path(),
+                                        'pushlog.sqlite'))
+    return _PUSHLOG
+
+
 class BuildLocation(object):
     def __init__(self, repos, buildtypes,
                  product, build_platforms, buildfile_ext):
@@ -219,13 +481,18 @@ class BuildLocation(object):
 
 
 class TaskClusterBuilds(BuildLocation):
+
+    # Maximum number of concurrent Taskcluster and Treeherder requests
+    # made while discovering builds.
+    DISCOVERY_THREADS = 8
+
     def __init__(self, repos, buildtypes,
-                 product, build_platforms, buildfile_ext, nightly):
+                 product, build_platforms, buildfile_ext, nightly,
+                 discovery_threads=DISCOVERY_THREADS):
         BuildLocation.__init__(self, repos, buildtypes,
                                product, build_platforms, buildfile_ext)
         self.nightly = nightly
-        self.index = taskcluster.index.Index()
-        self.queue = taskcluster.queue.Queue()
+        self.discovery_threads = discovery_threads
 
     def find_latest_builds(self):
         task_ids_by_repo = self._find_latest_task_ids()
@@ -390,78 +657,105 @@ class TaskClusterBuilds(BuildLocation):
         logger.debug('find_builds_by_revision: %s', builds)
         return builds
 
+    def _map(self, func, items):
+        """Return the list of func(item) for each item in items using at
+        most discovery_threads concurrent threads. The results are
+        in the same order as items."""
+        if len(items) < 2 or self.discovery_threads < 2:
+            return [func(item) for item in items]
+        pool = ThreadPool(min(len(items), self.discovery_threads))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
     def _find_builds_by_task_ids(self, task_ids_by_repo, only_run_id=None, start_time=None, end_time=None):
         """Return a list of build_data objects for the build_urls for the
         specified tasks.
         """
         logger = utils.getLogger()
-        builds_by_repo = {}
+        repo_task_ids = [(repo, task_id) for repo in task_ids_by_repo
+                         for task_id in task_ids_by_repo[repo]]
+        results = self._map(
+            lambda (repo, task_id): self._find_builds_by_task_id(
+                repo, task_id, only_run_id, start_time, end_time),
+            repo_task_ids)
+        builds_by_repo = dict([(repo, []) for repo in task_ids_by_repo])
+        for (repo, task_id), builds in zip(repo_task_ids, results):
+            builds_by_repo[repo].extend(builds)
+        for repo in builds_by_repo:
+            logger.debug('_find_builds_by_task_ids: %s', builds_by_repo[repo])
+        return builds_by_repo
+
+    def _find_builds_by_task_id(self, repo, task_id, only_run_id, start_time, end_time):
+        """Return a list of build_data objects for the build_urls of the
+        latest completed run of the task.
+        """
+        logger = utils.getLogger()
+        builds = []
         url_format = 'https://queue.taskcluster.net/v1/task/%s/runs/%s/artifacts/%s'
         re_fennec = re.compile(r'(fennec|target|geckoview_example).*apk$')
-        for repo in task_ids_by_repo:
-            builds_by_repo[repo] = builds = []
-            for task_id in task_ids_by_repo[repo]:
-                status = self.queue.status(task_id)['status']
-                worker_type = status['workerType']
-                builder_type = 'buildbot' if (worker_type == 'buildbot') else 'taskcluster'
-                logger.debug('_find_builds_by_task_ids: status: %s', status)
-                build_found = False
-                for run in reversed(status['runs']): # runs
-                    if build_found:
-                        break
-                    if run['state'] != 'completed':
-                        continue
-                    run_id = run['runId']
-                    if only_run_id is not None and only_run_id != run_id:
-                        continue
-                    tier = get_treeherder_tier(repo, task_id, run_id)
-                    artifacts = utils.taskcluster_artifacts(task_id, run_id)
-                    try:
-                        build_data = build_date = build_url = None
-                        while True: # artifacts
-                            # Collect all matching builds for this run.
-                            artifact = artifacts.next()
-                            artifact_name = artifact['name']
-                            search = re_fennec.search(artifact_name)
-                            if search:
-                                build_url = url_format % (task_id, run_id, artifact_name)
-                                if build_data:
-                                    # We have already obtained build_data for this run.
-                                    # We only need to copy the dict and update the build_url
-                                    # for this new artifact.
-                                    build_data = dict(build_data)
-                                    build_data['url'] = build_url
-                                else:
-                                    build_data = utils.get_build_data(build_url,
-                                                                      builder_type=builder_type)
-                                if not build_data:
-                                    # Failed to get the build data for this
-                                    # build. Break out of the artifacts for this
-                                    # run but keep looking for a build in earlier
-                                    # runs.
-                                    logger.warning('_find_builds_by_task_ids: '
-                                                   'task_id: %s, run_id: %s: '
-                                                   'could not get %s', task_id, run_id, build_url)
-                                    break # artifacts
-                                # Fall back to the taskcluster workerType to get the sdk if possible
-                                if build_data['sdk'] is None:
-                                    (platform, sdk) = parse_taskcluster_worker_type(worker_type)
-                                    if sdk:
-                                        build_data['platform'] = worker_type
-                                        build_data['sdk'] = sdk
-                                if 'nightly_build' in build_data and not build_data['nightly_build']:
-                                    break # artifacts
-                                build_date = build_data['date']
-                                if (start_time and end_time and build_date >= start_time and build_date <= end_time) or (start_time and build_date >= start_time) or (end_time and build_date <= end_time) or (not start_time and not end_time):
-                                    build_found = True
-                                    logger.debug('_find_builds_by_task_ids: adding worker_type: '
-                                                 '%s, build_data: %s, tier: %s',
-                                                 worker_type, build_data, tier)
-                                    builds.append(build_data)
-                    except StopIteration:
-                        pass
-            logger.debug('_find_builds_by_task_ids: %s', builds)
-        return builds_by_repo
+        status = utils.get_taskcluster_task_status(task_id)['status']
+        worker_type = status['workerType']
+        builder_type = 'buildbot' if (worker_type == 'buildbot') else 'taskcluster'
+        logger.debug('_find_builds_by_task_ids: status: %s', status)
+        build_found = False
+        for run in reversed(status['runs']): # runs
+            if build_found:
+                break
+            if run['state'] != 'completed':
+                continue
+            run_id = run['runId']
+            if only_run_id is not None and only_run_id != run_id:
+                continue
+            tier = get_treeherder_tier(repo, task_id, run_id)
+            artifacts = utils.taskcluster_artifacts(task_id, run_id)
+            try:
+                build_data = build_date = build_url = None
+                while True: # artifacts
+                    # Collect all matching builds for this run.
+                    artifact = artifacts.next()
+                    artifact_name = artifact['name']
+                    search = re_fennec.search(artifact_name)
+                    if search:
+                        build_url = url_format % (task_id, run_id, artifact_name)
+                        if build_data:
+                            # We have already obtained build_data for this run.
+                            # We only need to copy the dict and update the build_url
+                            # for this new artifact.
+                            build_data = dict(build_data)
+                            build_data['url'] = build_url
+                        else:
+                            build_data = utils.get_build_data(build_url,
+                                                              builder_type=builder_type)
+                        if not build_data:
+                            # Failed to get the build data for this
+                            # build. Break out of the artifacts for this
+                            # run but keep looking for a build in earlier
+                            # runs.
+                            logger.warning('_find_builds_by_task_ids: '
+                                           'task_id: %s, run_id: %s: '
+                                           'could not get %s', task_id, run_id, build_url)
+                            break # artifacts
+                        # Fall back to the taskcluster workerType to get the sdk if possible
+                        if build_data['sdk'] is None:
+                            (platform, sdk) = parse_taskcluster_worker_type(worker_type)
+                            if sdk:
+                                build_data['platform'] = worker_type
+                                build_data['sdk'] = sdk
+                        if 'nightly_build' in build_data and not build_data['nightly_build']:
+                            break # artifacts
+                        build_date = build_data['date']
+                        if (start_time and end_time and build_date >= start_time and build_date <= end_time) or (start_time and build_date >= start_time) or (end_time and build_date <= end_time) or (not start_time and not end_time):
+                            build_found = True
+                            logger.debug('_find_builds_by_task_ids: adding worker_type: '
+                                         '%s, build_data: %s, tier: %s',
+                                         worker_type, build_data, tier)
+                            builds.append(build_data)
+            except StopIteration:
+                pass
+        return builds
 
     def _find_latest_task_ids(self):
         """Return an object keyed by repository name. Each item in the object
@@ -488,14 +782,14 @@ class TaskClusterBuilds(BuildLocation):
             task_ids_by_repo[repo] = task_ids = []
             namespace = namespace_format % (namespace_version, repo)
             payload = {}
-            response = self.index.listTasks(namespace, payload)
+            response = metadatacache.taskcluster_index().listTasks(namespace, payload)
             logger.debug('_find_latest_task_ids: listTasks(%s, %s): response: %s',
                          namespace, payload, response)
             for task in response['tasks']:
                 # gecko.v2.mozilla-central.nightly.latest.mobile.android-api-16-opt
                 logger.debug('_find_latest_task_ids: task: %s', task)
                 task_id = task['taskId']
-                task_definition = self.queue.task(task_id)
+                task_definition = utils.get_taskcluster_task_definition(task_id)
                 logger.debug('_find_latest_task_ids: task_definition: %s', task_definition)
                 worker_type = task_definition['workerType']
                 # Just hard-code run_id 0 since we are only interested in the tier.
@@ -581,95 +875,120 @@ class TaskClusterBuilds(BuildLocation):
     def _find_task_ids_by_revisions(self, revisions_by_repo):
         """Return an object keyed by repository name. Each item in the object
         is a list of the task ids corresponding to the revisions.
+
+        The tasks for each revision are listed concurrently and then
+        each task is checked concurrently. The task ids are returned
+        in revision order.
         """
         logger = utils.getLogger()
-        namespace_version = 'v2'
-        namespace_format = 'gecko.%s.%s.revision.%s.mobile'
-
-        task_ids_by_repo = {}
 
         logger.debug('_find_task_ids_by_revisions: revisions_by_repo: %s',
                      revisions_by_repo)
 
-        for repo in revisions_by_repo:
-            task_ids_by_repo[repo] = task_ids = []
-            for revision in revisions_by_repo[repo]:
-                logger.debug('_find_task_ids_by_revisions: repo: %s, revision: %s',
-                             repo, revision)
-                # We could iterate over the build_platforms by adding
-                # the build_platform to the routing key, but that will
-                # end up paying a cost of looking up obsolete
-                # platforms in perpetuity. Instead we can list the
-                # namespaces under mobile and get the currently
-                # supported namespaces and filter those.
-
-                namespace = namespace_format % (namespace_version, repo, revision)
-                payload = {}
-                response = self.index.listTasks(namespace, payload)
-                for task in response['tasks']:
-                    logger.debug('_find_task_ids_by_revisions: task: %s', task)
-                    task_id = task['taskId']
-                    task_namespace = task['namespace']
-                    task_definition = self.queue.task(task_id)
-                    logger.debug('_find_task_ids_by_revisions: task_definition: %s',
-                                 task_definition)
-                    build_data = utils.get_build_data_from_taskcluster_task_definition(task_definition)
-                    logger.debug('_find_task_ids_by_revisions: build_data: %s',
-                                 build_data)
-                    worker_type = task_definition['workerType']
-                    builder_type = 'buildbot' if worker_type == 'buildbot' else 'taskcluster'
-                    # Just hard-code run_id 0 since the tier shouldn't change.
-                    tier = get_treeherder_tier(repo, task_id, 0)
-                    platform = build_type = None
-                    if build_data:
-                        logger.debug('_find_task_ids_by_revisions: using build_data')
-                        platform = build_data['platform']
-                        build_type = build_data['build_type']
-                    elif builder_type == 'buildbot':
-                        logger.debug('_find_task_ids_by_revisions: using task_namespace')
-                        (platform, build_type) = parse_taskcluster_namespace(task_namespace)
-                    else:
-                        logger.debug('_find_task_ids_by_revisions: using task_definition')
-                        if 'metadata' in task_definition and \
-                           'name' in task_definition['metadata'] and \
-                           '/' in task_definition['metadata']['name']:
-                            logger.debug('_find_task_ids_by_revisions: '
-                                         'using task_definition["metadata"]["name"]')
-                            # task_definition['metadata']['name'] has the form:
-                            # 'build-<platform>/<buildtype>'. For example:
-                            # 'build-android-api-16/debug'
-                            (platform, build_type) = task_definition['metadata']['name'].split('/')
-                            platform = platform.replace('build-', '')
-                        if build_type is None and 'extra' in task_definition and \
-                           'build_type' in task_definition['extra']:
-                            logger.debug('_find_task_ids_by_revisions: '
-                                         'using task_definition["workerType"] and '
-                                         'task_definition["extra"]["build_type"]')
-                            platform = task_definition['workerType']
-                            build_type = task_definition['extra']['build_type']
-                        if build_type is None:
-                            logger.warning('_find_task_ids_by_revisions: could not determine build_type')
-                    logger.debug('_find_task_ids_by_revisions: builder_type: %s, '
-                                 'platform: %s, build_platforms: %s, '
-                                 'build_type: %s, build_types: %s, '
-                                 'tier: %s',
-                                 builder_type,
-                                 platform, self.build_platforms,
-                                 build_type, self.buildtypes,
-                                 tier)
-                    # We must relax the tier 1 requirement since we want geckoview_example
-                    # builds but they are tier 2.
-                    if platform in self.build_platforms and \
-                       build_type in self.buildtypes and \
-                       (builder_type == 'buildbot' or tier >= 1):
-                        logger.debug('_find_task_ids_by_revisions: adding builder_type: %s, '
-                                     'task_id: %s, tier: %s, repo: %s, platform: %s, '
-                                     'build_type; %s',
-                                     builder_type, task_id, tier, repo, platform, build_type)
-                        task_ids.append(task_id)
+        repo_revisions = [(repo, revision) for repo in revisions_by_repo
+                          for revision in revisions_by_repo[repo]]
+        results = self._map(
+            lambda (repo, revision): self._list_revision_tasks(repo, revision),
+            repo_revisions)
+        repo_tasks = [(repo, task)
+                      for (repo, revision), tasks in zip(repo_revisions, results)
+                      for task in tasks]
+        results = self._map(
+            lambda (repo, task): self._is_matching_task(repo, task),
+            repo_tasks)
+        task_ids_by_repo = dict([(repo, []) for repo in revisions_by_repo])
+        for (repo, task), matches in zip(repo_tasks, results):
+            if matches:
+                task_ids_by_repo[repo].append(task['taskId'])
         logger.debug('_find_task_ids_by_revisions: %s', task_ids_by_repo)
         return task_ids_by_repo
 
+    def _list_revision_tasks(self, repo, revision):
+        """Return the list of tasks indexed under the mobile namespace
+        for the revision."""
+        logger = utils.getLogger()
+        namespace_version = 'v2'
+        namespace_format = 'gecko.%s.%s.revision.%s.mobile'
+        logger.debug('_find_task_ids_by_revisions: repo: %s, revision: %s',
+                     repo, revision)
+        # We could iterate over the build_platforms by adding
+        # the build_platform to the routing key, but that will
+        # end up paying a cost of looking up obsolete
+        # platforms in perpetuity. Instead we can list the
+        # namespaces under mobile and get the currently
+        # supported namespaces and filter those.
+
+        namespace = namespace_format % (namespace_version, repo, revision)
+        payload = {}
+        response = metadatacache.taskcluster_index().listTasks(namespace, payload)
+        return response['tasks']
+
+    def _is_matching_task(self, repo, task):
+        """Return True if the task is a build for one of the
+        build_platforms and buildtypes."""
+        logger = utils.getLogger()
+        logger.debug('_find_task_ids_by_revisions: task: %s', task)
+        task_id = task['taskId']
+        task_namespace = task['namespace']
+        task_definition = utils.get_taskcluster_task_definition(task_id)
+        logger.debug('_find_task_ids_by_revisions: task_definition: %s',
+                     task_definition)
+        build_data = utils.get_build_data_from_taskcluster_task_definition(task_definition)
+        logger.debug('_find_task_ids_by_revisions: build_data: %s',
+                     build_data)
+        worker_type = task_definition['workerType']
+        builder_type = 'buildbot' if worker_type == 'buildbot' else 'taskcluster'
+        # Just hard-code run_id 0 since the tier shouldn't change.
+        tier = get_treeherder_tier(repo, task_id, 0)
+        platform = build_type = None
+        if build_data:
+            logger.debug('_find_task_ids_by_revisions: using build_data')
+            platform = build_data['platform']
+            build_type = build_data['build_type']
+        elif builder_type == 'buildbot':
+            logger.debug('_find_task_ids_by_revisions: using task_namespace')
+            (platform, build_type) = parse_taskcluster_namespace(task_namespace)
+        else:
+            logger.debug('_find_task_ids_by_revisions: using task_definition')
+            if 'metadata' in task_definition and \
+               'name' in task_definition['metadata'] and \
+               '/' in task_definition['metadata']['name']:
+                logger.debug('_find_task_ids_by_revisions: '
+                             'using task_definition["metadata"]["name"]')
+                # task_definition['metadata']['name'] has the form:
+                # 'build-<platform>/<buildtype>'. For example:
+                # 'build-android-api-16/debug'
+                (platform, build_type) = task_definition['metadata']['name'].split('/')
+                platform = platform.replace('build-', '')
+            if build_type is None and 'extra' in task_definition and \
+               'build_type' in task_definition['extra']:
+                logger.debug('_find_task_ids_by_revisions: '
+                             'using task_definition["workerType"] and '
+                             'task_definition["extra"]["build_type"]')
+                platform = task_definition['workerType']
+                build_type = task_definition['extra']['build_type']
+            if build_type is None:
+                logger.warning('_find_task_ids_by_revisions: could not determine build_type')
+        logger.debug('_find_task_ids_by_revisions: builder_type: %s, '
+                     'platform: %s, build_platforms: %s, '
+                     'build_type: %s, build_types: %s, '
+                     'tier: %s',
+                     builder_type,
+                     platform, self.build_platforms,
+                     build_type, self.buildtypes,
+                     tier)
+        # We must relax the tier 1 requirement since we want geckoview_example
+        # builds but they are tier 2.
+        if platform in self.build_platforms and \
+           build_type in self.buildtypes and \
+           (builder_type == 'buildbot' or tier >= 1):
+            logger.debug('_find_task_ids_by_revisions: adding builder_type: %s, '
+                         'task_id: %s, tier: %s, repo: %s, platform: %s, '
+                         'build_type; %s',
+                         builder_type, task_id, tier, repo, platform, build_type)
+            return True
+        return False
+
 
 class FtpBuildLocation(BuildLocation):
     def __init__(self, repos, buildtypes,
@@ -1092,17 +1411,437 @@ class BuildCacheException(Exception):
     pass
 
 
+def _paths_cover(paths, other_paths):
+    """Return True if each path prefix in other_paths begins with one
+    of the path prefixes in paths."""
+    return all([other_path.startswith(tuple(paths)) for other_path in other_paths])
+
+
+def _merge_paths(paths, other_paths):
+    """Return the sorted union of the path prefixes in paths and
+    other_paths without the prefixes already covered by a shorter
+    prefix."""
+    merged = []
+    for path in sorted(set(paths) | set(other_paths)):
+        if not merged or not path.startswith(tuple(merged)):
+            merged.append(path)
+    return merged
+
+
+class BlobStore(object):
+    """Content addressed store of the files downloaded into a
+    BuildCache.
+
+    Each file is stored once as <path>/<digest[:2]>/<digest> where
+    digest is the sha256 digest of its contents and the build
+    directories contain hardlinks to the stored files. Files are never
+    modified in place, since downloads are written to temporary files
+    which are moved over the existing files, so a build directory can
+    never change the contents seen by another. The number of build
+    directories referring to each blob is kept in the BuildCacheIndex.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def link(self, path, digest):
+        """Store the file at path whose sha256 digest is digest. If the
+        blob is already stored, replace the file with a hardlink to it.
+        Returns True if the file is stored or None if hardlinks are not
+        supported."""
+        logger = utils.getLogger()
+        blob_path = self.blob_path(digest)
+        try:
+            try:
+                os.makedirs(os.path.dirname(blob_path))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                os.link(path, blob_path)
+                return True
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            if os.path.samefile(path, blob_path):
+                return True
+            link_path = '%s.%s.link' % (path, uuid.uuid4().hex)
+            os.link(blob_path, link_path)
+            os.rename(link_path, path)
+            return True
+        except OSError:
+            logger.exception('BlobStore.link(%s, %s)', path, digest)
+            return None
+
+    def remove(self, digest):
+        """Remove the blob for digest unless a build directory still
+        links to it."""
+        blob_path = self.blob_path(digest)
+        try:
+            if os.stat(blob_path).st_nlink == 1:
+                os.unlink(blob_path)
+        except OSError:
+            pass
+
+
+def _path_size(path):
+    """Return the number of bytes used by the file or the files in the
+    directory tree at path."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+
+def record_build_artifacts(build_path, names):
+    """Record in the build cache index the sizes of the files or
+    directories names in the build directory build_path which were
+    created after the build was fetched, such as the symbols extracted
+    when a crash is processed, so that they count towards the byte
+    budget of the cache. Does nothing if build_path is not in a build
+    cache."""
+    logger = utils.getLogger()
+    cache_dir = os.path.dirname(os.path.abspath(build_path))
+    if not os.path.exists(os.path.join(cache_dir, BuildCacheIndex.FILENAME)):
+        return
+    artifacts = {}
+    for name in names:
+        path = os.path.join(build_path, name)
+        try:
+            if os.path.exists(path):
+                artifacts[name] = _path_size(path)
+        except OSError:
+            logger.exception('record_build_artifacts: %s', path)
+    if artifacts:
+        BuildCacheIndex(cache_dir).update(os.path.basename(build_path),
+                                          artifacts)
+
+
+class BuildCacheIndex(object):
+    """Index of the builds in a BuildCache directory.
+
+    Each build directory is recorded with the number of bytes used by
+    each of its artifacts, the digests of the artifacts kept in the
+    BlobStore and the time it was last used so that the cache can be
+    expired without scanning it. Each blob is recorded with its size
+    and the number of build directories referring to it. If the index
+    is empty when it is opened, it is rebuilt from the build
+    directories already present in the cache.
+
+    Since the index only drives expiration, database errors are logged
+    and ignored.
+    """
+
+    FILENAME = 'index.sqlite'
+
+    def __init__(self, cache_dir, filename=FILENAME):
+        self.cache_dir = cache_dir
+        self.filename = os.path.join(cache_dir, filename)
+        logger = utils.getLogger()
+        conn = None
+        try:
+            conn = self._conn()
+            self._create_schema(conn)
+            if not conn.execute('select count(*) from builds').fetchone()[0]:
+                self._rebuild(conn)
+        except sqlite3.Error:
+            logger.exception('BuildCacheIndex(%s)', self.filename)
+        finally:
+            if conn:
+                conn.close()
+
+    def _create_schema(self, conn):
+        """Create the tables and add the columns missing from indexes
+        created by earlier versions."""
+        conn.execute('create table if not exists builds ('
+                     'build_dir text primary key, '
+                     'artifacts text, '
+                     'size integer, '
+                     'last_used real, '
+                     "blobs text default '{}')")
+        columns = [row[1] for row in
+                   conn.execute('pragma table_info(builds)').fetchall()]
+        if 'blobs' not in columns:
+            conn.execute("alter table builds add column blobs text default '{}'")
+        conn.execute('create table if not exists blobs ('
+                     'digest text primary key, '
+                     'size integer, '
+                     'refs integer)')
+        conn.commit()
+
+    def _conn(self):
+        return sqlite3.connect(self.filename, timeout=30)
+
+    def _add_ref(self, conn, digest, size):
+        conn.execute('insert or ignore into blobs values (?, ?, 0)',
+                     (digest, size))
+        conn.execute('update blobs set refs=refs+1 where digest=?', (digest,))
+
+    def _remove_ref(self, conn, digest):
+        """Remove a reference to digest and return True if it was the
+        last."""
+        conn.execute('update blobs set refs=refs-1 where digest=?', (digest,))
+        row = conn.execute('select refs from blobs where digest=?',
+                           (digest,)).fetchone()
+        if row and row[0] <= 0:
+            conn.execute('delete from blobs where digest=?', (digest,))
+            return True
+        return False
+
+    def _rebuild(self, conn):
+        """Index the build directories found in the cache, recording
+        the size of each of their top level entries as an artifact."""
+        logger = utils.getLogger()
+        for build_dir in os.listdir(self.cache_dir):
+            build_path = os.path.join(self.cache_dir, build_dir)
+            if (not os.path.isdir(build_path) or
+                build_dir in (BuildCache.BLOBS_DIR, BuildCache.QUARANTINE_DIR)):
+                continue
+            artifacts = {}
+            for name in os.listdir(build_path):
+                artifacts[name] = _path_size(os.path.join(build_path, name))
+            lastused_path = os.path.join(build_path, 'lastused')
+            if os.path.exists(lastused_path):
+                last_used = os.stat(lastused_path).st_mtime
+            else:
+                last_used = os.stat(build_path).st_mtime
+            logger.debug('BuildCacheIndex: indexing %s', build_dir)
+            conn.execute('insert or replace into builds '
+                         '(build_dir, artifacts, size, last_used, blobs) '
+                         'values (?, ?, ?, ?, ?)',
+                         (build_dir, json.dumps(artifacts),
+                          sum(artifacts.values()), last_used, '{}'))
+        conn.commit()
+
+    def update(self, build_dir, artifacts, blobs={}):
+        """Mark build_dir as used now and record the sizes in bytes of
+        the artifacts, a dict mapping artifact names to sizes, which
+        were fetched for it. blobs maps the names of the artifacts
+        stored in the BlobStore to (digest, size) tuples.
+
+        Returns the list of digests of the blobs which are no longer
+        referred to by any build directory."""
+        logger = utils.getLogger()
+        orphans = []
+        conn = None
+        try:
+            conn = self._conn()
+            row = conn.execute('select artifacts, blobs from builds '
+                               'where build_dir=?', (build_dir,)).fetchone()
+            if row:
+                recorded = json.loads(row[0])
+                recorded.update(artifacts)
+                recorded_blobs = json.loads(row[1] or '{}')
+            else:
+                recorded = artifacts
+                recorded_blobs = {}
+            for name, (digest, size) in blobs.items():
+                old_digest = recorded_blobs.get(name)
+                if old_digest == digest:
+                    continue
+                self._add_ref(conn, digest, size)
+                if old_digest and self._remove_ref(conn, old_digest):
+                    orphans.append(old_digest)
+                recorded_blobs[name] = digest
+            conn.execute('insert or replace into builds '
+                         '(build_dir, artifacts, size, last_used, blobs) '
+                         'values (?, ?, ?, ?, ?)',
+                         (build_dir, json.dumps(recorded),
+                          sum(recorded.values()), time.time(),
+                          json.dumps(recorded_blobs)))
+            conn.commit()
+        except sqlite3.Error:
+            logger.exception('BuildCacheIndex.update(%s)', build_dir)
+        finally:
+            if conn:
+                conn.close()
+        return orphans
+
+    def remove(self, build_dir):
+        """Remove build_dir from the index. Returns a tuple of the
+        number of bytes freed by removing the build directory and the
+        list of digests of the blobs which are no longer referred
+        to by any build directory."""
+        logger = utils.getLogger()
+        freed = 0
+        orphans = []
+        conn = None
+        try:
+            conn = self._conn()
+            row = conn.execute('select size, blobs from builds where build_dir=?',
+                               (build_dir,)).fetchone()
+            if row:
+                freed = row[0]
+                for digest in json.loads(row[1] or '{}').values():
+                    if self._remove_ref(conn, digest):
+                        orphans.append(digest)
+                    else:
+                        freed -= conn.execute(
+                            'select size from blobs where digest=?',
+                            (digest,)).fetchone()[0]
+            conn.execute('delete from builds where build_dir=?', (build_dir,))
+            conn.commit()
+        except sqlite3.Error:
+            logger.exception('BuildCacheIndex.remove(%s)', build_dir)
+        finally:
+            if conn:
+                conn.close()
+        return freed, orphans
+
+    def stats(self):
+        """Return a tuple of the number of bytes used by the indexed
+        build directories counting each hardlink separately and the
+        number of bytes they occupy on disk."""
+        logger = utils.getLogger()
+        conn = None
+        try:
+            conn = self._conn()
+            logical = conn.execute('select sum(size) from builds').fetchone()[0] or 0
+            shared = conn.execute('select sum(size*(refs-1)) from blobs '
+                                  'where refs>1').fetchone()[0] or 0
+            return logical, logical - shared
+        except sqlite3.Error:
+            logger.exception('BuildCacheIndex.stats()')
+            return 0, 0
+        finally:
+            if conn:
+                conn.close()
+
+    def entries(self):
+        """Return a list of (build_dir, size, last_used) tuples for the
+        indexed builds, least recently used first."""
+        logger = utils.getLogger()
+        conn = None
+        try:
+            conn = self._conn()
+            return conn.execute('select build_dir, size, last_used from builds '
+                                'order by last_used').fetchall()
+        except sqlite3.Error:
+            logger.exception('BuildCacheIndex.entries()')
+            return []
+        finally:
+            if conn:
+                conn.close()
+
+
+class BuildMetadataIndex(object):
+    """Index of the BuildMetadata of the builds in a BuildCache
+    directory and the build data returned by utils.get_build_data()
+    for them.
+
+    Entries are keyed by the build url and the sha256 digest of the
+    fennec.apk the metadata was read from so that a local build which
+    has been rebuilt at the same url is inspected again.
+
+    Since the index is only an optimization, database errors are
+    logged and treated as misses.
+    """
+
+    def __init__(self, cache_dir, filename='build_metadata.sqlite'):
+        self.filename = os.path.join(cache_dir, filename)
+
+    def _conn(self):
+        conn = sqlite3.connect(self.filename, timeout=30)
+        conn.execute('create table if not exists build_metadata ('
+                     'build_url text, '
+                     'digest text, '
+                     'directory text, '
+                     'metadata text, '
+                     'build_data text, '
+                     'primary key (build_url, digest))')
+        return conn
+
+    def get(self, build_url, digest):
+        """Return a tuple of the BuildMetadata json and the build data
+        recorded for build_url and digest or None."""
+        logger = utils.getLogger()
+        conn = None
+        try:
+            conn = self._conn()
+            row = conn.execute('select metadata, build_data from build_metadata '
+                               'where build_url=? and digest=?',
+                               (build_url, digest)).fetchone()
+            if row:
+                build_data = json.loads(row[1])
+                if build_data.get('date') is not None:
+                    build_data['date'] = datetime.datetime.fromtimestamp(
+                        build_data['date'], UTC)
+                return json.loads(row[0]), build_data
+        except (sqlite3.Error, ValueError):
+            logger.exception('BuildMetadataIndex.get(%s, %s)', build_url, digest)
+        finally:
+            if conn:
+                conn.close()
+        return None
+
+    def put(self, build_url, digest, directory, metadata, build_data):
+        """Record the BuildMetadata json metadata and the build data
+        of build_url in directory for digest, replacing the entries
+        for other digests of build_url."""
+        logger = utils.getLogger()
+        if build_data.get('date') is not None:
+            # Record the build date as a timestamp.
+            build_data = dict(build_data, date=calendar.timegm(
+                build_data['date'].utctimetuple()))
+        conn = None
+        try:
+            conn = self._conn()
+            conn.execute('delete from build_metadata where build_url=?',
+                         (build_url,))
+            conn.execute('insert into build_metadata values (?, ?, ?, ?, ?)',
+                         (build_url, digest, directory, json.dumps(metadata),
+                          json.dumps(build_data)))
+            conn.commit()
+        except sqlite3.Error:
+            logger.exception('BuildMetadataIndex.put(%s, %s)', build_url, digest)
+        finally:
+            if conn:
+                conn.close()
+
+    def remove(self, directory):
+        """Remove the entries of the builds in directory."""
+        logger = utils.getLogger()
+        conn = None
+        try:
+            conn = self._conn()
+            conn.execute('delete from build_metadata where directory=?',
+                         (directory,))
+            conn.commit()
+        except sqlite3.Error:
+            logger.exception('BuildMetadataIndex.remove(%s)', directory)
+        finally:
+            if conn:
+                conn.close()
+
+
 class BuildCache(object):
 
     MAX_NUM_BUILDS = 20
     EXPIRE_AFTER_DAYS = 1
+    MAX_BYTES = 20*1024*1024*1024
+    MIN_FREE_BYTES = 5*1024*1024*1024
+    FETCH_THREADS = 4
+    BLOBS_DIR = 'blobs'
+    QUARANTINE_DIR = 'quarantine'
+    PEER_TIMEOUT = 10
+    SCRUB_INTERVAL = 24*60*60
 
     def __init__(self, repos, buildtypes,
                  product, build_platforms, buildfile_ext,
                  cache_dir='builds', override_build_dir=None,
                  build_cache_size=MAX_NUM_BUILDS,
                  build_cache_expires=EXPIRE_AFTER_DAYS,
-                 treeherder_url=None):
+                 build_cache_max_bytes=MAX_BYTES,
+                 build_cache_min_free_bytes=MIN_FREE_BYTES,
+                 treeherder_url=None,
+                 fetch_threads=FETCH_THREADS,
+                 peers=[]):
         logger = utils.getLogger()
         self.repos = repos
         self.buildtypes = buildtypes
@@ -1124,7 +1863,21 @@ class BuildCache(object):
             os.mkdir(self.cache_dir)
         self.build_cache_size = build_cache_size
         self.build_cache_expires = build_cache_expires
+        self.build_cache_max_bytes = build_cache_max_bytes
+        self.build_cache_min_free_bytes = build_cache_min_free_bytes
+        self.index = BuildCacheIndex(self.cache_dir)
+        self.blob_store = BlobStore(os.path.join(self.cache_dir, self.BLOBS_DIR))
+        self.metadata_index = BuildMetadataIndex(self.cache_dir)
+        # host:port of the BuildCachePeerServers of other hosts which
+        # are tried before downloading files from upstream.
+        self.peers = ['http://%s' % peer for peer in peers]
+        self.peer_session = requests.Session()
         self.treeherder_url = treeherder_url
+        self.fetch_threads = fetch_threads
+        # Number of get() calls in progress for each build directory.
+        # These directories are never expired by clean_cache().
+        self.active_build_dirs = {}
+        self.lock = threading.Lock()
         logger.debug('BuildCache: %s', self.__dict__)
 
     def build_location(self, s):
@@ -1175,7 +1928,8 @@ class BuildCache(object):
         return build_location.find_builds_by_revision(first_revision, last_revision)
 
     def get(self, build_url, force=False, enable_unittests=False,
-            test_package_names=None, builder_type=None):
+            test_package_names=None, builder_type=None,
+            test_package_paths=None, rate_limiter=None, progress=None):
         """Returns info on a cached build, fetching it if necessary.
         Returns a dict with a boolean 'success' item.
         If 'success' is False, the dict also contains an 'error' item holding a
@@ -1183,15 +1937,102 @@ class BuildCache(object):
         If 'success' is True, the dict also contains a 'metadata' item, which is
         a json encoding of BuildMetadata.  The path to the build is the
         'dir' item, which is a directory containing fennec.apk,
-        symbols/, and, if enable_unittests is true, robocop.apk and tests/.
+        symbols.zip, and, if enable_unittests is true, robocop.apk and tests/.
+        The crash symbols are kept compressed in symbols.zip and are
+        extracted on demand into symbols/ when a crash is processed.
         If not found, fetches them, assuming a standard file structure.
+        If test_package_paths is a list of path prefixes, only the
+        members of the test packages beginning with one of them are
+        extracted into tests/. The test package zip files are kept so
+        that the members needed by later requests can be extracted
+        without downloading them again.
+        If rate_limiter is set, it is passed to utils.urlretrieve() to
+        limit the rate of the downloads. If progress is set, it is
+        called during the downloads with the name of the artifact,
+        the number of bytes received and the expected total or None.
         Cleans the cache before getting started.
         If self.override_build_dir is set, 'dir' is set to
         that value without verifying the contents nor fetching anything (though
         it will still try to open fennec.apk to read in the metadata).
         See BuildMetadata and BuildCache.build_metadata() for the other
         metadata items.
+        The dict also contains a 'timings' item listing the download and
+        extraction times of each artifact fetched. See
+        BuildCache._fetch_artifact().
         """
+        build_dir = self.build_dir(build_url)
+        with self.lock:
+            self.active_build_dirs[build_dir] = self.active_build_dirs.get(build_dir, 0) + 1
+        try:
+            return self._get(build_url, build_dir, force=force,
+                             enable_unittests=enable_unittests,
+                             test_package_names=test_package_names,
+                             builder_type=builder_type,
+                             test_package_paths=test_package_paths,
+                             rate_limiter=rate_limiter,
+                             progress=progress)
+        finally:
+            with self.lock:
+                self.active_build_dirs[build_dir] -= 1
+                if not self.active_build_dirs[build_dir]:
+                    del self.active_build_dirs[build_dir]
+
+    def build_dir(self, build_url):
+        """Return the name of the cache directory for build_url."""
+        # Create the cached build directory from the build_url by
+        # base64 encoding the url to the directory containing the
+        # build. This will ensure that if we have multiple apks for a
+        # given changeset, they will all share the same cached
+        # directory and downloaded auxiliary files such as the crash
+        # symbols, etc. Note that we will need to create a separate
+        # metadata json file for each apk type we are downloading.
+        return base64.b64encode(os.path.dirname(build_url))
+
+    def is_cached(self, build_url, force=False, enable_unittests=False,
+                  test_package_names=None, builder_type=None,
+                  test_package_paths=None):
+        """Return True if get() can return the build without
+        downloading any of its files. Extracting additional
+        test_package_paths from cached test packages does not require
+        a download."""
+        if self.override_build_dir:
+            return True
+        if force or not urlparse.urlparse(build_url).scheme.startswith('http'):
+            return False
+        cache_build_dir = os.path.join(self.cache_dir, self.build_dir(build_url))
+        fennec_build_path = os.path.join(cache_build_dir, 'fennec.apk')
+        if build_url.endswith('geckoview_example.apk'):
+            build_path = os.path.join(cache_build_dir, 'geckoview_example.apk')
+        else:
+            build_path = fennec_build_path
+        # The build must have been completely downloaded and its
+        # metadata indexed.
+        if not utils.get_recorded_digest(build_path):
+            return False
+        fennec_digest = utils.get_recorded_digest(fennec_build_path)
+        if not fennec_digest or not self.metadata_index.get(build_url,
+                                                            fennec_digest):
+            return False
+        paths = [os.path.join(cache_build_dir, 'symbols.zip')]
+        if enable_unittests:
+            test_packages_json_path = os.path.join(cache_build_dir,
+                                                   'test_packages.json')
+            if not test_package_names or not os.path.exists(test_packages_json_path):
+                return False
+            try:
+                test_packages = json.loads(file(test_packages_json_path).read())
+                for test_package_name in test_package_names:
+                    for test_package_file in test_packages[test_package_name]:
+                        paths.append(os.path.join(cache_build_dir,
+                                                  test_package_file))
+            except (IOError, ValueError, KeyError):
+                return False
+            paths.append(os.path.join(cache_build_dir, 'robocop.apk'))
+        return all([self.verify_download(path) for path in paths])
+
+    def _get(self, build_url, build_dir, force=False, enable_unittests=False,
+             test_package_names=None, builder_type=None,
+             test_package_paths=None, rate_limiter=None, progress=None):
         logger = utils.getLogger()
         is_geckoview_example = build_url.endswith('geckoview_example.apk')
         if self.override_build_dir:
@@ -1230,14 +2071,6 @@ class BuildCache(object):
         # If the build_url is for a local build, force the download since it may
         # have changed even though the build_url hasn't.
         force = force or not urlparse.urlparse(build_url).scheme.startswith('http')
-        # Create the cached build directory from the build_url by
-        # base64 encoding the url to the directory containing the
-        # build. This will ensure that if we have multiple apks for a
-        # given changeset, they will all share the same cached
-        # directory and downloaded auxiliary files such as the crash
-        # symbols, etc. Note that we will need to create a separate
-        # metadata json file for each apk type we are downloading.
-        build_dir = base64.b64encode(os.path.dirname(build_url))
         self.clean_cache([build_dir])
         cache_build_dir = os.path.join(self.cache_dir, build_dir)
         if is_geckoview_example:
@@ -1252,27 +2085,18 @@ class BuildCache(object):
         if not os.path.exists(cache_build_dir):
             os.makedirs(cache_build_dir)
 
+        # Collect the artifacts which need to be downloaded then
+        # fetch them concurrently. Each artifact is extracted by the
+        # thread which downloaded it so that extraction overlaps
+        # with the remaining downloads.
+        artifacts = []
+
         # build
-        try:
-            download_build = (force or not os.path.exists(build_path) or
-                              zipfile.ZipFile(build_path).testzip() is not None)
-        except (zipfile.BadZipfile, IOError), e:
-            logger.warning('%s checking build: %s. Forcing download.', e, build_url)
-            download_build = True
-        if download_build:
-            # retrieve to temporary file then move over, so we don't end
-            # up with half a file if it aborts
-            tmpf = tempfile.NamedTemporaryFile(delete=False)
-            tmpf.close()
-            try:
-                utils.urlretrieve(build_url, tmpf.name)
-            except:
-                os.unlink(tmpf.name)
-                err = 'IO Error retrieving build: %s.' % build_url
-                logger.exception(err)
-                return {'success': False, 'error': err}
-            shutil.move(tmpf.name, build_path)
-        file(os.path.join(cache_build_dir, 'lastused'), 'w')
+        if force or not self.verify_download(build_path):
+            artifacts.append({'name': 'build',
+                              'url': build_url,
+                              'path': build_path,
+                              'required': True})
 
         if is_geckoview_example:
             # Kludge to handle automatically downloading the
@@ -1281,45 +2105,25 @@ class BuildCache(object):
             # procname and version. If the geckoview_example.apk
             # contained the necessary data, we would not have to
             # download fennec here.
-            if force or not os.path.exists(fennec_build_path):
-                try:
-                    utils.urlretrieve(fennec_build_url, fennec_build_path)
-                except HTTPError, http_error:
-                    if 'Not Found' in str(http_error):
-                        logger.info('No %s found.', fennec_build_url)
-                    else:
-                        logger.exception('Error retrieving %s.', fennec_build_url)
-                except:
-                    logger.exception('Error retrieving %s.', fennec_build_url)
+            if force or not self.verify_download(fennec_build_path):
+                artifacts.append({'name': 'fennec',
+                                  'url': fennec_build_url,
+                                  'path': fennec_build_path,
+                                  'required': False})
 
         # symbols
+        # Keep the symbols compressed. Only the symbols for the modules
+        # referenced by a crash dump are extracted into the symbols
+        # directory. See AutophoneCrashProcessor._extract_symbols().
         symbols_path = os.path.join(cache_build_dir, 'symbols')
-        if force or not os.path.exists(symbols_path):
-            tmpf = tempfile.NamedTemporaryFile(delete=False)
-            tmpf.close()
+        symbols_zip_path = os.path.join(cache_build_dir, 'symbols.zip')
+        if force or not self.verify_download(symbols_zip_path):
             # XXX: assumes fixed fennec_build_url-> symbols_url mapping
             symbols_url = re.sub('.apk$', '.crashreporter-symbols.zip', fennec_build_url)
-            try:
-                utils.urlretrieve(symbols_url, tmpf.name)
-                symbols_zipfile = zipfile.ZipFile(tmpf.name)
-                symbols_zipfile.extractall(symbols_path)
-                symbols_zipfile.close()
-            except HTTPError, http_error:
-                if 'Not Found' in str(http_error):
-                    logger.info('No symbols found: %s.', symbols_url)
-                else:
-                    logger.exception('Error retrieving symbols: %s.', symbols_url)
-            except zipfile.BadZipfile:
-                logger.info('Ignoring zipfile.BadZipfile Error retrieving symbols: %s.',
-                            symbols_url)
-                try:
-                    with open(tmpf.name, 'r') as badzipfile:
-                        logger.debug(badzipfile.read())
-                except:
-                    pass
-            except:
-                logger.exception('Error retrieving symbols: %s.', symbols_url)
-            os.unlink(tmpf.name)
+            artifacts.append({'name': 'symbols',
+                              'url': symbols_url,
+                              'path': symbols_zip_path,
+                              'required': False})
 
         # tests
         if enable_unittests:
@@ -1331,20 +2135,23 @@ class BuildCache(object):
             # XXX: assumes fixed fennec_build_url-> robocop mapping
             robocop_url = urlparse.urljoin(fennec_build_url, 'robocop.apk')
             robocop_path = os.path.join(cache_build_dir, 'robocop.apk')
-            if force or not os.path.exists(robocop_path):
-                tmpf = tempfile.NamedTemporaryFile(delete=False)
-                tmpf.close()
-                try:
-                    utils.urlretrieve(robocop_url, tmpf.name)
-                except:
-                    os.unlink(tmpf.name)
-                    err = 'Error retrieving robocop.apk: %s.' % robocop_url
-                    logger.exception(err)
-                    return {'success': False, 'error': err}
-                shutil.move(tmpf.name, robocop_path)
+            if force or not self.verify_download(robocop_path):
+                artifacts.append({'name': 'robocop',
+                                  'url': robocop_url,
+                                  'path': robocop_path,
+                                  'required': True})
+            test_packages_json_path = os.path.join(cache_build_dir,
+                                                   'test_packages.json')
             test_packages_url = re.sub('.apk$', '.test_packages.json', fennec_build_url)
-            logger.info('downloading test package json %s', test_packages_url)
-            test_packages = utils.get_remote_json(test_packages_url)
+            test_packages = None
+            if not force and os.path.exists(test_packages_json_path):
+                try:
+                    test_packages = json.loads(file(test_packages_json_path).read())
+                except (IOError, ValueError):
+                    pass
+            if not test_packages:
+                logger.info('downloading test package json %s', test_packages_url)
+                test_packages = utils.get_remote_json(test_packages_url)
             if not test_packages:
                 logger.warning('test package json %s not found',
                                test_packages_url)
@@ -1378,42 +2185,134 @@ class BuildCache(object):
                     err = 'No test packages specified for build %s' % fennec_build_url
                     logger.exception(err)
                     return {'success': False, 'error': err}
-            for test_package_file in test_package_files:
+            # An empty prefix extracts every member.
+            needed_paths = sorted(set(test_package_paths or ['']))
+            extracted_json_path = os.path.join(cache_build_dir,
+                                               'test_packages_extracted.json')
+            extracted = {}
+            if not force and os.path.exists(extracted_json_path):
+                try:
+                    extracted = json.loads(file(extracted_json_path).read())
+                except (IOError, ValueError):
+                    pass
+            # The test packages share the tests directory. Extract
+            # them one at a time so that zipfile does not race
+            # creating the same subdirectories.
+            tests_lock = threading.Lock()
+            for test_package_file in sorted(test_package_files):
                 test_package_path = os.path.join(cache_build_dir,
                                                  test_package_file)
                 test_package_url = urlparse.urljoin(fennec_build_url, test_package_file)
-                if not force and os.path.exists(test_package_path):
-                    logger.info('skipping already downloaded '
-                                'test package %s', test_package_url)
-                    continue
-                logger.info('downloading test package %s', test_package_url)
-                tmpf = tempfile.NamedTemporaryFile(delete=False)
-                tmpf.close()
-                try:
-                    utils.urlretrieve(test_package_url, tmpf.name)
-                except:
-                    os.unlink(tmpf.name)
-                    err = 'IO Error retrieving tests: %s.' % test_package_url
-                    logger.exception(err)
-                    return {'success': False, 'error': err}
-                try:
-                    tests_zipfile = zipfile.ZipFile(tmpf.name)
-                    tests_zipfile.extractall(tests_path)
-                    tests_zipfile.close()
-                    # Move the test package zip file to the cache
-                    # build directory so we can check if it has been
-                    # downloaded.
-                    shutil.move(tmpf.name, test_package_path)
-                except zipfile.BadZipfile:
-                    err = 'Zip file error retrieving tests: %s.' % test_package_url
-                    logger.exception(err)
-                    return {'success': False, 'error': err}
-            if test_packages:
-                # Save the test_packages.json file
-                test_packages_json_path = os.path.join(cache_build_dir,
-                                                       'test_packages.json')
-                file(test_packages_json_path, 'w').write(
-                    json.dumps(test_packages))
+                artifact = {'name': test_package_file,
+                            'url': test_package_url,
+                            'path': test_package_path,
+                            'extract_path': tests_path,
+                            'extract_lock': tests_lock,
+                            'members': needed_paths,
+                            'extracted': [],
+                            'required': True}
+                if not force and self.verify_download(test_package_path):
+                    # Test packages downloaded before their extracted
+                    # paths were recorded were extracted completely.
+                    extracted_paths = extracted.get(
+                        test_package_file, {'paths': ['']})['paths']
+                    if _paths_cover(extracted_paths, needed_paths):
+                        logger.info('skipping already downloaded '
+                                    'test package %s', test_package_url)
+                        continue
+                    logger.info('extracting %s from already downloaded '
+                                'test package %s', needed_paths, test_package_url)
+                    artifact['url'] = None
+                    artifact['extracted'] = extracted_paths
+                else:
+                    logger.info('downloading test package %s', test_package_url)
+                    extracted.pop(test_package_file, None)
+                # Move the test package zip file to the cache build
+                # directory after extracting it so we can check if it
+                # has been downloaded.
+                artifacts.append(artifact)
+
+        for artifact in artifacts:
+            artifact['rate_limiter'] = rate_limiter
+            artifact['progress'] = progress
+        timings = self._fetch_artifacts(artifacts)
+        for artifact, timing in zip(artifacts, timings):
+            if artifact['name'] != 'symbols' or timing['error']:
+                continue
+            # Symbols extracted from a previous symbols.zip are stale.
+            shutil.rmtree(symbols_path, ignore_errors=True)
+            try:
+                symbols_zipfile = zipfile.ZipFile(symbols_zip_path)
+                uncompressed_size = sum(
+                    [info.file_size for info in symbols_zipfile.infolist()])
+                symbols_zipfile.close()
+                logger.info('BuildCache.get %s: symbols.zip %d bytes, '
+                            'saved %d bytes by not extracting it.',
+                            build_url, timing['size'],
+                            uncompressed_size - timing['size'])
+            except zipfile.BadZipfile:
+                timing['error'] = 'Zip file error retrieving symbols: %s.' % artifact['url']
+                logger.info('Ignoring zipfile.BadZipfile Error retrieving symbols: %s.',
+                            artifact['url'])
+                utils.remove_digest(symbols_zip_path)
+                os.unlink(symbols_zip_path)
+                if timing['digest']:
+                    self.blob_store.remove(timing['digest'])
+        # Record the bytes each fetched artifact occupies in the cache
+        # under the name of the file or directory holding it and mark
+        # the build as used.
+        artifact_sizes = {}
+        blobs = {}
+        for artifact, timing in zip(artifacts, timings):
+            if timing['error']:
+                continue
+            if timing['digest']:
+                blobs[os.path.basename(artifact['path'])] = (timing['digest'],
+                                                             timing['size'])
+            if 'members' in artifact:
+                # Record the paths extracted from each test package.
+                record = extracted.setdefault(artifact['name'],
+                                              {'paths': [], 'extracted_size': 0})
+                record['paths'] = _merge_paths(record['paths'], artifact['members'])
+                record['extracted_size'] += timing['extracted_size']
+                artifact_sizes[artifact['name']] = (
+                    timing['size'] + record['extracted_size'])
+            elif artifact['path']:
+                artifact_sizes[os.path.basename(artifact['path'])] = (
+                    timing['size'] + timing['extracted_size'])
+            else:
+                artifact_sizes[os.path.basename(artifact['extract_path'])] = (
+                    timing['extracted_size'])
+            if artifact['name'] == 'symbols':
+                # The symbols directory was removed above. Symbols
+                # extracted later are recorded by record_build_artifacts.
+                artifact_sizes['symbols'] = 0
+        for digest in self.index.update(build_dir, artifact_sizes, blobs):
+            self.blob_store.remove(digest)
+        if blobs:
+            logical, physical = self.index.stats()
+            logger.info('BuildCache: builds use %d bytes stored in %d bytes, '
+                        'dedupe ratio %.2f', logical, physical,
+                        float(logical) / physical if physical else 1.0)
+        self.clean_cache([build_dir])
+        if timings:
+            logger.info('BuildCache.get %s: %s', build_url, ', '.join(
+                ['%s %.1fs download%s %.1fs extract' % (
+                    timing['name'], timing['download'],
+                    ' from %s' % timing['peer'] if timing['peer'] else '',
+                    timing['extract'])
+                 for timing in timings]))
+        for artifact, timing in zip(artifacts, timings):
+            if artifact['required'] and timing['error']:
+                return {'success': False, 'error': timing['error'],
+                        'timings': timings}
+
+        if enable_unittests and test_packages:
+            # Save the test_packages.json file
+            file(test_packages_json_path, 'w').write(
+                json.dumps(test_packages))
+        if enable_unittests:
+            file(extracted_json_path, 'w').write(json.dumps(extracted))
 
         metadata = self.build_metadata(build_url, cache_build_dir, builder_type=builder_type)
         if metadata:
@@ -1423,42 +2322,310 @@ class BuildCache(object):
         return {
             'success': metadata is not None,
             'error': '' if metadata is not None else 'metadata is None',
-            'metadata': metadata_json
+            'metadata': metadata_json,
+            'timings': timings
         }
 
-    def clean_cache(self, preserve=[]):
-        def lastused_path(d):
-            return os.path.join(self.cache_dir, d, 'lastused')
+    def _fetch_artifacts(self, artifacts):
+        """Fetch the artifacts using at most self.fetch_threads
+        concurrent downloads. Returns the list of the timings of each
+        artifact in the same order as artifacts."""
+        if len(artifacts) < 2 or self.fetch_threads < 2:
+            return [self._fetch_artifact(artifact) for artifact in artifacts]
+        pool = ThreadPool(min(self.fetch_threads, len(artifacts)))
+        try:
+            return pool.map(self._fetch_artifact, artifacts)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _fetch_artifact(self, artifact):
+        """Download artifact['url'] and, if artifact has an
+        'extract_path', extract the downloaded zip file into it while
+        holding artifact['extract_lock']. If artifact['path'] is set,
+        the download is moved there and its digest recorded. If
+        artifact['url'] is None, the zip file already downloaded to
+        artifact['path'] is extracted.
+
+        If artifact has 'members', a list of path prefixes, only the
+        members beginning with one of the prefixes and none of the
+        prefixes in artifact['extracted'] are extracted.
+
+        Returns a dict containing the artifact's name, url, size and
+        extracted_size in bytes, the seconds spent downloading and
+        extracting it, the digest of the download if it was stored in
+        the BlobStore, the peer it was downloaded from or None if it
+        was downloaded from upstream and an error which is empty if the
+        artifact was fetched.
+        """
+        logger = utils.getLogger()
+        name = artifact['name']
+        url = artifact['url']
+        path = artifact['path']
+        extract_path = artifact.get('extract_path')
+        timing = {'name': name, 'url': url, 'size': 0, 'extracted_size': 0,
+                  'download': 0.0, 'extract': 0.0, 'error': '', 'digest': None,
+                  'peer': None}
+        # retrieve to temporary file then move over, so we don't end
+        # up with half a file if it aborts
+        tmpf = tempfile.NamedTemporaryFile(delete=False)
+        tmpf.close()
+        try:
+            if url:
+                start = time.time()
+                try:
+                    artifact_progress = None
+                    if artifact.get('progress'):
+                        artifact_progress = functools.partial(
+                            artifact['progress'], name)
+                    digest = None
+                    if self.peers and path:
+                        timing['peer'], digest = self._fetch_from_peers(
+                            path, tmpf.name,
+                            rate_limiter=artifact.get('rate_limiter'),
+                            progress=artifact_progress)
+                    if not digest:
+                        digest = utils.urlretrieve(
+                            url, tmpf.name,
+                            rate_limiter=artifact.get('rate_limiter'),
+                            progress=artifact_progress)
+                finally:
+                    timing['download'] = time.time() - start
+                zip_path = tmpf.name
+            else:
+                zip_path = path
+            timing['size'] = os.path.getsize(zip_path)
+            if extract_path:
+                start = time.time()
+                members = tuple(artifact.get('members', ['']))
+                extracted = tuple(artifact.get('extracted', []))
+                with artifact['extract_lock']:
+                    artifact_zipfile = zipfile.ZipFile(zip_path)
+                    infos = [info for info in artifact_zipfile.infolist()
+                             if info.filename.startswith(members) and
+                             not (extracted and info.filename.startswith(extracted))]
+                    artifact_zipfile.extractall(extract_path, infos)
+                    timing['extracted_size'] = sum(
+                        [info.file_size for info in infos])
+                    artifact_zipfile.close()
+                timing['extract'] = time.time() - start
+            if url and path:
+                utils.remove_digest(path)
+                shutil.move(tmpf.name, path)
+                if self.blob_store.link(path, digest):
+                    timing['digest'] = digest
+                # Record the digest after linking to the blob since
+                # the file may have been replaced by the blob.
+                utils.record_digest(path, digest)
+        except HTTPError, http_error:
+            timing['error'] = 'Error retrieving %s: %s.' % (name, url)
+            if not artifact['required'] and 'Not Found' in str(http_error):
+                logger.info('No %s found: %s.', name, url)
+            else:
+                logger.exception(timing['error'])
+        except zipfile.BadZipfile:
+            timing['error'] = 'Zip file error retrieving %s: %s.' % (name, url)
+            if artifact['required']:
+                logger.exception(timing['error'])
+            else:
+                logger.info('Ignoring zipfile.BadZipfile Error retrieving %s: %s.',
+                            name, url)
+        except Exception:
+            timing['error'] = 'IO Error retrieving %s: %s.' % (name, url)
+            logger.exception(timing['error'])
+        finally:
+            if os.path.exists(tmpf.name):
+                os.unlink(tmpf.name)
+        return timing
 
-        def keep_build(d):
-            if preserve and d in preserve:
-                # specifically keep this build
-                return True
-            if not os.path.exists(lastused_path(d)):
-                # probably not a build dir
-                return True
-            # Use local time now since os.stat returns times in localtime.
-            if ((datetime.datetime.now() -
-                 datetime.datetime.fromtimestamp(os.stat(lastused_path(d)).st_mtime) <=
-                 datetime.timedelta(days=self.build_cache_expires))):
-                # too new
-                return True
-            return False
+    def _fetch_from_peers(self, path, dest, rate_limiter=None, progress=None):
+        """Download the file cached at path by one of the peers to
+        dest. The download is only used if its digest matches the
+        digest recorded by the peer. Returns a tuple of the peer and
+        the digest or (None, None) if no peer has the file."""
+        logger = utils.getLogger()
+        relpath = urllib.quote(os.path.relpath(path, self.cache_dir), safe='')
+        for peer in self.peers:
+            peer_url = '%s/%s' % (peer, relpath)
+            try:
+                r = self.peer_session.get(peer_url + utils.DIGEST_SUFFIX,
+                                          timeout=self.PEER_TIMEOUT)
+                if r.status_code != 200:
+                    continue
+                expected_digest = r.json()['sha256']
+                digest = utils.urlretrieve(peer_url, dest, max_attempts=1,
+                                           rate_limiter=rate_limiter,
+                                           progress=progress)
+            except Exception, e:
+                logger.warning('BuildCache: peer %s: %s: %s', peer, relpath, e)
+                continue
+            if digest == expected_digest:
+                logger.debug('BuildCache: fetched %s from peer %s', path, peer)
+                return peer, digest
+            logger.warning('BuildCache: peer %s: %s: sha256 %s, expected %s',
+                           peer, relpath, digest, expected_digest)
+        return None, None
+
+    def verify_download(self, path):
+        """Return True if the file at path still has the size and
+        modification time recorded when it was completely downloaded.
+        Its contents are verified by scrub()."""
+        return utils.get_recorded_digest(path) is not None
+
+    def free_bytes(self):
+        """Return the number of bytes available on the file system
+        containing the cache."""
+        stat = os.statvfs(self.cache_dir)
+        return stat.f_bavail * stat.f_frsize
 
+    def clean_cache(self, preserve=[]):
+        """Expire the least recently used builds, other than those in
+        preserve or in use by another get(), while the cache holds more
+        than build_cache_max_bytes, the file system has fewer than
+        build_cache_min_free_bytes available or more than
+        build_cache_size builds have not been used for
+        build_cache_expires days."""
+        logger = utils.getLogger()
+        with self.lock:
+            entries = self.index.entries()
+            cache_bytes = self.index.stats()[1]
+            expire_time = time.time() - self.build_cache_expires*24*60*60
+            num_expired = len([entry for entry in entries
+                               if entry[2] < expire_time])
+            for build_dir, size, last_used in entries:
+                if build_dir in preserve or build_dir in self.active_build_dirs:
+                    continue
+                if cache_bytes > self.build_cache_max_bytes:
+                    reason = 'cache size %d bytes' % cache_bytes
+                elif self.free_bytes() < self.build_cache_min_free_bytes:
+                    reason = 'free space %d bytes' % self.free_bytes()
+                elif num_expired > self.build_cache_size:
+                    reason = '%d expired builds' % num_expired
+                else:
+                    break
+                logger.info('Expiring %s (%d bytes): %s', build_dir, size, reason)
+                shutil.rmtree(os.path.join(self.cache_dir, build_dir),
+                              ignore_errors=True)
+                self.metadata_index.remove(os.path.join(self.cache_dir, build_dir))
+                freed, orphans = self.index.remove(build_dir)
+                for digest in orphans:
+                    self.blob_store.remove(digest)
+                cache_bytes -= freed
+                if last_used < expire_time:
+                    num_expired -= 1
+
+    def scrub(self):
+        """Verify the contents of the downloaded files of the cached
+        builds against the sha256 digests recorded when they were
+        downloaded. Builds containing corrupt files are quarantined so
+        that they are downloaded again. Files sharing a blob are
+        verified once. The corrupt files of quarantined builds are
+        kept for build_cache_expires days. Returns the list of the
+        quarantined build directories."""
         logger = utils.getLogger()
-        builds = [(x, os.stat(lastused_path(x)).st_mtime) for x in
-                  os.listdir(self.cache_dir) if not keep_build(x)]
-        builds.sort(key=lambda x: x[1])
-        while len(builds) > self.build_cache_size:
-            b = builds.pop(0)[0]
-            logger.info('Expiring %s', b)
-            shutil.rmtree(os.path.join(self.cache_dir, b))
+        quarantine_dir = os.path.join(self.cache_dir, self.QUARANTINE_DIR)
+        expire_time = time.time() - self.build_cache_expires*24*60*60
+        if os.path.isdir(quarantine_dir):
+            for name in os.listdir(quarantine_dir):
+                path = os.path.join(quarantine_dir, name)
+                if os.stat(path).st_mtime < expire_time:
+                    shutil.rmtree(path, ignore_errors=True)
+        start = time.time()
+        # (st_dev, st_ino): True if the file's contents are intact
+        verified = {}
+        quarantined = []
+        for build_dir, size, last_used in self.index.entries():
+            build_path = os.path.join(self.cache_dir, build_dir)
+            try:
+                names = os.listdir(build_path)
+            except OSError:
+                continue
+            corrupt = []
+            for name in names:
+                if not name.endswith(utils.DIGEST_SUFFIX):
+                    continue
+                path = os.path.join(build_path, name[:-len(utils.DIGEST_SUFFIX)])
+                digest = utils.get_recorded_digest(path)
+                if not digest:
+                    # Changed files are downloaded again by get().
+                    continue
+                try:
+                    stat = os.stat(path)
+                    key = (stat.st_dev, stat.st_ino)
+                    if key not in verified:
+                        verified[key] = utils.file_digest(path) == digest
+                except (IOError, OSError):
+                    continue
+                if not verified[key]:
+                    logger.warning('BuildCache.scrub: %s is corrupt', path)
+                    corrupt.append((path, digest))
+            if corrupt and self._quarantine(build_dir, corrupt):
+                quarantined.append(build_dir)
+        logger.info('BuildCache.scrub: verified %d files in %.1f seconds, '
+                    'quarantined %d builds', len(verified), time.time() - start,
+                    len(quarantined))
+        return quarantined
+
+    def _quarantine(self, build_dir, corrupt):
+        """Copy the corrupt files, a list of (path, digest) tuples, of
+        build_dir to the quarantine directory and remove build_dir
+        unless it is in use or the corrupt files have been downloaded
+        again. Returns True if it was quarantined.
+
+        The files are copied rather than the build directory moved so
+        that the quarantine does not keep links to the blobs of the
+        build which can then be removed from the BlobStore."""
+        logger = utils.getLogger()
+        build_path = os.path.join(self.cache_dir, build_dir)
+        quarantine_path = os.path.join(self.cache_dir, self.QUARANTINE_DIR,
+                                       build_dir)
+        with self.lock:
+            if build_dir in self.active_build_dirs:
+                logger.warning('BuildCache.scrub: %s is in use', build_dir)
+                return False
+            if not [path for path, digest in corrupt
+                    if utils.get_recorded_digest(path) == digest]:
+                return False
+            for path, digest in corrupt:
+                # Do not let future downloads link to the corrupt blob.
+                blob_path = self.blob_store.blob_path(digest)
+                try:
+                    if os.path.samefile(path, blob_path):
+                        os.unlink(blob_path)
+                except OSError:
+                    pass
+            logger.warning('BuildCache.scrub: quarantining %s', build_dir)
+            shutil.rmtree(quarantine_path, ignore_errors=True)
+            os.makedirs(quarantine_path)
+            for path, digest in corrupt:
+                for quarantined_path in (path, path + utils.DIGEST_SUFFIX):
+                    try:
+                        shutil.copy2(quarantined_path, quarantine_path)
+                    except (IOError, OSError):
+                        logger.exception('BuildCache.scrub: copying %s',
+                                         quarantined_path)
+            # Mark when it was quarantined for expiration.
+            os.utime(quarantine_path, None)
+            self.metadata_index.remove(build_path)
+            freed, orphans = self.index.remove(build_dir)
+            # Remove the build's links to its blobs before the orphaned
+            # blobs so that BlobStore.remove sees their last link.
+            shutil.rmtree(build_path, ignore_errors=True)
+            for digest in orphans:
+                self.blob_store.remove(digest)
+        return True
 
     def build_metadata(self, build_url, build_dir, builder_type='taskcluster'):
-        # If the build is a local build, do not rely on any
-        # existing cached build.
+        """Return the BuildMetadata of build_url whose files are in
+        build_dir or None if its fennec.apk can not be read.
+
+        The metadata is returned from the metadata index if it has an
+        entry for build_url and the digest of the fennec.apk. Otherwise
+        the build data is obtained with utils.get_build_data(), the
+        package name and version are read from the apk and the result
+        is indexed.
+        """
         logger = utils.getLogger()
-        remote = urlparse.urlparse(build_url).scheme.startswith('http')
         app_name = None
         if build_url.endswith('geckoview_example.apk'):
             # Taskcluster only, Gradle only for now.
@@ -1466,37 +2633,36 @@ class BuildCache(object):
             # its apk file that fennec does. Use the parallel
             # fennec.apk to get the appropriate information for
             # geckoview_example.
-            build_metadata_path = os.path.join(build_dir, 'geckoview_example_metadata.json')
             app_name = 'org.mozilla.geckoview_example'
             fennec_apk_url = build_url.replace('geckoview_example.apk', 'target.apk')
         else:
-            build_metadata_path = os.path.join(build_dir, 'fennec_metadata.json')
             fennec_apk_url = build_url
-        if remote and os.path.exists(build_metadata_path):
-            try:
-                return BuildMetadata().from_json(
-                    json.loads(file(build_metadata_path).read()))
-            except (ValueError, IOError):
-                pass
+        fennec_apk_path = os.path.join(build_dir, 'fennec.apk')
+        try:
+            digest = self._apk_digest(fennec_apk_path)
+        except IOError:
+            logger.exception('Could not read %s; aborting job.', fennec_apk_path)
+            return None
+        entry = self.metadata_index.get(build_url, digest)
+        if entry:
+            return BuildMetadata().from_json(entry[0])
         build_data = utils.get_build_data(fennec_apk_url, builder_type=builder_type)
         if not build_data:
             raise BuildCacheException('Could not get build_data for %s', build_url)
-        tmpdir = tempfile.mkdtemp()
         try:
-            fennec_apk_path = os.path.join(build_dir, 'fennec.apk')
             apkfile = zipfile.ZipFile(fennec_apk_path)
-            apkfile.extract('application.ini', tmpdir)
-            apkfile.extract('package-name.txt', tmpdir)
-        except zipfile.BadZipfile:
+            try:
+                procname = apkfile.read('package-name.txt').strip()
+                application_ini = apkfile.read('application.ini')
+            finally:
+                apkfile.close()
+        except (zipfile.BadZipfile, KeyError):
             # we should have already tried to redownload bad zips, so treat
             # this as fatal.
             logger.exception('%s is a bad apk; aborting job.', fennec_apk_path)
-            shutil.rmtree(tmpdir)
             return None
-        with open(os.path.join(tmpdir, 'package-name.txt')) as package_file:
-            procname = package_file.read().strip()
         cfg = ConfigParser.RawConfigParser()
-        cfg.read(os.path.join(tmpdir, 'application.ini'))
+        cfg.readfp(StringIO(application_ini))
         ver = cfg.get('App', 'Version')
         if not app_name:
             app_name = procname
@@ -1517,11 +2683,46 @@ class BuildCache(object):
                                  nightly=build_data['nightly'],
                                  platform=build_data['platform'],
                                  builder_type=builder_type)
-        shutil.rmtree(tmpdir)
-        if metadata:
-            file(build_metadata_path, 'w').write(json.dumps(metadata.to_json()))
+        self.metadata_index.put(build_url, digest, build_dir,
+                                metadata.to_json(), build_data)
         return metadata
 
+    def _apk_digest(self, path):
+        """Return the sha256 digest of the apk at path, using the
+        digest recorded when it was downloaded if possible."""
+        return utils.get_recorded_digest(path) or utils.file_digest(path)
+
+
+class BuildCacheScrubber(object):
+    """Run BuildCache.scrub() every interval seconds in a background
+    thread."""
+
+    def __init__(self, build_cache, interval=BuildCache.SCRUB_INTERVAL):
+        self.build_cache = build_cache
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run,
+                                       name='BuildCacheScrubber')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        logger = utils.getLogger()
+        while not self.stopped.wait(self.interval):
+            try:
+                self.build_cache.scrub()
+            except Exception:
+                logger.exception('BuildCacheScrubber')
+
 
 class BuildMetadata(object):
     def __init__(self,
@@ -1558,7 +2759,11 @@ class BuildMetadata(object):
             self.symbols = None
         else:
             self.dir = os.path.abspath(directory)
-            self.symbols = os.path.join(self.dir, 'symbols')
+            # Cached builds keep their symbols in symbols.zip while
+            # override build directories may contain extracted symbols.
+            self.symbols = os.path.join(self.dir, 'symbols.zip')
+            if not os.path.exists(self.symbols):
+                self.symbols = os.path.join(self.dir, 'symbols')
             if not os.path.exists(self.symbols):
                 self.symbols = None
         self.tree = tree
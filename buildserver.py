@@ -2,122 +2,609 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import BaseHTTPServer
+import Queue
 import SocketServer
 import errno
+import functools
 import json
+import os
+import shutil
 import socket
 import threading
+import time
+import urllib
 import urlparse
 
+import utils
+
 DEFAULT_PORT = 28008
+PROTOCOL_VERSION = 2
 
 class BuildCacheServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Serve BuildCache.get() requests from the workers.
+
+    Requests for builds sharing a build cache directory are served
+    one at a time so that concurrent requests for a build wait for a
+    single download. Requests for builds which are not cached yet
+    download concurrently up to max_downloads at a time while
+    requests for cached builds are answered without waiting for a
+    download.
+
+    Prefetch requests share a download rate of prefetch_rate bytes
+    per second, 0 meaning unlimited. A prefetch in progress is no
+    longer rate limited once a worker requests the same build.
+    """
+
+    MAX_DOWNLOADS = 4
+    PREFETCH_RATE = 10*1024*1024
 
     build_cache = None
-    cache_lock = threading.Lock()
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 max_downloads=MAX_DOWNLOADS, prefetch_rate=PREFETCH_RATE):
+        SocketServer.TCPServer.__init__(self, server_address,
+                                        RequestHandlerClass)
+        self.lock = threading.Lock()
+        # build_dir: [lock, number of requests using lock]
+        self.build_locks = {}
+        self.download_slots = threading.BoundedSemaphore(max_downloads)
+        if prefetch_rate:
+            self.prefetch_limiter = utils.RateLimiter(prefetch_rate)
+        else:
+            self.prefetch_limiter = None
+        # build_dir: number of worker requests for the build
+        self.worker_requests = {}
+        # build_dir: progress callbacks of the requests for the build
+        self.progress_listeners = {}
+        self.counters = {'requests': 0, 'prefetches': 0, 'hits': 0,
+                         'downloads': 0}
+        self.downloading = 0
+
+    def _acquire_build(self, build_dir):
+        with self.lock:
+            build_lock = self.build_locks.setdefault(build_dir,
+                                                     [threading.Lock(), 0])
+            build_lock[1] += 1
+        build_lock[0].acquire()
+
+    def _release_build(self, build_dir):
+        with self.lock:
+            build_lock = self.build_locks[build_dir]
+            build_lock[0].release()
+            build_lock[1] -= 1
+            if not build_lock[1]:
+                del self.build_locks[build_dir]
+
+    def get(self, build_url, prefetch=False, progress=None, **kwargs):
+        """Return the result of BuildCache.get() for build_url. If
+        progress is set, it is called with the progress of the
+        downloads of the build made by this or any concurrent request
+        for the build."""
+        build_dir = self.build_cache.build_dir(build_url)
+        rate_limiter = None
+        if prefetch:
+            if self.prefetch_limiter:
+                rate_limiter = _PrefetchThrottle(self, build_dir)
+        with self.lock:
+            self.counters['prefetches' if prefetch else 'requests'] += 1
+            if not prefetch:
+                self.worker_requests[build_dir] = (
+                    self.worker_requests.get(build_dir, 0) + 1)
+            if progress:
+                self.progress_listeners.setdefault(build_dir, []).append(progress)
+        self._acquire_build(build_dir)
+        try:
+            if self.build_cache.is_cached(build_url, **kwargs):
+                with self.lock:
+                    self.counters['hits'] += 1
+                return self.build_cache.get(build_url, **kwargs)
+            with self.download_slots:
+                with self.lock:
+                    self.counters['downloads'] += 1
+                    self.downloading += 1
+                try:
+                    return self.build_cache.get(
+                        build_url,
+                        rate_limiter=rate_limiter,
+                        progress=functools.partial(self._progress, build_dir),
+                        **kwargs)
+                finally:
+                    with self.lock:
+                        self.downloading -= 1
+        finally:
+            self._release_build(build_dir)
+            with self.lock:
+                if not prefetch:
+                    self.worker_requests[build_dir] -= 1
+                    if not self.worker_requests[build_dir]:
+                        del self.worker_requests[build_dir]
+                if progress:
+                    listeners = self.progress_listeners[build_dir]
+                    listeners.remove(progress)
+                    if not listeners:
+                        del self.progress_listeners[build_dir]
+
+    def _progress(self, build_dir, artifact, received, total):
+        with self.lock:
+            listeners = list(self.progress_listeners.get(build_dir, []))
+        for listener in listeners:
+            listener(artifact, received, total)
+
+    def stats(self):
+        """Return a dict of the request counters, the current activity
+        and the size of the build cache."""
+        logical, physical = self.build_cache.index.stats()
+        with self.lock:
+            stats = dict(self.counters)
+            stats['downloading'] = self.downloading
+            stats['waiting_builds'] = len(self.worker_requests)
+        stats['builds'] = len(self.build_cache.index.entries())
+        stats['logical_bytes'] = logical
+        stats['physical_bytes'] = physical
+        return stats
+
+    def is_requested(self, build_dir):
+        """Return True if a worker is waiting for or getting the build
+        in build_dir."""
+        with self.lock:
+            return build_dir in self.worker_requests
+
+
+class _PrefetchThrottle(object):
+    """Rate limit the downloads of a prefetch of the build in
+    build_dir using the server's shared prefetch limiter unless a
+    worker is waiting for the build."""
+
+    def __init__(self, server, build_dir):
+        self.server = server
+        self.build_dir = build_dir
+
+    def consume(self, nbytes):
+        if not self.server.is_requested(self.build_dir):
+            self.server.prefetch_limiter.consume(nbytes)
 
 
 class BuildCacheHandler(SocketServer.BaseRequestHandler):
+    """Serve the requests received on a build cache client connection.
+
+    Version 1 requests are lines of space separated tokens: the build
+    url optionally followed by force, prefetch, enable_unittests,
+    builder_type_buildbot, builder_type_taskcluster,
+    test_package_path=<path> and test_packages followed by the names
+    of the test packages. Each is answered by a line containing the
+    JSON result of BuildCache.get() before the next line is read.
+
+    Version 2 requests are lines containing a JSON object with the
+    items version, id, verb and the arguments of the verb. The verbs
+    are get and prefetch, whose arguments are build_url and the
+    keyword arguments of BuildCache.get(), and stats. The requests
+    on a connection are served concurrently. Each is answered by
+    JSON lines events containing its id: progress events holding the
+    artifact, bytes and total of a download at most every
+    PROGRESS_INTERVAL seconds, waiting events when no other event has
+    been sent for KEEPALIVE seconds and a final result event holding
+    the result.
+    """
+
+    PROGRESS_INTERVAL = 10
+    KEEPALIVE = 30
+
+    def setup(self):
+        self.send_lock = threading.Lock()
+        self.threads = []
 
     def handle(self):
-        buff = ''
-        while True:
-            try:
-                data = self.request.recv(1024)
-            except socket.error, e:
-                if e.errno == errno.ECONNRESET:
+        rfile = self.request.makefile('rb')
+        try:
+            while True:
+                try:
+                    line = rfile.readline()
+                except socket.error, e:
+                    if e.errno == errno.ECONNRESET:
+                        return
+                    raise e
+                if not line:
                     return
-                raise e
-            if not data:
-                return
-            buff += data
-            while buff:
-                line, nl, rest = buff.partition('\n')
-                if not nl:
-                    break
-                buff = rest
                 line = line.strip()
                 if not line:
                     continue
                 if line == 'quit' or line == 'exit':
                     return
-                cmds = line.split()
-                build = cmds[0]
-                force = False
-                enable_unittests = False
-                builder_type = None
-                test_package_names = set()
-                collecting_test_packages = False
-                cmds = cmds[1:]
-                for cmd in cmds:
-                    if collecting_test_packages:
-                        test_package_names.add(cmd)
-                    elif cmd.lower() == 'force':
-                        force = True
-                    elif cmd.lower() == 'enable_unittests':
-                        enable_unittests = True
-                    elif cmd.lower() == 'builder_type_buildbot':
-                        builder_type = 'buildbot'
-                    elif cmd.lower() == 'builder_type_taskcluster':
-                        builder_type = 'taskcluster'
-                    elif cmd.lower() == 'test_packages':
-                        collecting_test_packages = True
-                self.server.cache_lock.acquire()
-                try:
-                    results = self.server.build_cache.get(
-                        build,
-                        force=force,
-                        enable_unittests=enable_unittests,
-                        test_package_names=test_package_names,
-                        builder_type=builder_type)
-                except Exception, e:
-                    results = {
-                        'success': False,
-                        'error': 'Exception: %s' % e,
-                        'metadata': ''
-                    }
-                finally:
-                    self.server.cache_lock.release()
-                self.request.send(json.dumps(results) + '\n')
+                if line.startswith('{'):
+                    self.handle_v2(line)
+                else:
+                    self.handle_v1(line)
+        finally:
+            rfile.close()
+            for thread in self.threads:
+                thread.join()
+
+    def send(self, message):
+        """Send message as a JSON line. Returns False if the client
+        has gone away."""
+        try:
+            with self.send_lock:
+                self.request.sendall(json.dumps(message) + '\n')
+            return True
+        except socket.error:
+            return False
+
+    def get(self, build_url, **kwargs):
+        try:
+            return self.server.get(build_url, **kwargs)
+        except Exception, e:
+            return {
+                'success': False,
+                'error': 'Exception: %s' % e,
+                'metadata': ''
+            }
+
+    def handle_v1(self, line):
+        cmds = line.split()
+        build = cmds[0]
+        force = False
+        prefetch = False
+        enable_unittests = False
+        builder_type = None
+        test_package_names = set()
+        test_package_paths = None
+        collecting_test_packages = False
+        cmds = cmds[1:]
+        for cmd in cmds:
+            if cmd.startswith('test_package_path='):
+                if test_package_paths is None:
+                    test_package_paths = []
+                test_package_paths.append(cmd[len('test_package_path='):])
+            elif collecting_test_packages:
+                test_package_names.add(cmd)
+            elif cmd.lower() == 'force':
+                force = True
+            elif cmd.lower() == 'prefetch':
+                prefetch = True
+            elif cmd.lower() == 'enable_unittests':
+                enable_unittests = True
+            elif cmd.lower() == 'builder_type_buildbot':
+                builder_type = 'buildbot'
+            elif cmd.lower() == 'builder_type_taskcluster':
+                builder_type = 'taskcluster'
+            elif cmd.lower() == 'test_packages':
+                collecting_test_packages = True
+        self.send(self.get(build,
+                           prefetch=prefetch,
+                           force=force,
+                           enable_unittests=enable_unittests,
+                           test_package_names=test_package_names,
+                           builder_type=builder_type,
+                           test_package_paths=test_package_paths))
+
+    def handle_v2(self, line):
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('not an object')
+        except ValueError, e:
+            self.send({'id': None, 'event': 'result',
+                       'result': {'success': False,
+                                  'error': 'Invalid request: %s' % e}})
+            return
+        thread = threading.Thread(target=self.serve_v2, args=(request,),
+                                  name='BuildCacheRequest-%s' % request.get('id'))
+        thread.daemon = True
+        thread.start()
+        self.threads = [t for t in self.threads if t.is_alive()]
+        self.threads.append(thread)
+
+    def serve_v2(self, request):
+        request_id = request.get('id')
+        verb = request.get('verb')
+        if request.get('version') != PROTOCOL_VERSION:
+            result = {'success': False,
+                      'error': 'Unsupported protocol version %s' %
+                      request.get('version')}
+        elif verb == 'stats':
+            result = {'success': True, 'stats': self.server.stats()}
+        elif verb in ('get', 'prefetch'):
+            result = self.serve_get(request_id, request, verb == 'prefetch')
+        else:
+            result = {'success': False, 'error': 'Unknown verb %s' % verb}
+        self.send({'id': request_id, 'event': 'result', 'result': result})
+
+    def serve_get(self, request_id, request, prefetch):
+        last_event = [time.time()]
+        done = threading.Event()
+
+        def progress(artifact, received, total):
+            now = time.time()
+            if (received != total and
+                now - last_event[0] < self.PROGRESS_INTERVAL):
+                return
+            last_event[0] = now
+            self.send({'id': request_id, 'event': 'progress',
+                       'artifact': artifact, 'bytes': received,
+                       'total': total})
+
+        def keepalive():
+            while not done.wait(self.KEEPALIVE):
+                if time.time() - last_event[0] >= self.KEEPALIVE:
+                    last_event[0] = time.time()
+                    if not self.send({'id': request_id, 'event': 'waiting'}):
+                        return
+
+        keepalive_thread = threading.Thread(target=keepalive)
+        keepalive_thread.daemon = True
+        keepalive_thread.start()
+        try:
+            return self.get(
+                request.get('build_url'),
+                prefetch=prefetch,
+                progress=progress,
+                force=request.get('force', False),
+                enable_unittests=request.get('enable_unittests', False),
+                test_package_names=set(request.get('test_package_names') or []),
+                builder_type=request.get('builder_type'),
+                test_package_paths=request.get('test_package_paths'))
+        finally:
+            done.set()
+            keepalive_thread.join()
 
 
 class BuildCacheClient(object):
+    """Client of BuildCacheServer using version 2 of the protocol.
+
+    Several requests may be submitted before receiving their results.
+    Waiting for an event from the server times out after timeout
+    seconds.
+    """
+
+    TIMEOUT = 300
 
-    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT):
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, timeout=TIMEOUT):
         self.host = host
         self.port = port
+        self.timeout = timeout
         self.sock = None
+        self.rfile = None
+        self.request_id = 0
+        # request id: result received while waiting for another request
+        self.results = {}
 
     def connect(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((self.host, self.port))
+        self.sock = socket.create_connection((self.host, self.port),
+                                             self.timeout)
+        self.rfile = self.sock.makefile('rb')
 
     def close(self):
-        self.sock.close()
-        self.sock = None
+        if self.sock:
+            self.rfile.close()
+            self.sock.close()
+            self.rfile = None
+            self.sock = None
 
-    def get(self, url, force=False, enable_unittests=False,
-            test_package_names=None, builder_type=None):
+    def submit(self, verb, **kwargs):
+        """Send a request and return its id."""
         if not self.sock:
             self.connect()
-        line = url
+        self.request_id += 1
+        request = dict(kwargs, version=PROTOCOL_VERSION, id=self.request_id,
+                       verb=verb)
+        self.sock.sendall(json.dumps(request) + '\n')
+        return self.request_id
+
+    def receive(self, request_id, progress=None):
+        """Return the result of the request request_id. progress is
+        called with each progress and waiting event of the request
+        received in the meantime."""
+        logger = utils.getLogger()
+        while request_id not in self.results:
+            try:
+                line = self.rfile.readline()
+            except socket.timeout:
+                line = None
+                error = 'timed out waiting for the build server'
+            else:
+                error = 'build server hung up'
+            if not line:
+                logger.warning('BuildCacheClient: %s', error)
+                self.close()
+                return {'success': False, 'error': error, 'metadata': ''}
+            event = json.loads(line)
+            if event['event'] == 'result':
+                self.results[event['id']] = event['result']
+            elif event['id'] == request_id and progress:
+                progress(event)
+        return self.results.pop(request_id)
+
+    def get(self, url, force=False, enable_unittests=False,
+            test_package_names=None, builder_type=None,
+            test_package_paths=None, prefetch=False, progress=None):
         force = force or not urlparse.urlparse(url).scheme.startswith('http')
-        if force:
-            line += ' force'
-        if enable_unittests:
-            line += ' enable_unittests'
-        if builder_type:
-            line += ' builder_type_' + builder_type
-        if test_package_names:
-            line += ' test_packages'
-            for test_package in test_package_names:
-                line += ' ' + test_package
-        self.sock.sendall(line + '\n')
-        buf = ''
-        while not '\n' in buf:
-            data = self.sock.recv(1024)
-            if not data:
-                print 'build server hung up!'
-                return None
-            buf += data
-        return json.loads(buf)
+        if test_package_paths is not None:
+            test_package_paths = sorted(test_package_paths)
+        request_id = self.submit(
+            'prefetch' if prefetch else 'get',
+            build_url=url,
+            force=force,
+            enable_unittests=enable_unittests,
+            test_package_names=sorted(test_package_names or []),
+            builder_type=builder_type,
+            test_package_paths=test_package_paths)
+        return self.receive(request_id, progress=progress)
+
+    def stats(self):
+        return self.receive(self.submit('stats'))
+
+
+class BuildCachePeerServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    """Serve the completely downloaded files in the build cache
+    directory cache_dir to the BuildCaches of other hosts.
+
+    A file is requested using its path relative to cache_dir quoted
+    as a single path component. The JSON record of the file's sha256
+    digest and size is served at the file's url followed by
+    utils.DIGEST_SUFFIX.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, cache_dir):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address,
+                                           BuildCachePeerHandler)
+        self.cache_dir = os.path.realpath(cache_dir)
+
+
+class BuildCachePeerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        utils.getLogger().debug('BuildCachePeerHandler: %s: %s',
+                                self.client_address[0], format % args)
+
+    def send_not_found(self):
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        relpath = urllib.unquote(self.path.lstrip('/'))
+        record_requested = relpath.endswith(utils.DIGEST_SUFFIX)
+        if record_requested:
+            relpath = relpath[:-len(utils.DIGEST_SUFFIX)]
+        path = os.path.realpath(os.path.join(self.server.cache_dir, relpath))
+        if not path.startswith(self.server.cache_dir + os.sep):
+            self.send_not_found()
+            return
+        digest = utils.get_recorded_digest(path)
+        if not digest:
+            self.send_not_found()
+            return
+        try:
+            cached_file = open(path, 'rb')
+        except IOError:
+            self.send_not_found()
+            return
+        with cached_file:
+            size = os.fstat(cached_file.fileno()).st_size
+            if record_requested:
+                body = json.dumps({'sha256': digest, 'size': size})
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            shutil.copyfileobj(cached_file, self.wfile)
+
+
+class BuildPrefetcher(object):
+    """Download builds into the build cache ahead of the workers.
+
+    Builds are scheduled with their expected position in the job
+    queues and are fetched through the build cache server by
+    num_threads threads in order of increasing position. Scheduling
+    a build which is already pending merges the requested test
+    packages and keeps the lower position.
+    """
+
+    PREFETCH_THREADS = 2
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT,
+                 num_threads=PREFETCH_THREADS):
+        self.host = host
+        self.port = port
+        self.num_threads = num_threads
+        self.lock = threading.Lock()
+        self.queue = Queue.PriorityQueue()
+        # build_url: dict of the position, sequence number and get()
+        # arguments of the most recent queue entry for the build.
+        self.pending = {}
+        self.seq = 0
+        self.threads = []
+
+    def start(self):
+        for i in range(self.num_threads):
+            thread = threading.Thread(target=self._run,
+                                      name='BuildPrefetcher-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for thread in self.threads:
+            self.queue.put((-1, -1, None))
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def schedule(self, build_url, position, enable_unittests=False,
+                 test_package_names=None, test_package_paths=None,
+                 builder_type=None):
+        """Schedule the prefetch of build_url which is expected to be
+        fetched by a worker after position other jobs. A
+        test_package_paths of None extracts the test packages
+        completely."""
+        logger = utils.getLogger()
+        with self.lock:
+            self.seq += 1
+            request = self.pending.get(build_url)
+            if request:
+                position = min(position, request['position'])
+                enable_unittests = (enable_unittests or
+                                    request['enable_unittests'])
+                test_package_names = (set(test_package_names or []) |
+                                      request['test_package_names'])
+                if (test_package_paths is None or
+                    request['test_package_paths'] is None):
+                    test_package_paths = None
+                else:
+                    test_package_paths = (set(test_package_paths) |
+                                          request['test_package_paths'])
+            elif test_package_paths is not None:
+                test_package_paths = set(test_package_paths)
+            self.pending[build_url] = {
+                'position': position,
+                'seq': self.seq,
+                'enable_unittests': enable_unittests,
+                'test_package_names': set(test_package_names or []),
+                'test_package_paths': test_package_paths,
+                'builder_type': builder_type,
+            }
+            self.queue.put((position, self.seq, build_url))
+        logger.debug('BuildPrefetcher.schedule: %s position %s',
+                     build_url, position)
+
+    def _run(self):
+        logger = utils.getLogger()
+        while True:
+            position, seq, build_url = self.queue.get()
+            if build_url is None:
+                return
+            with self.lock:
+                request = self.pending.get(build_url)
+                if not request or request['seq'] != seq:
+                    # Superseded by a later schedule() of the build.
+                    continue
+                del self.pending[build_url]
+            client = BuildCacheClient(host=self.host, port=self.port)
+            try:
+                response = client.get(
+                    build_url,
+                    enable_unittests=request['enable_unittests'],
+                    test_package_names=request['test_package_names'],
+                    builder_type=request['builder_type'],
+                    test_package_paths=request['test_package_paths'],
+                    prefetch=True)
+                if response and not response['success']:
+                    logger.warning('BuildPrefetcher: %s: %s',
+                                   build_url, response['error'])
+                else:
+                    logger.debug('BuildPrefetcher: prefetched %s',
+                                 build_url)
+            except Exception:
+                logger.exception('BuildPrefetcher: %s', build_url)
+            finally:
+                client.close()
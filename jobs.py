@@ -408,44 +408,119 @@ class Jobs(object):
         self._commit_connection(conn)
         self._close_connection(conn)
 
-    def get_next_treeherder_job(self):
-        logger = utils.getLogger()
+    def get_treeherder_queues(self):
+        """Return a list of (project, submissions, newest_id) tuples of
+        the projects with queued treeherder submissions ordered by
+        their oldest submission, where submissions is the number of
+        queued submissions for the project and newest_id is the id of
+        the most recently queued one."""
         conn = self._conn()
-
-        job_cursor = self._execute_sql(
+        project_cursor = self._execute_sql(
             conn,
-            'select id,attempts,last_attempt,machine,project,job_collection from treeherder')
+            'select project, count(*), max(id), min(id) as first '
+            'from treeherder group by project order by first')
+        queues = [tuple(project_row[:3]) for project_row in project_cursor]
+        project_cursor.close()
+        self._close_connection(conn)
+        return queues
+
+    def get_next_treeherder_jobs(self, max_jobs, max_bytes, project=None,
+                                 exclude_ids=(), isolate_ids=()):
+        """Return a list of the oldest queued treeherder submissions
+        which can be posted to Treeherder in a single request.
+
+        The submissions all belong to project, or if project is None,
+        to the project of the oldest submission and are returned in
+        the order they were queued. No two submissions in the list
+        contain the same job_guid so that the pending, running and
+        completed states of a job are posted in separate requests and
+        in order. The list is limited to max_jobs Treeherder jobs and
+        max_bytes of job collection json but always contains the
+        oldest eligible submission.
+
+        Submissions whose ids are in exclude_ids are skipped along
+        with any later submissions for the same job_guids so that the
+        states of a job are still posted in order. A submission whose
+        id is in isolate_ids is only returned on its own.
+        """
+        logger = utils.getLogger()
+        conn = self._conn()
 
-        job_row = job_cursor.fetchone()
+        if project:
+            job_cursor = self._execute_sql(
+                conn,
+                'select id,attempts,last_attempt,machine,project,job_collection '
+                'from treeherder where project=? order by id',
+                values=(project,))
+        else:
+            job_cursor = self._execute_sql(
+                conn,
+                'select id,attempts,last_attempt,machine,project,job_collection '
+                'from treeherder order by id')
+
+        jobs = []
+        job_guids = set()
+        excluded_guids = set()
+        num_jobs = 0
+        num_bytes = 0
+        for job_row in job_cursor:
+            if jobs and job_row[4] != jobs[0]['project']:
+                continue
+            job_collection = json.loads(job_row[5])
+            row_guids = set([data['job']['job_guid'] for data in job_collection])
+            if job_row[0] in exclude_ids or row_guids & excluded_guids:
+                excluded_guids.update(row_guids)
+                continue
+            if jobs and (job_row[0] in isolate_ids or
+                         row_guids & job_guids or
+                         num_jobs + len(job_collection) > max_jobs or
+                         num_bytes + len(job_row[5]) > max_bytes):
+                break
+            jobs.append({'id': job_row[0],
+                         'attempts': job_row[1],
+                         'last_attempt': job_row[2],
+                         'machine': job_row[3],
+                         'project': job_row[4],
+                         'job_collection': job_collection})
+            job_guids.update(row_guids)
+            num_jobs += len(job_collection)
+            num_bytes += len(job_row[5])
+            if job_row[0] in isolate_ids:
+                break
         job_cursor.close()
-        if not job_row:
-            self._close_connection(conn)
-            return None
+        self._close_connection(conn)
 
-        job = {'id': job_row[0],
-               'attempts': job_row[1],
-               'last_attempt': job_row[2],
-               'machine': job_row[3],
-               'project': job_row[4],
-               'job_collection': json.loads(job_row[5])}
-        job['attempts'] += 1
-        job['last_attempt'] = datetime.datetime.utcnow().isoformat()
-        self._execute_sql(
-            conn,
-            'update treeherder set attempts=?, last_attempt=? where id=?',
-            values=(job['attempts'], job['last_attempt'],
-                    job['id']))
+        logger.debug('jobs.get_next_treeherder_jobs: %s',
+                     [job['id'] for job in jobs])
+        return jobs
 
-        logger.debug('jobs.get_next_treeherder_job: %s', job)
+    def treeherder_jobs_attempted(self, jobs):
+        """Increment the attempts and update the last_attempt of each
+        of the treeherder submissions in jobs."""
+        logger = utils.getLogger()
+        logger.debug('jobs.treeherder_jobs_attempted: %s',
+                     [job['id'] for job in jobs])
+        last_attempt = datetime.datetime.utcnow().isoformat()
+        conn = self._conn()
+        for job in jobs:
+            job['attempts'] += 1
+            job['last_attempt'] = last_attempt
+            self._execute_sql(
+                conn,
+                'update treeherder set attempts=?, last_attempt=? where id=?',
+                values=(job['attempts'], job['last_attempt'],
+                        job['id']))
         self._commit_connection(conn)
         self._close_connection(conn)
-        return job
 
-    def treeherder_job_completed(self, th_id):
+    def treeherder_jobs_completed(self, jobs):
         logger = utils.getLogger()
-        logger.debug('jobs.treeherder_job_completed: %s', th_id)
+        logger.debug('jobs.treeherder_jobs_completed: %s',
+                     [job['id'] for job in jobs])
         conn = self._conn()
-        self._execute_sql(conn, 'delete from treeherder where id=?', values=(th_id,))
+        for job in jobs:
+            self._execute_sql(conn, 'delete from treeherder where id=?',
+                              values=(job['id'],))
         self._commit_connection(conn)
         self._close_connection(conn)
 
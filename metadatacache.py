@@ -0,0 +1,181 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import json
+import sqlite3
+import threading
+import time
+
+import taskcluster
+from thclient import TreeherderClient
+
+import utils
+
+
+class MetadataKind(object):
+    TASK_DEFINITION = 'task_definition'
+    TASK_STATUS = 'task_status'
+    ARTIFACTS = 'artifacts'
+    TREEHERDER_JOB = 'treeherder_job'
+
+
+class MetadataCache(object):
+    """Two level cache of Taskcluster and Treeherder metadata.
+
+    Values are kept in an in-process LRU of at most MAX_ENTRIES
+    entries backed by a SQLite database shared by the Autophone
+    processes. Each kind of metadata expires after its own TTL in
+    seconds: task definitions and the artifacts of completed runs are
+    immutable while the status of a task changes as its runs
+    progress.
+
+    Since the cache is only an optimization, database errors are
+    logged and treated as misses.
+    """
+
+    MAX_ENTRIES = 1000
+    TTLS = {
+        MetadataKind.TASK_DEFINITION: 7*24*60*60,
+        MetadataKind.TASK_STATUS: 60,
+        MetadataKind.ARTIFACTS: 24*60*60,
+        MetadataKind.TREEHERDER_JOB: 24*60*60,
+    }
+
+    def __init__(self, filename='metadata.sqlite', max_entries=MAX_ENTRIES,
+                 ttls=TTLS):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.ttls = ttls
+        self.lock = threading.Lock()
+        self.lru = collections.OrderedDict()
+        self.stats = {}
+        for kind in self.ttls:
+            self.stats[kind] = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def _conn(self):
+        conn = sqlite3.connect(self.filename, timeout=30)
+        conn.execute('create table if not exists metadata ('
+                     'kind text, '
+                     'key text, '
+                     'value text, '
+                     'expires real, '
+                     'primary key (kind, key))')
+        return conn
+
+    def _count(self, kind, stat):
+        with self.lock:
+            self.stats[kind][stat] += 1
+
+    def _remember(self, kind, key, value, expires):
+        with self.lock:
+            self.lru.pop((kind, key), None)
+            self.lru[(kind, key)] = (value, expires)
+            while len(self.lru) > self.max_entries:
+                self.lru.popitem(last=False)
+
+    def get(self, kind, key):
+        """Return the unexpired cached value for kind and key or None."""
+        logger = utils.getLogger()
+        now = time.time()
+        with self.lock:
+            entry = self.lru.pop((kind, key), None)
+            if entry and entry[1] > now:
+                self.lru[(kind, key)] = entry
+                self.stats[kind]['memory_hits'] += 1
+                return entry[0]
+        conn = None
+        try:
+            conn = self._conn()
+            row = conn.execute('select value, expires from metadata '
+                               'where kind=? and key=? and expires>?',
+                               (kind, key, now)).fetchone()
+            if row:
+                value = json.loads(row[0])
+                self._remember(kind, key, value, row[1])
+                self._count(kind, 'disk_hits')
+                return value
+        except sqlite3.Error:
+            logger.exception('MetadataCache.get(%s, %s)', kind, key)
+        finally:
+            if conn:
+                conn.close()
+        self._count(kind, 'misses')
+        return None
+
+    def put(self, kind, key, value):
+        logger = utils.getLogger()
+        now = time.time()
+        expires = now + self.ttls[kind]
+        self._remember(kind, key, value, expires)
+        conn = None
+        try:
+            conn = self._conn()
+            conn.execute('delete from metadata where kind=? and expires<=?',
+                         (kind, now))
+            conn.execute('insert or replace into metadata values (?, ?, ?, ?)',
+                         (kind, key, json.dumps(value), expires))
+            conn.commit()
+        except sqlite3.Error:
+            logger.exception('MetadataCache.put(%s, %s)', kind, key)
+        finally:
+            if conn:
+                conn.close()
+
+    def memoize(self, kind, key, getter):
+        """Return the cached value for kind and key. If it is not
+        cached, call getter to obtain the value and cache it unless
+        it is None."""
+        value = self.get(kind, key)
+        if value is None:
+            value = getter()
+            if value is not None:
+                self.put(kind, key, value)
+        return value
+
+    def report(self):
+        response = ''
+        with self.lock:
+            for kind in sorted(self.stats):
+                response += '%s: %d memory hits, %d disk hits, %d misses\n' % (
+                    kind,
+                    self.stats[kind]['memory_hits'],
+                    self.stats[kind]['disk_hits'],
+                    self.stats[kind]['misses'])
+        return response
+
+
+_METADATA_CACHE = None
+_CLIENTS = threading.local()
+
+
+def metadata_cache():
+    """Return the process wide MetadataCache."""
+    global _METADATA_CACHE
+
+    if not _METADATA_CACHE:
+        _METADATA_CACHE = MetadataCache()
+    return _METADATA_CACHE
+
+
+def taskcluster_queue():
+    """Return the calling thread's taskcluster Queue client."""
+    if not hasattr(_CLIENTS, 'queue'):
+        _CLIENTS.queue = taskcluster.queue.Queue()
+    return _CLIENTS.queue
+
+
+def taskcluster_index():
+    """Return the calling thread's taskcluster Index client."""
+    if not hasattr(_CLIENTS, 'index'):
+        _CLIENTS.index = taskcluster.index.Index()
+    return _CLIENTS.index
+
+
+def treeherder_client():
+    """Return the calling thread's client for the production instance
+    of Treeherder."""
+    if not hasattr(_CLIENTS, 'treeherder'):
+        _CLIENTS.treeherder = TreeherderClient()
+    return _CLIENTS.treeherder
@@ -2,7 +2,11 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from autophonetreeherder import AutophoneTreeherder
 from builds import BuildCache
+from buildserver import BuildCacheServer, BuildPrefetcher
+from s3 import S3UploadIndex
+from utils import HttpSessions
 from worker import Crashes, PhoneWorker
 
 class AutophoneOptions(object):
@@ -57,6 +61,15 @@ class AutophoneOptions(object):
         # ini options
         self.build_cache_size = BuildCache.MAX_NUM_BUILDS
         self.build_cache_expires = BuildCache.EXPIRE_AFTER_DAYS
+        self.build_cache_max_bytes = BuildCache.MAX_BYTES
+        self.build_cache_min_free_bytes = BuildCache.MIN_FREE_BYTES
+        self.build_cache_max_downloads = BuildCacheServer.MAX_DOWNLOADS
+        self.build_cache_fetch_threads = BuildCache.FETCH_THREADS
+        self.build_cache_scrub_interval = BuildCache.SCRUB_INTERVAL
+        self.build_cache_prefetch_threads = BuildPrefetcher.PREFETCH_THREADS
+        self.build_cache_prefetch_rate = BuildCacheServer.PREFETCH_RATE
+        self.build_cache_peer_port = 0
+        self.build_cache_peers = []
         self.device_ready_retry_wait = PhoneWorker.DEVICE_READY_RETRY_WAIT
         self.device_ready_retry_attempts = PhoneWorker.DEVICE_READY_RETRY_ATTEMPTS
         self.device_battery_min = PhoneWorker.DEVICE_BATTERY_MIN
@@ -68,6 +81,15 @@ class AutophoneOptions(object):
         self.phone_command_queue_timeout = PhoneWorker.PHONE_COMMAND_QUEUE_TIMEOUT
         self.phone_crash_window = Crashes.CRASH_WINDOW
         self.phone_crash_limit = Crashes.CRASH_LIMIT
+        self.s3_dedupe_ttl = S3UploadIndex.TTL
+        self.treeherder_coalesce_max_jobs = AutophoneTreeherder.COALESCE_MAX_JOBS
+        self.treeherder_coalesce_max_bytes = AutophoneTreeherder.COALESCE_MAX_BYTES
+        self.treeherder_coalesce_max_age = AutophoneTreeherder.COALESCE_MAX_AGE
+        self.treeherder_sender_threads = AutophoneTreeherder.SENDER_THREADS
+        self.treeherder_circuit_failures = AutophoneTreeherder.CIRCUIT_FAILURES
+        self.http_retry_attempts = HttpSessions.ATTEMPTS
+        self.http_backoff_base = HttpSessions.BACKOFF_BASE
+        self.http_backoff_max = HttpSessions.BACKOFF_MAX
         # other
         self.debug = 3
 
@@ -103,6 +125,15 @@ class AutophoneOptions(object):
                      'device_test_root',
                      'build_cache_size',
                      'build_cache_expires',
+                     'build_cache_max_bytes',
+                     'build_cache_min_free_bytes',
+                     'build_cache_max_downloads',
+                     'build_cache_fetch_threads',
+                     'build_cache_scrub_interval',
+                     'build_cache_prefetch_threads',
+                     'build_cache_prefetch_rate',
+                     'build_cache_peer_port',
+                     'build_cache_peers',
                      'device_ready_retry_wait',
                      'device_ready_retry_attempts',
                      'device_battery_min',
@@ -114,6 +145,15 @@ class AutophoneOptions(object):
                      'phone_command_queue_timeout',
                      'phone_crash_window',
                      'phone_crash_limit',
+                     's3_dedupe_ttl',
+                     'treeherder_coalesce_max_jobs',
+                     'treeherder_coalesce_max_bytes',
+                     'treeherder_coalesce_max_age',
+                     'treeherder_sender_threads',
+                     'treeherder_circuit_failures',
+                     'http_retry_attempts',
+                     'http_backoff_base',
+                     'http_backoff_max',
                      'debug')
         d = {}
         for attr in whitelist:
@@ -27,12 +27,180 @@ from phonestatus import PhoneStatus, TreeherderStatus, TestStatus
 # Define the Adobe Flash Player package name as a constant for reuse.
 FLASH_PACKAGE = 'com.adobe.flashplayer'
 
+class PrefixTrie(object):
+    """Trie mapping path prefixes to the set of values registered for
+    them. Used to find the tests whose run_if_changed directories are
+    prefixes of the directories changed by a push."""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix, value):
+        node = self.root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        node.setdefault(None, set()).add(value)
+
+    def remove(self, prefix, value):
+        path = []
+        node = self.root
+        for c in prefix:
+            if c not in node:
+                return
+            path.append((node, c))
+            node = node[c]
+        values = node.get(None, set())
+        values.discard(value)
+        if not values:
+            node.pop(None, None)
+        # Prune the nodes which no longer lead to any values.
+        while path and not node:
+            parent, c = path.pop()
+            del parent[c]
+            node = parent
+
+    def match(self, path):
+        """Return the set of values registered for prefixes of path."""
+        matches = set()
+        node = self.root
+        if None in node:
+            matches.update(node[None])
+        for c in path:
+            node = node.get(c)
+            if node is None:
+                break
+            if None in node:
+                matches.update(node[None])
+        return matches
+
+
+class PhoneTestIndex(object):
+    """Index of the PhoneTest instances by the attributes used to
+    select them in PhoneTest.match so that queries are answered by set
+    intersections rather than by scanning every instance."""
+
+    def __init__(self):
+        self.tests = set()
+        self.phoneids = {}
+        self.job_guids = {}
+        self.app_names = {}
+        self.build_types = {}
+        self.platforms = {}
+        self.repos = {}
+        # Tests without repos match every repo.
+        self.any_repo = set()
+        # Tests without run_if_changed match every changeset.
+        self.unconditional = set()
+        self.run_if_changed = PrefixTrie()
+
+    @staticmethod
+    def _add(index, values, test):
+        for value in values:
+            index.setdefault(value, set()).add(test)
+
+    @staticmethod
+    def _remove(index, values, test):
+        for value in values:
+            tests = index.get(value)
+            if tests is None:
+                continue
+            tests.discard(test)
+            if not tests:
+                del index[value]
+
+    def _fields(self, test):
+        return ((self.phoneids, [test.phone.id]),
+                (self.app_names, test.app_names),
+                (self.build_types, test.buildtypes),
+                (self.platforms, test.platforms),
+                (self.repos, test.repos))
+
+    def add(self, test):
+        self.tests.add(test)
+        for index, values in self._fields(test):
+            self._add(index, values, test)
+        if test.job_guid:
+            self._add(self.job_guids, [test.job_guid], test)
+        if not test.repos:
+            self.any_repo.add(test)
+        if test.run_if_changed:
+            for prefix in test.run_if_changed:
+                self.run_if_changed.add(prefix, test)
+        else:
+            self.unconditional.add(test)
+
+    def remove(self, test):
+        if test not in self.tests:
+            return
+        self.tests.discard(test)
+        for index, values in self._fields(test):
+            self._remove(index, values, test)
+        if test.job_guid:
+            self._remove(self.job_guids, [test.job_guid], test)
+        self.any_repo.discard(test)
+        self.unconditional.discard(test)
+        for prefix in test.run_if_changed:
+            self.run_if_changed.remove(prefix, test)
+
+    def update_job_guid(self, test, old_job_guid, new_job_guid):
+        if test not in self.tests:
+            return
+        if old_job_guid:
+            self._remove(self.job_guids, [old_job_guid], test)
+        if new_job_guid:
+            self._add(self.job_guids, [new_job_guid], test)
+
+    @property
+    def has_run_if_changed(self):
+        return len(self.unconditional) < len(self.tests)
+
+    def candidates(self, phoneid=None, job_guid=None, repo=None,
+                   platform=None, app_name=None, build_type=None,
+                   changeset_dirs=None):
+        """Return the set of tests matching the indexed attributes."""
+        selections = []
+        if phoneid:
+            selections.append(self.phoneids.get(phoneid, set()))
+        if job_guid:
+            selections.append(self.job_guids.get(job_guid, set()))
+        if app_name:
+            selections.append(self.app_names.get(app_name, set()))
+        if build_type:
+            selections.append(self.build_types.get(build_type, set()))
+        if platform:
+            selections.append(self.platforms.get(platform, set()))
+        if repo:
+            selections.append(self.repos.get(repo, set()) | self.any_repo)
+        # If changeset_dirs is empty, we will run the tests anyway.
+        # This is safer in terms of catching regressions and extra tests
+        # being run are more likely to be noticed and fixed than tests
+        # not being run that should have been.
+        if changeset_dirs and '' not in changeset_dirs and \
+           self.has_run_if_changed:
+            changed = set(self.unconditional)
+            for cd in changeset_dirs:
+                changed.update(self.run_if_changed.match(cd))
+            selections.append(changed)
+        if not selections:
+            return set(self.tests)
+        # Intersect starting with the smallest set.
+        selections.sort(key=len)
+        candidates = set(selections[0])
+        for selection in selections[1:]:
+            candidates.intersection_update(selection)
+            if not candidates:
+                break
+        return candidates
+
+
 class PhoneTest(object):
 
     # Use instances keyed on phoneid+':'config_file+':'+str(chunk)
     # to lookup tests.
 
     instances = {}
+    # index contains the fully initialized instances.
+    index = PhoneTestIndex()
     has_run_if_changed = False
 
     @classmethod
@@ -55,78 +223,34 @@ class PhoneTest(object):
                      'abi: %s, build_sdk: %s',
                      tests, test_name, phoneid, config_file, job_guid,
                      repo, platform, app_name, build_type, build_abi, build_sdk)
-        matches = []
-        if not tests:
-            tests = [PhoneTest.instances[key] for key in PhoneTest.instances.keys()]
+        # The indexed attributes and run_if_changed are matched by
+        # PhoneTest.index. The remaining attributes are checked for
+        # each of the candidates.
+        candidates = PhoneTest.index.candidates(phoneid=phoneid,
+                                                job_guid=job_guid,
+                                                repo=repo,
+                                                platform=platform,
+                                                app_name=app_name,
+                                                build_type=build_type,
+                                                changeset_dirs=changeset_dirs)
+        if tests:
+            tests = [test for test in tests if test in candidates]
+        else:
+            tests = candidates
 
+        matches = []
         for test in tests:
-            # If changeset_dirs is empty, we will run the tests anyway.
-            # This is safer in terms of catching regressions and extra tests
-            # being run are more likely to be noticed and fixed than tests
-            # not being run that should have been.
-            if hasattr(test, 'run_if_changed') and test.run_if_changed and changeset_dirs:
-                matched = False
-                for cd in changeset_dirs:
-                    if matched:
-                        break
-                    for td in test.run_if_changed:
-                        if cd == "" or cd.startswith(td):
-                            logger.debug('PhoneTest.match: test %s dir %s '
-                                         'matched changeset_dirs %s', test, td, cd)
-                            matched = True
-                            break
-                if not matched:
-                    logger.debug('PhoneTest.match: did not match changeset_dirs %s %s %s',
-                                 test, test.run_if_changed, changeset_dirs)
-                    continue
-
             if test_name and test_name != test.name and \
                "%s%s" % (test_name, test.name_suffix) != test.name:
-                logger.debug('PhoneTest.match: did not match test_name %s %s %s',
-                             test, test_name, test.app_names)
-                continue
-
-            if phoneid and phoneid != test.phone.id:
-                logger.debug('PhoneTest.match: did not match phoneid %s %s %s',
-                             test, phoneid, test.phone.id)
                 continue
 
             if config_file and config_file != test.config_file:
-                logger.debug('PhoneTest.match: did not match config_file %s %s %s',
-                             test, config_file, test.config_file)
-                continue
-
-            if job_guid and job_guid != test.job_guid:
-                logger.debug('PhoneTest.match: did not match job_guid %s %s %s',
-                             test, job_guid, test.job_guid)
-                continue
-
-            if repo and test.repos and repo not in test.repos:
-                logger.debug('PhoneTest.match: did not match repo %s %s %s',
-                             test, repo, test.repos)
-                continue
-
-            if build_type and build_type not in test.buildtypes:
-                logger.debug('PhoneTest.match: did not match build_type %s %s %s',
-                             test, build_type, test.buildtypes)
-                continue
-
-            if platform and platform not in test.platforms:
-                logger.debug('PhoneTest.match: did not match platform %s %s %s',
-                             test, platform, test.platforms)
-                continue
-
-            if app_name and app_name not in test.app_names:
-                logger.debug('PhoneTest.match: did not match app_name %s %s %s',
-                             test, app_name, test.app_names)
                 continue
 
             if build_abi and build_abi not in test.phone.abi:
                 # phone.abi may be of the form armeabi-v7a, arm64-v8a
                 # or some form of x86. Test for inclusion rather than
                 # exact matches to cover the possibilities.
-                logger.debug('PhoneTest.match: did not match build_api %s %s %s',
-                             test, build_abi, test.phone.abi)
                 continue
 
             if build_sdk and build_sdk not in test.phone.supported_sdks:
@@ -140,8 +264,6 @@ class PhoneTest(object):
                         sdk_found = True
                         break
                 if not sdk_found:
-                    logger.debug('PhoneTest.match: did not match build_sdk %s %s %s',
-                                 test, build_sdk, test.phone.supported_sdks)
                     continue
 
             matches.append(test)
@@ -161,7 +283,6 @@ class PhoneTest(object):
         # to work.
         assert type(repos) == list, 'PhoneTest repos argument must be a list'
         repos.sort()
-        self._add_instance(phone.id, config_file, chunk)
         # The default preferences and environment for running fennec
         # are set here in PhoneTest. Tests which subclass PhoneTest can
         # add or override these preferences during their
@@ -206,7 +327,7 @@ class PhoneTest(object):
         # test job in treeherder. The test job_guid is updated when a
         # test is added to the pending jobs/tests in the jobs
         # database.
-        self.job_guid = None
+        self._job_guid = None
         self.job_details = []
         self.submit_timestamp = None
         self.start_timestamp = None
@@ -267,8 +388,6 @@ class PhoneTest(object):
         try:
             dirs = self.cfg.get('runtests', 'run_if_changed')
             self.run_if_changed = set([d.strip() for d in dirs.split(',')])
-            if self.run_if_changed:
-                PhoneTest.has_run_if_changed = True
         except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
             pass
         if 'profile' in self._paths:
@@ -314,6 +433,7 @@ class PhoneTest(object):
             self.platforms = self.options.platforms
 
         self.loggerdeco.info('PhoneTest: %s', self.__dict__)
+        self._add_instance(phone.id, config_file, chunk)
 
     def __str__(self):
         return '%s(%s, config_file=%s, chunk=%s, buildtypes=%s)' % (
@@ -327,22 +447,30 @@ class PhoneTest(object):
         return self.__str__()
 
     def _add_instance(self, phoneid, config_file, chunk):
+        # Called at the end of initialization so that the attributes
+        # used by PhoneTest.index are available.
         key = '%s:%s:%s' % (phoneid, config_file, chunk)
         assert key not in PhoneTest.instances, 'Duplicate PhoneTest %s' % key
         PhoneTest.instances[key] = self
+        PhoneTest.index.add(self)
+        PhoneTest.has_run_if_changed = PhoneTest.index.has_run_if_changed
 
     def remove(self):
         key = '%s:%s:%s' % (self.phone.id, self.config_file, self.chunk)
         if key in PhoneTest.instances:
-            had_run_if_changed = hasattr(PhoneTest.instances[key], 'run_if_changed') and \
-                                 PhoneTest.instances[key].run_if_changed
             del PhoneTest.instances[key]
-            if had_run_if_changed:
-                PhoneTest.has_run_if_changed = False
-                for key in PhoneTest.instances.keys():
-                    if PhoneTest.instances[key].run_if_changed:
-                        PhoneTest.has_run_if_changed = True
-                        break
+            PhoneTest.index.remove(self)
+            PhoneTest.has_run_if_changed = PhoneTest.index.has_run_if_changed
+
+    @property
+    def job_guid(self):
+        return self._job_guid
+
+    @job_guid.setter
+    def job_guid(self, job_guid):
+        # Keep PhoneTest.index up to date as the job_guid changes.
+        PhoneTest.index.update_job_guid(self, self._job_guid, job_guid)
+        self._job_guid = job_guid
 
     def set_worker_subprocess(self, worker_subprocess):
         logger = utils.getLogger()
@@ -661,6 +789,14 @@ class PhoneTest(object):
         """
         return set()
 
+    def get_test_package_paths(self):
+        """Return a set of the path prefixes of the members of the test
+        packages which need to be extracted in order to run the test
+        or None if the test packages need to be extracted completely.
+        This set will be passed to the BuildCache.get() method.
+        """
+        return None
+
     def generate_guid(self):
         self.job_guid = utils.generate_guid()
 
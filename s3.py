@@ -4,14 +4,23 @@
 
 # modeled after https://github.com/mozilla-b2g/gaia/blob/master/tests/python/gaia-ui-tests/gaiatest/mixins/treeherder.py
 
+import Queue
 import gzip
+import hashlib
+import itertools
 import logging
 import os
 import re
-import tempfile
+import socket
+import sqlite3
+import threading
+import time
+
+from cStringIO import StringIO
 
 import boto
 import boto.s3.connection
+import boto.s3.multipart
 
 import utils
 
@@ -19,13 +28,197 @@ class S3Error(Exception):
     def __init__(self, message):
         Exception.__init__(self, 'S3Error: %s' % message)
 
+
+class GzipChunkBuffer(object):
+    """File-like sink for gzip.GzipFile which accumulates the compressed
+    output in memory until it is taken by the caller. This allows a
+    file to be compressed and uploaded in pieces without writing the
+    compressed copy to disk."""
+
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data):
+        if data:
+            self._chunks.append(data)
+            self.size += len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = ''.join(self._chunks)
+        self._chunks = []
+        self.size = 0
+        return data
+
+
+class S3UploadIndex(object):
+    """Content addressed index of uploaded files.
+
+    Maps the sha256 digest and Content-Type of each file uploaded by
+    S3Bucket.upload to the url of the S3 object holding its
+    contents. Files whose contents have already been uploaded within
+    the last ttl seconds reuse the existing url rather than being
+    uploaded again. The bytes saved are accumulated per day.
+
+    The index is shared by all of the worker processes. Since it is
+    only an optimization, database errors are logged and treated as
+    an index miss rather than being retried.
+    """
+
+    TTL = 24*60*60
+
+    def __init__(self, filename='s3uploads.sqlite', ttl=TTL):
+        self.filename = filename
+        self.ttl = ttl
+
+        if not os.path.exists(self.filename):
+            conn = self._conn()
+            conn.execute('create table if not exists uploads ('
+                         'sha256 text, '
+                         'content_type text, '
+                         'url text, '
+                         'size int, '
+                         'created real, '
+                         'primary key (sha256, content_type))')
+            conn.execute('create table if not exists savings ('
+                         'day text primary key, '
+                         'hits int, '
+                         'bytes int)')
+            conn.commit()
+            conn.close()
+
+    def _conn(self):
+        return sqlite3.connect(self.filename, timeout=30)
+
+    @staticmethod
+    def digest(path):
+        """Return the sha256 hexdigest and size of the file at path."""
+        sha256 = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(S3Bucket.READ_SIZE)
+                if not data:
+                    break
+                sha256.update(data)
+                size += len(data)
+        return sha256.hexdigest(), size
+
+    def lookup(self, sha256, content_type):
+        """Return the url of an unexpired upload with the given digest
+        and content type or None. A hit is counted towards today's
+        savings."""
+        logger = utils.getLogger()
+        now = time.time()
+        conn = None
+        try:
+            conn = self._conn()
+            row = conn.execute('select url, size from uploads where '
+                               'sha256=? and content_type=? and created>?',
+                               (sha256, content_type, now - self.ttl)).fetchone()
+            if not row:
+                return None
+            url, size = row
+            day = time.strftime('%Y-%m-%d', time.gmtime(now))
+            conn.execute('insert or ignore into savings values (?, 0, 0)',
+                         (day,))
+            conn.execute('update savings set hits=hits+1, bytes=bytes+? '
+                         'where day=?', (size, day))
+            conn.commit()
+            return url
+        except sqlite3.Error:
+            logger.exception('S3UploadIndex.lookup(%s)', sha256)
+            return None
+        finally:
+            if conn:
+                conn.close()
+
+    def add(self, sha256, content_type, url, size):
+        """Record that the contents with the given digest and content
+        type have been uploaded to url. Expired entries are purged."""
+        logger = utils.getLogger()
+        now = time.time()
+        conn = None
+        try:
+            conn = self._conn()
+            conn.execute('delete from uploads where created<=?',
+                         (now - self.ttl,))
+            conn.execute('insert or replace into uploads values '
+                         '(?, ?, ?, ?, ?)',
+                         (sha256, content_type, url, size, now))
+            conn.commit()
+        except sqlite3.Error:
+            logger.exception('S3UploadIndex.add(%s, %s)', sha256, url)
+        finally:
+            if conn:
+                conn.close()
+
+    def savings(self, days=7):
+        """Return a list of (day, hits, bytes) tuples for the most
+        recent days ordered by day."""
+        logger = utils.getLogger()
+        conn = None
+        try:
+            conn = self._conn()
+            rows = conn.execute('select day, hits, bytes from savings '
+                                'order by day desc limit ?',
+                                (days,)).fetchall()
+            rows.reverse()
+            return rows
+        except sqlite3.Error:
+            logger.exception('S3UploadIndex.savings')
+            return []
+        finally:
+            if conn:
+                conn.close()
+
+
 class S3Bucket(object):
 
-    def __init__(self, bucket_name, access_key_id, access_secret_key):
+    # The compressed contents of an uploaded file are sent in a single
+    # request if they fit in one part of PART_SIZE bytes. Larger files
+    # are sent as a multipart upload using PART_THREADS concurrent
+    # part uploads, each of which is attempted up to PART_ATTEMPTS
+    # times. S3 requires all parts but the last to be at least 5MB.
+    PART_SIZE = 8 * 1024 * 1024
+    PART_THREADS = 4
+    PART_ATTEMPTS = 3
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, bucket_name, access_key_id, access_secret_key,
+                 host=None, port=None, is_secure=True,
+                 part_size=PART_SIZE, part_threads=PART_THREADS,
+                 part_attempts=PART_ATTEMPTS, upload_index=None):
         self.bucket_name = bucket_name
         self._bucket = None
         self.access_key_id = access_key_id
         self.access_secret_key = access_secret_key
+        # host, port and is_secure are only needed when using an S3
+        # compatible server other than AWS, e.g. in selftest/s3upload.py.
+        self.host = host
+        self.port = port
+        self.is_secure = is_secure
+        self.part_size = part_size
+        self.part_threads = part_threads
+        self.part_attempts = part_attempts
+        # upload_index is an optional S3UploadIndex used to avoid
+        # uploading the same contents more than once.
+        self.upload_index = upload_index
+
+    def _connect(self):
+        if not self.host:
+            return boto.s3.connection.S3Connection(self.access_key_id,
+                                                   self.access_secret_key)
+        return boto.s3.connection.S3Connection(
+            self.access_key_id,
+            self.access_secret_key,
+            host=self.host,
+            port=self.port,
+            is_secure=self.is_secure,
+            calling_format=boto.s3.connection.OrdinaryCallingFormat())
 
     @property
     def bucket(self):
@@ -33,8 +226,7 @@ class S3Bucket(object):
             return self._bucket
         logger = utils.getLogger()
         try:
-            conn = boto.s3.connection.S3Connection(self.access_key_id,
-                                                   self.access_secret_key)
+            conn = self._connect()
             if not conn.lookup(self.bucket_name):
                 raise S3Error('bucket %s not found' % self.bucket_name)
             if not self._bucket:
@@ -66,28 +258,172 @@ class S3Bucket(object):
             logger.exception(str(e))
             raise S3Error('%s' % e)
 
+    def _gzip_chunks(self, path):
+        """Generator which compresses the file at path on the fly and
+        yields the compressed data in chunks of at least part_size
+        bytes. Only the final chunk may be smaller than part_size."""
+        buf = GzipChunkBuffer()
+        with open(path, 'rb') as f:
+            gz = gzip.GzipFile(path, 'wb', fileobj=buf)
+            while True:
+                data = f.read(self.READ_SIZE)
+                if not data:
+                    break
+                gz.write(data)
+                if buf.size >= self.part_size:
+                    yield buf.take()
+            gz.close()
+        yield buf.take()
+
+    def _upload_part(self, mp, part_num, data):
+        """Upload a single part of a multipart upload, retrying up to
+        part_attempts times. Returns the part's etag."""
+        logger = utils.getLogger()
+        for attempt in range(1, self.part_attempts + 1):
+            try:
+                part = mp.upload_part_from_file(StringIO(data), part_num,
+                                                size=len(data))
+                return part.etag
+            except (boto.exception.BotoClientError,
+                    boto.exception.BotoServerError,
+                    socket.error, IOError), e:
+                logger.warning('Attempt %d uploading part %d of %s: %s',
+                               attempt, part_num, mp.key_name, e)
+                if attempt == self.part_attempts:
+                    raise
+                time.sleep(attempt)
+
+    def _multipart_upload(self, key, chunks):
+        """Upload the compressed chunks to key using a multipart upload
+        whose parts are sent concurrently by part_threads threads.
+
+        At most part_threads parts are queued waiting for a thread
+        which bounds the memory used to roughly 2 * part_threads *
+        part_size bytes regardless of the size of the file.
+        """
+        logger = utils.getLogger()
+        mp = self.bucket.initiate_multipart_upload(key.name,
+                                                   metadata=key.metadata)
+        part_queue = Queue.Queue(maxsize=self.part_threads)
+        etags = {}
+        errors = []
+
+        def part_uploader():
+            # boto connections are not shared between threads. Each
+            # thread uses its own connection to upload its parts. If
+            # the connection fails, the thread records the error and
+            # keeps draining the queue so the producer never blocks.
+            thread_mp = None
+            try:
+                thread_mp = boto.s3.multipart.MultiPartUpload(
+                    self._connect().get_bucket(self.bucket_name,
+                                               validate=False))
+                thread_mp.key_name = mp.key_name
+                thread_mp.id = mp.id
+            except Exception, e:
+                errors.append(e)
+            while True:
+                item = part_queue.get()
+                if item is None:
+                    break
+                if errors:
+                    # Drain the queue without uploading once any part fails.
+                    continue
+                part_num, data = item
+                try:
+                    etags[part_num] = self._upload_part(thread_mp, part_num, data)
+                except Exception, e:
+                    errors.append(e)
+
+        threads = []
+        for i in range(self.part_threads):
+            thread = threading.Thread(target=part_uploader,
+                                      name='S3PartUploader-%d' % i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for part_num, data in enumerate(chunks, 1):
+                if errors:
+                    break
+                part_queue.put((part_num, data))
+        except Exception, e:
+            errors.append(e)
+        finally:
+            for thread in threads:
+                part_queue.put(None)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            logger.error('Cancelling multipart upload of %s: %s',
+                         key.name, errors[0])
+            try:
+                mp.cancel_upload()
+            except boto.exception.S3ResponseError:
+                logger.exception('Error cancelling multipart upload of %s',
+                                 key.name)
+            raise S3Error('%s' % errors[0])
+
+        xml = '<CompleteMultipartUpload>\n'
+        for part_num in sorted(etags):
+            xml += ('  <Part>\n'
+                    '    <PartNumber>%d</PartNumber>\n'
+                    '    <ETag>%s</ETag>\n'
+                    '  </Part>\n' % (part_num, etags[part_num]))
+        xml += '</CompleteMultipartUpload>'
+        self.bucket.complete_multipart_upload(key.name, mp.id, xml)
+        logger.debug('Uploaded %s in %d parts', key.name, len(etags))
+
     def upload(self, path, destination):
+        """Upload the gzip compressed contents of the file at path to
+        the key destination and return the url of the uploaded key.
+
+        The file is compressed while it is read. If the compressed
+        contents fit in a single part they are sent in one request,
+        otherwise they are sent using a parallel multipart upload.
+
+        If an upload_index is set and a file with identical contents
+        has already been uploaded, the url of the existing key is
+        returned and the file is not uploaded again.
+        """
+        logger = utils.getLogger()
+        ext = os.path.splitext(path)[-1]
+        if ext == '.log' or ext == '.txt':
+            content_type = 'text/plain'
+        else:
+            content_type = ''
+        if self.upload_index:
+            sha256, size = self.upload_index.digest(path)
+            url = self.upload_index.lookup(sha256, content_type)
+            if url:
+                logger.debug('File %s already uploaded to: %s', path, url)
+                return url
         try:
-            logger = utils.getLogger()
             key = self.bucket.get_key(destination)
             if not key:
                 logger.debug('Creating key: %s', destination)
                 key = self.bucket.new_key(destination)
 
-            ext = os.path.splitext(path)[-1]
-            if ext == '.log' or ext == '.txt':
-                key.set_metadata('Content-Type', 'text/plain')
-
-            with tempfile.NamedTemporaryFile('w+b', suffix=ext) as tf:
-                logger.debug('Compressing: %s', path)
-                with gzip.GzipFile(path, 'wb', fileobj=tf) as gz:
-                    with open(path, 'rb') as f:
-                        gz.writelines(f)
-                tf.flush()
-                tf.seek(0)
-                key.set_metadata('Content-Encoding', 'gzip')
-                logger.debug('Setting key contents from: %s', tf.name)
-                key.set_contents_from_file(tf)
+            if content_type:
+                key.set_metadata('Content-Type', content_type)
+            key.set_metadata('Content-Encoding', 'gzip')
+
+            logger.debug('Compressing: %s', path)
+            chunks = self._gzip_chunks(path)
+            first_chunk = chunks.next()
+            try:
+                second_chunk = chunks.next()
+            except StopIteration:
+                second_chunk = None
+            if second_chunk is None:
+                logger.debug('Setting key contents from: %s', path)
+                key.set_contents_from_string(first_chunk)
+            else:
+                logger.debug('Setting key contents from: %s using multipart upload',
+                             path)
+                self._multipart_upload(
+                    key, itertools.chain([first_chunk, second_chunk], chunks))
 
             url = key.generate_url(expires_in=0,
                                    query_auth=False)
@@ -96,6 +432,8 @@ class S3Bucket(object):
             raise S3Error('%s' % e)
 
         logger.debug('File %s uploaded to: %s', path, url)
+        if self.upload_index:
+            self.upload_index.add(sha256, content_type, url, size)
         return url
 
 def main():
@@ -0,0 +1,643 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Concurrency tests for BuildCacheServer using a local http server
+serving fake builds."""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+
+from cStringIO import StringIO
+
+import buildserver
+import builds
+import utils
+
+REPO = 'autoland'
+
+
+def zip_bytes(files):
+    """Return the contents of a zip file containing files, a dict
+    mapping names to contents. Zip files with the same files have the
+    same contents."""
+    buf = StringIO()
+    with zipfile.ZipFile(buf, 'w') as z:
+        for name, contents in sorted(files.items()):
+            z.writestr(zipfile.ZipInfo(name, (2017, 6, 1, 0, 0, 0)), contents)
+    return buf.getvalue()
+
+
+class FakeBuildServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serve fake builds and their hg changesets. Requests for paths
+    in delays wait for the given number of seconds before
+    responding. The requested paths are recorded in order in
+    requests."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeBuildHandler)
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.files = {}
+        self.delays = {}
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def add_build(self, number, delay=0):
+        """Add build number and return the url of its apk."""
+        revision = '%040x' % number
+        build_dir = '/builds/%d/' % number
+        self.files[build_dir + 'target.apk'] = zip_bytes({
+            'application.ini': '[App]\nVersion=55.0a1\n',
+            'package-name.txt': 'org.mozilla.fennec\n',
+            'build.txt': revision})
+        self.files[build_dir + 'target.json'] = json.dumps({
+            'buildid': '20170601%06d' % number,
+            'target_cpu': 'arm',
+            'moz_source_repo': 'MOZ_SOURCE_REPO=%s/hg/%s' % (self.url, REPO),
+            'moz_source_stamp': revision,
+            'mozconfig': 'mobile/android/config/mozconfigs/android-api-16/nightly'})
+        self.files[build_dir + 'target.mozinfo.json'] = json.dumps({
+            'debug': False, 'os': 'android', 'nightly_build': False})
+        self.files[build_dir + 'target.crashreporter-symbols.zip'] = zip_bytes({
+            'libxul.so/0/libxul.so.sym': 'MODULE Linux arm 0 libxul.so\n'})
+        self.files[build_dir + 'robocop.apk'] = zip_bytes({
+            'AndroidManifest.xml': ''})
+        self.files[build_dir + 'target.test_packages.json'] = json.dumps({
+            'common': ['target.common.tests.zip'],
+            'mochitest': ['target.common.tests.zip',
+                          'target.mochitest.tests.zip']})
+        self.files[build_dir + 'target.common.tests.zip'] = zip_bytes({
+            'bin/xpcshell': 'xpcshell', 'modules/common.py': 'common'})
+        self.files[build_dir + 'target.mochitest.tests.zip'] = zip_bytes({
+            'mochitest/runtests.py': 'runtests',
+            'modules/mochitest.py': 'mochitest'})
+        self.files['/hg/%s/json-pushes?changeset=%s' % (REPO, revision)] = \
+            json.dumps({str(number): {'changesets': [revision], 'date': 0}})
+        self.files['/hg/%s/raw-rev/%s' % (REPO, revision)] = (
+            '--- a/mobile/android/base/file.java\n'
+            '+++ b/mobile/android/base/file.java\n')
+        self.delays[build_dir + 'target.apk'] = delay
+        return self.url + build_dir + 'target.apk'
+
+
+class FakeBuildHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.counts[self.path] = server.counts.get(self.path, 0) + 1
+            server.requests.append(self.path)
+            delay = server.delays.get(self.path)
+            if delay is not None:
+                server.active += 1
+                server.max_active = max(server.max_active, server.active)
+        try:
+            if delay:
+                time.sleep(delay)
+            body = server.files.get(self.path)
+            if body is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            if delay is not None:
+                with server.lock:
+                    server.active -= 1
+
+
+class BuildCacheServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved_changeset_dirs_db = utils.CHANGESET_DIRS_DB
+        utils.CHANGESET_DIRS_DB = os.path.join(self.tmpdir,
+                                               'changeset_dirs.sqlite')
+        self.http_server = FakeBuildServer()
+        self.build_cache_server = None
+
+    def tearDown(self):
+        if self.build_cache_server:
+            self.build_cache_server.shutdown()
+            self.build_cache_server.server_close()
+        self.http_server.stop()
+        utils.CHANGESET_DIRS_DB = self.saved_changeset_dirs_db
+        shutil.rmtree(self.tmpdir)
+
+    def start_build_cache_server(self, max_downloads, prefetch_rate=0):
+        build_cache = builds.BuildCache(
+            [REPO], ['opt'], 'fennec', ['android-api-16'], '.apk',
+            cache_dir=os.path.join(self.tmpdir, 'builds'))
+        self.build_cache_server = buildserver.BuildCacheServer(
+            ('127.0.0.1', 0), buildserver.BuildCacheHandler,
+            max_downloads=max_downloads, prefetch_rate=prefetch_rate)
+        self.build_cache_server.build_cache = build_cache
+        thread = threading.Thread(
+            target=self.build_cache_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def get(self, build_url, results=None, test_package_names=None,
+            test_package_paths=None):
+        client = buildserver.BuildCacheClient(
+            port=self.build_cache_server.server_address[1])
+        try:
+            result = client.get(build_url,
+                                enable_unittests=bool(test_package_names),
+                                test_package_names=test_package_names,
+                                test_package_paths=test_package_paths)
+        finally:
+            client.close()
+        if results is not None:
+            results.append(result)
+        return result
+
+    def get_concurrently(self, build_urls):
+        """Request each of build_urls from a separate client thread.
+        Returns the results and the elapsed time."""
+        results = []
+        threads = [threading.Thread(target=self.get, args=(build_url, results))
+                   for build_url in build_urls]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, time.time() - start
+
+    def apk_count(self, build_url):
+        return self.http_server.counts.get(
+            build_url.replace(self.http_server.url, ''), 0)
+
+    def test_single_flight(self):
+        self.start_build_cache_server(max_downloads=4)
+        build_url = self.http_server.add_build(1, delay=0.5)
+        results, elapsed = self.get_concurrently([build_url] * 4)
+        self.assertEqual([result['success'] for result in results],
+                         [True] * 4)
+        self.assertEqual(self.apk_count(build_url), 1)
+
+    def test_parallel_downloads(self):
+        self.start_build_cache_server(max_downloads=3)
+        build_urls = [self.http_server.add_build(i, delay=1) for i in range(3)]
+        results, elapsed = self.get_concurrently(build_urls)
+        self.assertEqual([result['success'] for result in results],
+                         [True] * 3)
+        self.assertEqual(self.http_server.max_active, 3)
+        self.assertTrue(elapsed < 2.5, 'elapsed %.1f' % elapsed)
+
+    def test_download_limit(self):
+        self.start_build_cache_server(max_downloads=2)
+        build_urls = [self.http_server.add_build(i, delay=0.5) for i in range(4)]
+        results, elapsed = self.get_concurrently(build_urls)
+        self.assertEqual([result['success'] for result in results],
+                         [True] * 4)
+        self.assertEqual(self.http_server.max_active, 2)
+
+    def test_artifacts_fetched_concurrently(self):
+        self.start_build_cache_server(max_downloads=1)
+        build_url = self.http_server.add_build(1, delay=1)
+        self.http_server.delays[build_url.replace(
+            self.http_server.url, '').replace(
+                '.apk', '.crashreporter-symbols.zip')] = 1
+        results, elapsed = self.get_concurrently([build_url])
+        self.assertTrue(results[0]['success'])
+        self.assertEqual(sorted([timing['name'] for timing in results[0]['timings']]),
+                         ['build', 'symbols'])
+        self.assertEqual(self.http_server.max_active, 2)
+        self.assertTrue(elapsed < 1.9, 'elapsed %.1f' % elapsed)
+
+    def test_test_packages(self):
+        self.start_build_cache_server(max_downloads=1)
+        build_url = self.http_server.add_build(1)
+        result = self.get(build_url, test_package_names=['mochitest'])
+        self.assertTrue(result['success'])
+        self.assertEqual(sorted([timing['name'] for timing in result['timings']]),
+                         ['build', 'robocop', 'symbols',
+                          'target.common.tests.zip',
+                          'target.mochitest.tests.zip'])
+        tests_path = os.path.join(result['metadata']['dir'],
+                                  'tests')
+        for path in ['bin/xpcshell', 'modules/common.py',
+                     'mochitest/runtests.py', 'modules/mochitest.py']:
+            self.assertTrue(os.path.exists(os.path.join(tests_path, path)),
+                            path)
+        result = self.get(build_url, test_package_names=['mochitest'])
+        self.assertTrue(result['success'])
+        self.assertEqual(result['timings'], [])
+
+    def test_selective_test_package_extraction(self):
+        self.start_build_cache_server(max_downloads=1)
+        build_url = self.http_server.add_build(1)
+
+        def extract(test_package_paths):
+            result = self.get(build_url, test_package_names=['mochitest'],
+                              test_package_paths=test_package_paths)
+            self.assertTrue(result['success'])
+            tests_path = os.path.join(result['metadata']['dir'], 'tests')
+            extracted = []
+            for dirpath, dirnames, filenames in os.walk(tests_path):
+                for filename in filenames:
+                    extracted.append(os.path.relpath(
+                        os.path.join(dirpath, filename), tests_path))
+            return (sorted([(timing['name'], timing['extracted_size'] > 0)
+                            for timing in result['timings']]),
+                    sorted(extracted))
+
+        self.assertEqual(extract(['modules/']),
+                         ([('build', False), ('robocop', False),
+                           ('symbols', False),
+                           ('target.common.tests.zip', True),
+                           ('target.mochitest.tests.zip', True)],
+                          ['modules/common.py', 'modules/mochitest.py']))
+        # Only the difference is extracted, without downloading.
+        self.assertEqual(extract(['modules/', 'mochitest/']),
+                         ([('target.common.tests.zip', False),
+                           ('target.mochitest.tests.zip', True)],
+                          ['mochitest/runtests.py', 'modules/common.py',
+                           'modules/mochitest.py']))
+        self.assertEqual(extract(['mochitest/']), ([], [
+            'mochitest/runtests.py', 'modules/common.py',
+            'modules/mochitest.py']))
+        self.assertEqual(extract(None),
+                         ([('target.common.tests.zip', True),
+                           ('target.mochitest.tests.zip', False)],
+                          ['bin/xpcshell', 'mochitest/runtests.py',
+                           'modules/common.py', 'modules/mochitest.py']))
+        self.assertEqual(extract(['bin/']), ([], [
+            'bin/xpcshell', 'mochitest/runtests.py',
+            'modules/common.py', 'modules/mochitest.py']))
+        for zip_file in ('target.common.tests.zip',
+                         'target.mochitest.tests.zip'):
+            self.assertEqual(self.http_server.counts[
+                '/builds/1/' + zip_file], 1)
+
+    def test_dedupe(self):
+        self.start_build_cache_server(max_downloads=2)
+        build_cache = self.build_cache_server.build_cache
+        # Each build has its own apk but shares robocop, the symbols
+        # and the test packages with the others.
+        build_urls = [self.http_server.add_build(i) for i in range(4)]
+        for build_url in build_urls:
+            self.assertTrue(self.get(build_url,
+                                     test_package_names=['mochitest'])['success'])
+        build_paths = [os.path.join(build_cache.cache_dir,
+                                    build_cache.build_dir(build_url))
+                       for build_url in build_urls]
+        blobs_path = os.path.join(build_cache.cache_dir,
+                                  builds.BuildCache.BLOBS_DIR)
+
+        def blobs():
+            return sorted([filename for dirpath, dirnames, filenames in
+                           os.walk(blobs_path) for filename in filenames])
+
+        self.assertEqual(len(blobs()), 8)
+        robocop_stats = [os.stat(os.path.join(build_path, 'robocop.apk'))
+                         for build_path in build_paths]
+        self.assertEqual(len(set([stat.st_ino for stat in robocop_stats])), 1)
+        self.assertEqual(robocop_stats[0].st_nlink, 5)
+        logical, physical = build_cache.index.stats()
+        shared = sum([os.path.getsize(os.path.join(build_paths[0], name))
+                      for name in ('robocop.apk', 'symbols.zip',
+                                   'target.common.tests.zip',
+                                   'target.mochitest.tests.zip')])
+        self.assertEqual(logical - physical, 3 * shared)
+
+        # Expire all but the most recently used build.
+        build_cache.build_cache_size = 0
+        build_cache.build_cache_expires = -1
+        build_cache.clean_cache([build_cache.build_dir(build_urls[-1])])
+        self.assertEqual([os.path.exists(build_path)
+                          for build_path in build_paths],
+                         [False, False, False, True])
+        self.assertEqual(len(blobs()), 5)
+        self.assertEqual(os.stat(os.path.join(build_paths[-1],
+                                              'robocop.apk')).st_nlink, 2)
+        logical, physical = build_cache.index.stats()
+        self.assertEqual(logical, physical)
+        # The remaining build is still complete.
+        self.assertTrue(build_cache.is_cached(build_urls[-1],
+                                              enable_unittests=True,
+                                              test_package_names=['mochitest']))
+
+        build_cache.clean_cache()
+        self.assertEqual(blobs(), [])
+        self.assertEqual(build_cache.index.stats(), (0, 0))
+
+    def prefetch(self, schedule):
+        """Prefetch the builds in schedule, a list of tuples of the
+        arguments to BuildPrefetcher.schedule(), using one thread and
+        return the elapsed time."""
+        prefetcher = buildserver.BuildPrefetcher(
+            port=self.build_cache_server.server_address[1], num_threads=1)
+        for args in schedule:
+            prefetcher.schedule(*args)
+        start = time.time()
+        prefetcher.start()
+        try:
+            while not prefetcher.queue.empty():
+                time.sleep(0.05)
+        finally:
+            # Waits for the last prefetch to complete.
+            prefetcher.stop()
+        return time.time() - start
+
+    def test_prefetch_order(self):
+        self.start_build_cache_server(max_downloads=4)
+        build_urls = [self.http_server.add_build(i) for i in range(3)]
+        self.prefetch([(build_urls[0], 5),
+                       (build_urls[1], 2),
+                       (build_urls[2], 0),
+                       (build_urls[0], 1, True, set(['mochitest']))])
+        apk_paths = [build_url.replace(self.http_server.url, '')
+                     for build_url in build_urls]
+        self.assertEqual([path for path in self.http_server.requests
+                          if path in apk_paths],
+                         [apk_paths[2], apk_paths[0], apk_paths[1]])
+        # The merged request for build 0 fetched the test packages.
+        result = self.get(build_urls[0], test_package_names=['mochitest'])
+        self.assertTrue(result['success'])
+        self.assertTrue(os.path.exists(os.path.join(
+            result['metadata']['dir'], 'tests', 'mochitest', 'runtests.py')))
+        self.assertEqual(self.http_server.counts[
+            '/builds/0/target.mochitest.tests.zip'], 1)
+        self.assertEqual(self.apk_count(build_urls[0]), 1)
+
+    def test_prefetch_rate(self):
+        build_url = self.http_server.add_build(1)
+        # The apk and symbols are the artifacts downloaded when unit
+        # tests are not enabled.
+        size = sum(len(self.http_server.files['/builds/1/' + name])
+                   for name in ('target.apk',
+                                'target.crashreporter-symbols.zip'))
+        # Allow the first second's burst plus half of the rest.
+        self.start_build_cache_server(max_downloads=4,
+                                      prefetch_rate=size / 3)
+        elapsed = self.prefetch([(build_url, 0)])
+        self.assertTrue(elapsed > 1, 'elapsed %.1f' % elapsed)
+        # Worker requests are not rate limited.
+        build_url = self.http_server.add_build(2)
+        start = time.time()
+        self.assertTrue(self.get(build_url)['success'])
+        self.assertTrue(time.time() - start < 1)
+
+    def test_progress_events(self):
+        self.start_build_cache_server(max_downloads=4)
+        build_url = self.http_server.add_build(1, delay=0.5)
+        events = []
+        waiter_events = []
+        waiter = threading.Thread(target=self.get_with_progress,
+                                  args=(build_url, waiter_events))
+        client = buildserver.BuildCacheClient(
+            port=self.build_cache_server.server_address[1])
+        try:
+            request_id = client.submit('get', build_url=build_url)
+            # Wait until the download has started.
+            while not self.http_server.active:
+                time.sleep(0.05)
+            waiter.start()
+            result = client.receive(request_id, progress=events.append)
+        finally:
+            client.close()
+        waiter.join()
+        self.assertTrue(result['success'])
+        apk_size = len(self.http_server.files['/builds/1/target.apk'])
+        self.assertIn({'id': request_id, 'event': 'progress',
+                       'artifact': 'build', 'bytes': apk_size,
+                       'total': apk_size}, events)
+        # The concurrent request for the build received the progress
+        # of the download it waited for.
+        self.assertIn('build', [event['artifact'] for event in waiter_events])
+
+    def get_with_progress(self, build_url, events):
+        client = buildserver.BuildCacheClient(
+            port=self.build_cache_server.server_address[1])
+        try:
+            return client.get(build_url, progress=events.append)
+        finally:
+            client.close()
+
+    def test_pipelined_requests(self):
+        self.start_build_cache_server(max_downloads=4)
+        slow_url = self.http_server.add_build(1, delay=1)
+        fast_url = self.http_server.add_build(2)
+        client = buildserver.BuildCacheClient(
+            port=self.build_cache_server.server_address[1])
+        try:
+            slow_id = client.submit('get', build_url=slow_url)
+            fast_id = client.submit('prefetch', build_url=fast_url)
+            start = time.time()
+            self.assertTrue(client.receive(fast_id)['success'])
+            self.assertTrue(time.time() - start < 1)
+            self.assertTrue(client.receive(slow_id)['success'])
+            stats = client.stats()
+            self.assertTrue(stats['success'])
+            self.assertEqual(stats['stats']['requests'], 1)
+            self.assertEqual(stats['stats']['prefetches'], 1)
+            self.assertEqual(stats['stats']['downloads'], 2)
+            self.assertEqual(stats['stats']['builds'], 2)
+            result = client.receive(client.submit('unknown'))
+            self.assertFalse(result['success'])
+        finally:
+            client.close()
+
+    def test_version_1_requests(self):
+        self.start_build_cache_server(max_downloads=4)
+        build_url = self.http_server.add_build(1)
+        sock = socket.create_connection(
+            ('127.0.0.1', self.build_cache_server.server_address[1]))
+        rfile = sock.makefile('rb')
+        try:
+            sock.sendall('%s prefetch\n%s\n' % (build_url, build_url))
+            results = [json.loads(rfile.readline()) for i in range(2)]
+        finally:
+            rfile.close()
+            sock.close()
+        self.assertEqual([result['success'] for result in results],
+                         [True, True])
+        self.assertEqual(self.apk_count(build_url), 1)
+
+    def start_peer_server(self, build_cache):
+        """Serve the files of build_cache and return its host:port."""
+        peer_server = buildserver.BuildCachePeerServer(
+            ('127.0.0.1', 0), build_cache.cache_dir)
+        thread = threading.Thread(target=peer_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(peer_server.server_close)
+        self.addCleanup(peer_server.shutdown)
+        return '127.0.0.1:%d' % peer_server.server_address[1]
+
+    def test_peers(self):
+        build_url = self.http_server.add_build(1)
+        symbols_path = '/builds/1/target.crashreporter-symbols.zip'
+
+        def build_cache(name, peers):
+            return builds.BuildCache(
+                [REPO], ['opt'], 'fennec', ['android-api-16'], '.apk',
+                cache_dir=os.path.join(self.tmpdir, name), peers=peers)
+
+        cache_a = build_cache('a', [])
+        result = cache_a.get(build_url)
+        self.assertTrue(result['success'])
+        peer_a = self.start_peer_server(cache_a)
+        # A peer which is not running is skipped.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead_peer = '127.0.0.1:%d' % sock.getsockname()[1]
+        sock.close()
+
+        result = build_cache('b', [dead_peer, peer_a]).get(build_url)
+        self.assertTrue(result['success'])
+        self.assertEqual(self.apk_count(build_url), 1)
+        self.assertEqual(self.http_server.counts[symbols_path], 1)
+        self.assertEqual(sorted((timing['name'], timing['peer'])
+                                for timing in result['timings']),
+                         [('build', 'http://' + peer_a),
+                          ('symbols', 'http://' + peer_a)])
+
+        # A file which no longer matches the peer's recorded digest
+        # is downloaded from upstream.
+        apk_path = os.path.join(cache_a.cache_dir,
+                                cache_a.build_dir(build_url), 'fennec.apk')
+        with open(apk_path, 'r+b') as apk_file:
+            apk_file.write('X')
+        result = build_cache('c', [peer_a]).get(build_url)
+        self.assertTrue(result['success'])
+        self.assertEqual(self.apk_count(build_url), 2)
+        self.assertEqual(self.http_server.counts[symbols_path], 1)
+
+    def test_metadata_index(self):
+        build_url = self.http_server.add_build(1)
+        cache_dir = os.path.join(self.tmpdir, 'builds')
+        calls = []
+        get_build_data = utils.get_build_data
+
+        def counting_get_build_data(*args, **kwargs):
+            calls.append(args[0])
+            return get_build_data(*args, **kwargs)
+
+        def build_cache():
+            return builds.BuildCache(
+                [REPO], ['opt'], 'fennec', ['android-api-16'], '.apk',
+                cache_dir=cache_dir)
+
+        utils.get_build_data = counting_get_build_data
+        try:
+            result = build_cache().get(build_url)
+            self.assertTrue(result['success'])
+            self.assertEqual(calls, [build_url])
+            # Warm hits, including those of a new BuildCache, are
+            # answered from the index.
+            cache = build_cache()
+            self.assertTrue(cache.is_cached(build_url))
+            warm_result = cache.get(build_url)
+            self.assertEqual(warm_result['metadata'], result['metadata'])
+            self.assertEqual(calls, [build_url])
+            # A different apk at the same url is inspected again.
+            apk_path = os.path.join(cache_dir, cache.build_dir(build_url),
+                                    'fennec.apk')
+            utils.remove_digest(apk_path)
+            os.unlink(apk_path)
+            self.http_server.files['/builds/1/target.apk'] = zip_bytes({
+                'application.ini': '[App]\nVersion=56.0a1\n',
+                'package-name.txt': 'org.mozilla.fennec\n'})
+            self.assertFalse(cache.is_cached(build_url))
+            result = cache.get(build_url)
+            self.assertEqual(result['metadata']['version'], '56.0a1')
+            self.assertEqual(calls, [build_url] * 2)
+        finally:
+            utils.get_build_data = get_build_data
+
+    def test_scrub(self):
+        build_urls = [self.http_server.add_build(i) for i in range(2)]
+        cache = builds.BuildCache(
+            [REPO], ['opt'], 'fennec', ['android-api-16'], '.apk',
+            cache_dir=os.path.join(self.tmpdir, 'builds'))
+        for build_url in build_urls:
+            self.assertTrue(cache.get(build_url)['success'])
+        build_dirs = [cache.build_dir(build_url) for build_url in build_urls]
+        self.assertEqual(cache.scrub(), [])
+        # Corrupt the symbols shared by the builds without changing
+        # the size or modification time recorded for them.
+        symbols_path = os.path.join(cache.cache_dir, build_dirs[0],
+                                    'symbols.zip')
+        with open(symbols_path, 'r+b') as symbols_file:
+            symbols_file.write('X')
+        os.utime(symbols_path, (1000000000, 1000000000))
+        for build_dir in build_dirs:
+            record_path = os.path.join(cache.cache_dir, build_dir,
+                                       'symbols.zip' + utils.DIGEST_SUFFIX)
+            with open(record_path) as digest_file:
+                record = json.load(digest_file)
+            record['mtime'] = os.stat(symbols_path).st_mtime
+            with open(record_path, 'w') as digest_file:
+                json.dump(record, digest_file)
+        # Cache hits only check the recorded size and modification time.
+        self.assertTrue(cache.is_cached(build_urls[0]))
+        self.assertEqual(sorted(cache.scrub()), sorted(build_dirs))
+        for build_dir in build_dirs:
+            self.assertFalse(os.path.exists(
+                os.path.join(cache.cache_dir, build_dir)))
+            self.assertEqual(sorted(os.listdir(os.path.join(
+                cache.cache_dir, cache.QUARANTINE_DIR, build_dir))),
+                ['symbols.zip', 'symbols.zip' + utils.DIGEST_SUFFIX])
+        # The quarantine does not keep the blobs of the builds.
+        blobs_dir = os.path.join(cache.cache_dir, cache.BLOBS_DIR)
+        self.assertEqual([filenames for dirpath, dirnames, filenames
+                          in os.walk(blobs_dir) if filenames], [])
+        for i, build_url in enumerate(build_urls):
+            self.assertFalse(cache.is_cached(build_url))
+            self.assertTrue(cache.get(build_url)['success'])
+            self.assertEqual(self.apk_count(build_url), 2)
+            self.assertEqual(self.http_server.counts[
+                '/builds/%d/target.crashreporter-symbols.zip' % i], 2)
+        self.assertEqual(cache.scrub(), [])
+
+    def test_cache_hit_does_not_wait(self):
+        self.start_build_cache_server(max_downloads=1)
+        cached_url = self.http_server.add_build(1)
+        self.assertTrue(self.get(cached_url)['success'])
+        slow_url = self.http_server.add_build(2, delay=3)
+        slow_results = []
+        slow_thread = threading.Thread(target=self.get,
+                                       args=(slow_url, slow_results))
+        slow_thread.start()
+        # Wait until the slow download has started.
+        while not self.http_server.active:
+            time.sleep(0.05)
+        start = time.time()
+        self.assertTrue(self.get(cached_url)['success'])
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(self.apk_count(cached_url), 1)
+        slow_thread.join()
+        self.assertTrue(slow_results[0]['success'])
@@ -0,0 +1,221 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Tests for AutophoneCrashProcessor using a stand-in
+minidump_stackwalk which reads the machine readable output from the
+dump file itself and logs each symbolication and a stand-in device
+which keeps its files in a local directory.
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import autophonecrash
+import builds
+from autophonecrash import AutophoneCrashProcessor
+
+STACKWALK = """#!/bin/sh
+if [ "$1" = "-m" ]; then
+    cat "$2"
+else
+    echo "$1" >> "%(log)s"
+    echo "Thread 0 (crashed)"
+    echo " 0  libxul.so!$(grep '^Crash' "$1" | cut -d'|' -f3) [a.cpp : 1 + 0x0]"
+fi
+"""
+
+DUMP = """OS|Android|0.0.0
+Module|libxul.so||libxul.so|AAAA0|0xa0000000|0xa3ffffff|1
+Crash|SIGSEGV|%(address)s|0
+0|0|libxul.so||||%(offset)s
+1|0|libc.so||||0x10
+"""
+
+
+class FakeDevice(object):
+    """Stand-in for ADBDevice which records the commands it is sent
+    and keeps the remote files below root."""
+
+    def __init__(self, root):
+        self.root = root
+        self.calls = []
+
+    def local(self, path):
+        return os.path.join(self.root, path.replace('\\ ', ' ').lstrip('/'))
+
+    def ls_l(self, path):
+        path = self.local(path)
+        if not os.path.exists(path):
+            return ['ls: %s: No such file or directory' % path]
+        if os.path.isdir(path):
+            names = sorted(os.listdir(path))
+            paths = [os.path.join(path, name) for name in names]
+        else:
+            names = [os.path.basename(path)]
+            paths = [path]
+        lines = ['total %d' % len(names)]
+        for name, p in zip(names, paths):
+            lines.append('-rw-rw-rw- 1 system system %d 2017-06-01 12:00 %s' % (
+                os.path.getsize(p), name))
+        return lines
+
+    def shell_output(self, cmd, root=False):
+        self.calls.append('shell_output')
+        lines = []
+        for command in cmd[len("sh -c '"):-1].split('; '):
+            if command.startswith('echo '):
+                lines.append(command[len('echo '):])
+            elif command.startswith('ls -l '):
+                lines.extend(self.ls_l(command[len('ls -l '):]))
+        return '\n'.join(lines)
+
+    def get_logcat(self):
+        self.calls.append('get_logcat')
+        return []
+
+    def exists(self, path, root=False):
+        self.calls.append('exists')
+        return os.path.exists(self.local(path))
+
+    def is_dir(self, path, root=False):
+        self.calls.append('is_dir')
+        return os.path.isdir(self.local(path))
+
+    def chmod(self, path, recursive=False, mask='777', root=False):
+        self.calls.append('chmod')
+
+    def pull(self, remote, local):
+        self.calls.append('pull')
+        remote = self.local(remote)
+        for name in os.listdir(remote):
+            shutil.copy(os.path.join(remote, name), local)
+
+    def rm(self, path, recursive=False, force=False, root=False):
+        self.calls.append('rm')
+        path = self.local(path.rstrip('*'))
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                os.unlink(os.path.join(path, name))
+
+
+class CrashProcessorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.build_dir = os.path.join(self.tmpdir, 'build')
+        self.dump_dir = os.path.join(self.tmpdir, 'dumps')
+        self.upload_dir = os.path.join(self.tmpdir, 'upload')
+        for d in (self.build_dir, self.dump_dir, self.upload_dir):
+            os.mkdir(d)
+        self.symbols_path = os.path.join(self.build_dir, 'symbols')
+        os.mkdir(self.symbols_path)
+        self.log = os.path.join(self.tmpdir, 'stackwalk.log')
+        self.stackwalk = os.path.join(self.tmpdir, 'minidump_stackwalk')
+        with open(self.stackwalk, 'w') as f:
+            f.write(STACKWALK % {'log': self.log})
+        os.chmod(self.stackwalk, stat.S_IRWXU)
+        self.processor = AutophoneCrashProcessor(None, None, self.upload_dir,
+                                                 'org.mozilla.fennec')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_dumps(self, crashes):
+        dump_files = []
+        for i, (address, offset) in enumerate(crashes):
+            path = os.path.join(self.dump_dir, 'dump%d.dmp' % i)
+            with open(path, 'w') as f:
+                f.write(DUMP % {'address': address, 'offset': offset})
+            dump_files.append((path, os.path.splitext(path)[0] + '.extra'))
+        return dump_files
+
+    def symbolicated(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return [os.path.basename(line.strip()) for line in f]
+
+    def test_identical_dumps(self):
+        dump_files = self.write_dumps([('0x0', '0x100'),
+                                       ('0x4', '0x100'),
+                                       ('0x0', '0x100'),
+                                       ('0x0', '0x200')])
+        crashes = self.processor._process_dump_files(
+            dump_files, self.symbols_path, self.stackwalk)
+        self.assertEqual([crash['signature'] for crash in crashes],
+                         ['@ 0x0', '@ 0x4', '@ 0x0'])
+        self.assertIn('Identical crash dumps: dump2.dmp',
+                      crashes[0]['stackwalk_output'])
+        self.assertEqual(sorted(self.symbolicated()),
+                         ['dump0.dmp', 'dump1.dmp', 'dump3.dmp'])
+
+    def test_dump_file_limit(self):
+        self.processor.MAX_DUMP_FILES = 3
+        dump_files = self.write_dumps([('0x0', '0x100'),
+                                       ('0x0', '0x100'),
+                                       ('0x0', '0x100'),
+                                       ('0x4', '0x100'),
+                                       ('0x8', '0x100')])
+        crashes = self.processor._process_dump_files(
+            dump_files, self.symbols_path, self.stackwalk)
+        self.assertEqual([crash['signature'] for crash in crashes], ['@ 0x0'])
+        self.assertIn('Identical crash dumps: dump1.dmp, dump2.dmp',
+                      crashes[0]['stackwalk_output'])
+
+    def test_cached_results(self):
+        dump_files = self.write_dumps([('0x0', '0x100'), ('0x8', '0x300')])
+        first = self.processor._process_dump_files(
+            dump_files[:1], self.symbols_path, self.stackwalk)
+        second = self.processor._process_dump_files(
+            dump_files, self.symbols_path, self.stackwalk)
+        self.assertEqual(self.symbolicated(), ['dump0.dmp', 'dump1.dmp'])
+        self.assertEqual(second[0]['signature'], first[0]['signature'])
+        self.assertEqual(second[0]['stackwalk_output'],
+                         first[0]['stackwalk_output'])
+        self.assertEqual(second[1]['signature'], '@ 0x8')
+
+    def test_build_cache_index(self):
+        index = builds.BuildCacheIndex(self.tmpdir)
+        with open(os.path.join(self.symbols_path, 'libxul.so.sym'), 'w') as f:
+            f.write('x' * 100)
+        self.processor._process_dump_files(
+            self.write_dumps([('0x0', '0x100')]), self.symbols_path,
+            self.stackwalk)
+        sizes = dict([(build_dir, size)
+                      for build_dir, size, last_used in index.entries()])
+        self.assertEqual(sizes['build'], 100 + os.path.getsize(
+            os.path.join(self.build_dir, 'stackwalk.sqlite')))
+
+    def test_collect_only_changes(self):
+        device = FakeDevice(os.path.join(self.tmpdir, 'device'))
+        remote_dump_dir = os.path.join('/sdcard/profile', 'minidumps')
+        os.makedirs(device.local(remote_dump_dir))
+        os.makedirs(device.local(autophonecrash.TOMBSTONES))
+        processor = AutophoneCrashProcessor(device, '/sdcard/profile',
+                                            self.upload_dir,
+                                            'org.mozilla.fennec')
+        self.assertEqual(processor.get_errors(self.symbols_path,
+                                              self.stackwalk), [])
+        self.assertEqual(device.calls, ['shell_output'])
+
+        device.calls = []
+        with open(os.path.join(device.local(remote_dump_dir),
+                               'crash.dmp'), 'w') as f:
+            f.write(DUMP % {'address': '0x0', 'offset': '0x100'})
+        errors = processor.get_errors(self.symbols_path, self.stackwalk)
+        self.assertEqual([error['signature'] for error in errors], ['@ 0x0'])
+        self.assertEqual(device.calls, ['shell_output', 'chmod', 'pull', 'rm'])
+        self.assertEqual(os.listdir(device.local(remote_dump_dir)), [])
+
+        device.calls = []
+        self.assertEqual(processor.get_errors(self.symbols_path,
+                                              self.stackwalk), [])
+        self.assertEqual(device.calls, ['shell_output'])
+
+
+if __name__ == '__main__':
+    unittest.main()
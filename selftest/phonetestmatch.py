@@ -0,0 +1,225 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Tests and benchmark for the PhoneTest.match index.
+
+Run the benchmark with:
+
+    PYTHONPATH=. python selftest/phonetestmatch.py --benchmark [instances] [builds]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from phonetest import PhoneTest
+
+REPOS = ['mozilla-central', 'mozilla-inbound', 'autoland', 'try']
+PLATFORMS = ['android-api-16', 'android-api-15', 'android-x86']
+BUILD_TYPES = ['opt', 'debug']
+APP_NAMES = ['org.mozilla.fennec', 'org.mozilla.geckoview_example']
+SDKS = ['api-9', 'api-11', 'api-15', 'api-16']
+DIRS = ['mobile/android/', 'dom/media/', 'layout/', 'js/src/', 'gfx/',
+        'netwerk/', 'toolkit/', 'widget/android/', 'testing/', 'xpcom/']
+
+
+class Phone(object):
+    def __init__(self, phoneid, abi, supported_sdks):
+        self.id = phoneid
+        self.serial = phoneid
+        self.abi = abi
+        self.supported_sdks = supported_sdks
+
+    def __str__(self):
+        return self.id
+
+
+class Options(object):
+    buildtypes = BUILD_TYPES
+    platforms = PLATFORMS
+
+
+def linear_match(tests, test_name=None, phoneid=None, config_file=None,
+                 job_guid=None, repo=None, platform=None, app_name=None,
+                 build_type=None, build_abi=None, build_sdk=None,
+                 changeset_dirs=None):
+    """Reference implementation of PhoneTest.match which scans every
+    test."""
+    matches = []
+    for test in tests:
+        if test.run_if_changed and changeset_dirs:
+            if not [cd for cd in changeset_dirs for td in test.run_if_changed
+                    if cd == '' or cd.startswith(td)]:
+                continue
+        if test_name and test_name != test.name and \
+           '%s%s' % (test_name, test.name_suffix) != test.name:
+            continue
+        if phoneid and phoneid != test.phone.id:
+            continue
+        if config_file and config_file != test.config_file:
+            continue
+        if job_guid and job_guid != test.job_guid:
+            continue
+        if repo and test.repos and repo not in test.repos:
+            continue
+        if build_type and build_type not in test.buildtypes:
+            continue
+        if platform and platform not in test.platforms:
+            continue
+        if app_name and app_name not in test.app_names:
+            continue
+        if build_abi and build_abi not in test.phone.abi:
+            continue
+        if build_sdk and build_sdk not in test.phone.supported_sdks:
+            if not [sdk for sdk in build_sdk.split(',')
+                    if sdk in test.phone.supported_sdks]:
+                continue
+        matches.append(test)
+    return matches
+
+
+def create_tests(config_dir, num_tests, rng):
+    """Create num_tests PhoneTest instances spread over phones with 10
+    tests each, using a variety of configurations."""
+    tests = []
+    for i in range(num_tests):
+        config_file = os.path.join(config_dir, 'test-%d.ini' % (i % 10))
+        if not os.path.exists(config_file):
+            with open(config_file, 'w') as f:
+                f.write('[paths]\n')
+                f.write('dest = /data/local/tests/autophone/\n')
+                f.write('[builds]\n')
+                f.write('buildtypes = %s\n' % ' '.join(
+                    rng.sample(BUILD_TYPES, rng.randint(1, 2))))
+                f.write('platforms = %s\n' % ' '.join(
+                    rng.sample(PLATFORMS, rng.randint(1, 3))))
+                f.write('app_names = %s\n' % ' '.join(
+                    rng.sample(APP_NAMES, rng.randint(1, 2))))
+                if rng.random() < 0.5:
+                    f.write('[runtests]\n')
+                    f.write('run_if_changed = %s\n' % ', '.join(
+                        rng.sample(DIRS, 2)))
+        phoneid = 'phone-%d' % (i / 10)
+        phone = Phone(phoneid,
+                      rng.choice(['armeabi-v7a', 'arm64-v8a', 'x86']),
+                      ','.join(rng.sample(SDKS, 2)))
+        repos = rng.sample(REPOS, rng.randint(0, 2))
+        test = PhoneTest(phone=phone, options=Options(),
+                         config_file=config_file, repos=repos)
+        if rng.random() < 0.2:
+            test.job_guid = '%040x' % rng.getrandbits(160)
+        tests.append(test)
+    return tests
+
+
+def random_builds(num_builds, rng):
+    builds = []
+    for i in range(num_builds):
+        builds.append({
+            'app_name': rng.choice(APP_NAMES),
+            'repo': rng.choice(REPOS),
+            'platform': rng.choice(PLATFORMS),
+            'build_type': rng.choice(BUILD_TYPES),
+            'build_abi': rng.choice(['arm', 'x86']),
+            'build_sdk': rng.choice(SDKS),
+            'changeset_dirs': [d + 'file.cpp' for d in rng.sample(DIRS, 2)],
+        })
+    return builds
+
+
+def run_builds(match, builds):
+    """Match the tests for each build and then for each of the
+    matching phones the way AutoPhone.on_app_build and
+    AutoPhone.new_job do. Returns the number of matches."""
+    total = 0
+    for build in builds:
+        tests = match(**build)
+        for phoneid in set([test.phone.id for test in tests]):
+            total += len(match(tests=tests, phoneid=phoneid,
+                               app_name=build['app_name'],
+                               repo=build['repo'],
+                               platform=build['platform'],
+                               build_type=build['build_type'],
+                               build_abi=build['build_abi'],
+                               build_sdk=build['build_sdk']))
+    return total
+
+
+def remove_tests(tests):
+    for test in tests:
+        test.remove()
+
+
+class PhoneTestMatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.rng = random.Random(42)
+        self.tests = create_tests(self.config_dir, 100, self.rng)
+
+    def tearDown(self):
+        remove_tests(self.tests)
+        shutil.rmtree(self.config_dir)
+
+    def assertSameTests(self, a, b):
+        self.assertEqual(sorted(a, key=id), sorted(b, key=id))
+
+    def test_match_builds(self):
+        for build in random_builds(50, self.rng):
+            self.assertSameTests(PhoneTest.match(**build),
+                                 linear_match(self.tests, **build))
+
+    def test_match_phoneid_and_tests(self):
+        tests = PhoneTest.match(repo='try')
+        self.assertSameTests(PhoneTest.match(tests=tests, phoneid='phone-3'),
+                             linear_match(tests, phoneid='phone-3'))
+
+    def test_match_job_guid(self):
+        test = self.tests[7]
+        test.job_guid = 'a' * 40
+        self.assertEqual(PhoneTest.match(job_guid='a' * 40), [test])
+        test.job_guid = None
+        self.assertEqual(PhoneTest.match(job_guid='a' * 40), [])
+
+    def test_remove(self):
+        test = self.tests.pop()
+        test.remove()
+        self.assertFalse(test in PhoneTest.match(phoneid=test.phone.id))
+        self.assertSameTests(PhoneTest.match(), self.tests)
+
+
+def main():
+    num_tests = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    num_builds = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    config_dir = tempfile.mkdtemp()
+    rng = random.Random(42)
+    try:
+        tests = create_tests(config_dir, num_tests, rng)
+        builds = random_builds(num_builds, rng)
+        print '%d test instances, burst of %d builds' % (num_tests, num_builds)
+        start = time.time()
+        linear_total = run_builds(lambda **kwargs: linear_match(
+            kwargs.pop('tests', None) or tests, **kwargs), builds)
+        linear_elapsed = time.time() - start
+        start = time.time()
+        indexed_total = run_builds(PhoneTest.match, builds)
+        indexed_elapsed = time.time() - start
+        assert linear_total == indexed_total
+        print 'linear:  %.3f seconds' % linear_elapsed
+        print 'indexed: %.3f seconds' % indexed_elapsed
+        remove_tests(tests)
+    finally:
+        shutil.rmtree(config_dir)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--benchmark']:
+        del sys.argv[1]
+        main()
+    else:
+        unittest.main()
@@ -0,0 +1,137 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Tests for the local pushlog mirror using a stand-in for the
+version 2 json-pushes responses of hg.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import builds
+
+REPO = 'mozilla-central'
+
+
+class StandInPushlog(builds.Pushlog):
+    """Pushlog whose json-pushes requests are answered from pushes,
+    a dict mapping pushids to pushes, and fail once fail_after
+    requests have been made."""
+
+    def __init__(self, filename, **kwargs):
+        builds.Pushlog.__init__(self, filename, **kwargs)
+        self.pushes = {}
+        self.fetches = 0
+        self.fail_after = None
+
+    def add_push(self, date):
+        pushid = len(self.pushes) + 1
+        self.pushes[pushid] = {'date': int(date), 'user': 'user',
+                               'changesets': ['%040x' % pushid]}
+        return pushid
+
+    def _fetch(self, repo, parameters):
+        if self.fail_after is not None and self.fetches >= self.fail_after:
+            return None
+        self.fetches += 1
+        if 'startdate' in parameters:
+            start = time.mktime(time.strptime(parameters['startdate'],
+                                              '%Y-%m-%d %H:%M:%S'))
+            start -= time.timezone
+            pushes = dict([(str(pushid), push)
+                           for pushid, push in self.pushes.iteritems()
+                           if push['date'] >= start])
+        else:
+            pushes = dict([(str(pushid), push)
+                           for pushid, push in self.pushes.iteritems()
+                           if parameters['startID'] < pushid <= parameters['endID']])
+        return pushes, max(self.pushes.keys() or [0])
+
+
+class PushlogMirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pushlog = StandInPushlog(os.path.join(self.tmpdir,
+                                                   'pushlog.sqlite'))
+        self.now = int(time.time())
+        self.pushlog.add_push(self.now - 3600)
+        self.pushlog.add_push(self.now - 1800)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def synced(self):
+        return self.pushlog._query('select synced from mirrors where repo=?',
+                                   (REPO,))[0][0]
+
+    def age_mirror(self, seconds):
+        """Move the last sync of the mirror seconds into the past."""
+        conn = self.pushlog._conn()
+        conn.execute('update mirrors set synced=synced-? where repo=?',
+                     (seconds, REPO))
+        conn.commit()
+        conn.close()
+
+    def test_get_pushes(self):
+        pushes = self.pushlog.get_pushes(REPO, self.now - 7200, self.now - 60)
+        self.assertEqual([push[0] for push in pushes], [1, 2])
+        # A query made once a sync is due syncs the mirror first.
+        self.pushlog.add_push(time.time())
+        self.age_mirror(120)
+        pushes = self.pushlog.get_pushes(REPO, self.now - 7200,
+                                         int(time.time()))
+        self.assertEqual([push[0] for push in pushes], [1, 2, 3])
+
+    def test_end_date_after_sync(self):
+        self.pushlog.sync(REPO)
+        fetches = self.pushlog.fetches
+        # A query for the rest of the day is answered from the current
+        # mirror without fetching json-pushes.
+        pushes = self.pushlog.get_pushes(REPO, self.now - 7200,
+                                         self.now + 24*60*60)
+        self.assertEqual([push[0] for push in pushes], [1, 2])
+        self.assertEqual(self.pushlog.fetches, fetches)
+
+    def test_unknown_repo(self):
+        self.assertEqual(self.pushlog.get_pushes('unknown', self.now - 7200,
+                                                 self.now - 60), None)
+        self.assertEqual(self.pushlog.fetches, 0)
+
+    def test_sync_failure(self):
+        self.assertEqual(len(self.pushlog.get_pushes(REPO, self.now - 7200,
+                                                     self.now - 60)), 2)
+        self.pushlog.add_push(time.time())
+        self.pushlog.fail_after = self.pushlog.fetches
+        self.age_mirror(120)
+        # Once a sync is due, a failed sync is not answered from the
+        # mirror at all.
+        self.assertEqual(self.pushlog.get_pushes(REPO, self.now - 7200,
+                                                 self.now - 60), None)
+        self.assertEqual(self.pushlog.get_pushes(REPO, self.now - 7200,
+                                                 int(time.time())), None)
+
+    def test_partial_sync_is_stale(self):
+        self.pushlog.sync(REPO)
+        self.age_mirror(120)
+        synced = self.synced()
+        self.pushlog.BATCH_SIZE = 1
+        self.pushlog.add_push(time.time())
+        self.pushlog.add_push(time.time())
+        self.pushlog.fail_after = self.pushlog.fetches + 1
+        self.assertFalse(self.pushlog.sync(REPO, force=True))
+        self.assertEqual(self.synced(), synced)
+        self.assertEqual(self.pushlog.get_pushes(REPO, self.now - 7200,
+                                                 int(time.time())), None)
+        self.pushlog.fail_after = None
+        pushes = self.pushlog.get_pushes(REPO, self.now - 7200,
+                                         int(time.time()))
+        self.assertEqual([push[0] for push in pushes], [1, 2, 3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
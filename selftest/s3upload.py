@@ -0,0 +1,304 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Tests and benchmark for S3Bucket.upload using a local stand-in for S3.
+
+Run the benchmark with:
+
+    PYTHONPATH=. python selftest/s3upload.py --benchmark [size-in-mb]
+"""
+
+import BaseHTTPServer
+import SocketServer
+import gzip
+import hashlib
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+
+from cStringIO import StringIO
+
+import s3
+
+BUCKET = 'autophone-selftest'
+
+
+class FakeS3Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Minimal in-memory S3 implementation supporting the requests made
+    by S3Bucket.upload: bucket and key HEADs, object PUTs and multipart
+    uploads."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeS3Handler)
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.headers = {}
+        self.uploads = {}
+        self.next_upload_id = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _parse(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query, keep_blank_values=True)
+        parts = url.path.lstrip('/').split('/', 1)
+        key = parts[1] if len(parts) > 1 else ''
+        return parts[0], key, query
+
+    def _respond(self, status, body='', headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_HEAD(self):
+        bucket, key, query = self._parse()
+        if bucket != BUCKET:
+            self._respond(404)
+        elif not key:
+            self._respond(200)
+        elif key in self.server.objects:
+            self._respond(200, headers=self.server.headers[key])
+        else:
+            self._respond(404)
+
+    def do_GET(self):
+        bucket, key, query = self._parse()
+        if key in self.server.objects:
+            self._respond(200, self.server.objects[key],
+                          self.server.headers[key])
+        else:
+            self._respond(404)
+
+    def do_PUT(self):
+        bucket, key, query = self._parse()
+        body = self._read_body()
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        with self.server.lock:
+            if 'uploadId' in query:
+                upload = self.server.uploads[query['uploadId'][0]]
+                upload['parts'][int(query['partNumber'][0])] = body
+            else:
+                self.server.objects[key] = body
+                self.server.headers[key] = {
+                    'Content-Type': self.headers.get('Content-Type', ''),
+                    'Content-Encoding': self.headers.get('Content-Encoding', ''),
+                    'ETag': etag}
+        self._respond(200, headers={'ETag': etag})
+
+    def do_POST(self):
+        bucket, key, query = self._parse()
+        self._read_body()
+        with self.server.lock:
+            if 'uploads' in query:
+                self.server.next_upload_id += 1
+                upload_id = 'upload-%d' % self.server.next_upload_id
+                self.server.uploads[upload_id] = {
+                    'parts': {},
+                    'headers': {
+                        'Content-Type': self.headers.get('Content-Type', ''),
+                        'Content-Encoding': self.headers.get('Content-Encoding', '')}}
+                body = ('<?xml version="1.0" encoding="UTF-8"?>'
+                        '<InitiateMultipartUploadResult>'
+                        '<Bucket>%s</Bucket><Key>%s</Key>'
+                        '<UploadId>%s</UploadId>'
+                        '</InitiateMultipartUploadResult>' %
+                        (bucket, key, upload_id))
+            else:
+                upload = self.server.uploads.pop(query['uploadId'][0])
+                parts = upload['parts']
+                self.server.objects[key] = ''.join(
+                    [parts[part_num] for part_num in sorted(parts)])
+                self.server.headers[key] = upload['headers']
+                body = ('<?xml version="1.0" encoding="UTF-8"?>'
+                        '<CompleteMultipartUploadResult>'
+                        '<Location>http://127.0.0.1/%s/%s</Location>'
+                        '<Bucket>%s</Bucket><Key>%s</Key>'
+                        '<ETag>"%d-parts"</ETag>'
+                        '</CompleteMultipartUploadResult>' %
+                        (bucket, key, bucket, key, len(parts)))
+        self._respond(200, body, {'Content-Type': 'application/xml'})
+
+    def do_DELETE(self):
+        bucket, key, query = self._parse()
+        with self.server.lock:
+            self.server.uploads.pop(query.get('uploadId', [None])[0], None)
+        self._respond(204)
+
+
+def write_test_file(path, size):
+    """Write size bytes of compressible, log-like data to path."""
+    rng = random.Random(size)
+    words = ['INFO', 'DEBUG', 'TEST-PASS', 'TEST-UNEXPECTED-FAIL', 'adb',
+             'shell', 'org.mozilla.fennec', 'Gecko', '%d' % size]
+    written = 0
+    with open(path, 'wb') as f:
+        while written < size:
+            line = '%08x %s\n' % (rng.getrandbits(32),
+                                  ' '.join(rng.sample(words, 5)))
+            f.write(line)
+            written += len(line)
+
+
+def create_bucket(server, **kwargs):
+    return s3.S3Bucket(BUCKET, 'access-key', 'secret-key',
+                       host='127.0.0.1', port=server.server_address[1],
+                       is_secure=False, **kwargs)
+
+
+class S3UploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = FakeS3Server()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _upload(self, name, size, **kwargs):
+        path = os.path.join(self.tmpdir, name)
+        write_test_file(path, size)
+        bucket = create_bucket(self.server, **kwargs)
+        url = bucket.upload(path, 'logs/%s' % name)
+        self.assertTrue(url.endswith('logs/%s' % name))
+        uploaded = gzip.GzipFile(
+            fileobj=StringIO(self.server.objects['logs/%s' % name])).read()
+        with open(path, 'rb') as f:
+            self.assertEqual(uploaded, f.read())
+        return self.server.headers['logs/%s' % name]
+
+    def test_single_part_upload(self):
+        headers = self._upload('single.log', 64 * 1024)
+        self.assertEqual(headers['Content-Type'], 'text/plain')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+
+    def test_multipart_upload(self):
+        headers = self._upload('multi.log', 4 * 1024 * 1024,
+                               part_size=64 * 1024, part_threads=3)
+        self.assertEqual(headers['Content-Type'], 'text/plain')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(self.server.uploads, {})
+
+    def test_part_uploader_connection_failure(self):
+        path = os.path.join(self.tmpdir, 'connect.log')
+        write_test_file(path, 1024 * 1024)
+        bucket = create_bucket(self.server, part_size=64 * 1024,
+                               part_threads=2)
+        bucket.bucket
+
+        def connect():
+            raise socket.error('connection refused')
+        bucket._connect = connect
+        results = []
+
+        def upload():
+            try:
+                bucket.upload(path, 'logs/connect.log')
+            except s3.S3Error, e:
+                results.append(e)
+        thread = threading.Thread(target=upload)
+        thread.daemon = True
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(results), 1)
+        self.assertIn('connection refused', str(results[0]))
+        self.assertEqual(self.server.uploads, {})
+
+    def test_upload_index(self):
+        path = os.path.join(self.tmpdir, 'tombstone_00.txt')
+        write_test_file(path, 16 * 1024)
+        index = s3.S3UploadIndex(os.path.join(self.tmpdir, 'uploads.sqlite'))
+        bucket = create_bucket(self.server, upload_index=index)
+        url1 = bucket.upload(path, 'guid1/tombstone_00.txt')
+        url2 = bucket.upload(path, 'guid2/tombstone_00.txt')
+        self.assertEqual(url1, url2)
+        self.assertEqual(self.server.objects.keys(), ['guid1/tombstone_00.txt'])
+        savings = index.savings()
+        self.assertEqual(len(savings), 1)
+        self.assertEqual(savings[0][1:], (1, os.path.getsize(path)))
+        # Expired entries are uploaded again.
+        index.ttl = 0
+        url3 = bucket.upload(path, 'guid3/tombstone_00.txt')
+        self.assertNotEqual(url1, url3)
+
+
+def _benchmark_upload(port, path, part_threads, results):
+    bucket = s3.S3Bucket(BUCKET, 'access-key', 'secret-key',
+                         host='127.0.0.1', port=port, is_secure=False,
+                         part_size=s3.S3Bucket.PART_SIZE,
+                         part_threads=part_threads)
+    start = time.time()
+    bucket.upload(path, 'benchmark/%d.log' % part_threads)
+    elapsed = time.time() - start
+    # ru_maxrss is reported in kilobytes on Linux.
+    results.put((elapsed,
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    tmpdir = tempfile.mkdtemp()
+    server = FakeS3Server()
+    try:
+        path = os.path.join(tmpdir, 'benchmark.log')
+        write_test_file(path, size_mb * 1024 * 1024)
+        print 'Uploading %d MB to %s:%d' % (size_mb, server.server_address[0],
+                                            server.server_address[1])
+        for part_threads in (1, 2, s3.S3Bucket.PART_THREADS, 8):
+            # Each upload runs in a fresh process so that its peak
+            # resident set size is not inflated by earlier uploads.
+            results = multiprocessing.Queue()
+            proc = multiprocessing.Process(
+                target=_benchmark_upload,
+                args=(server.server_address[1], path, part_threads, results))
+            proc.start()
+            elapsed, maxrss = results.get()
+            proc.join()
+            print ('part_threads %d: %.1f MB/s, peak RSS %.1f MB' %
+                   (part_threads, size_mb / elapsed, maxrss / 1024.0))
+            server.objects.clear()
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--benchmark']:
+        del sys.argv[1]
+        main()
+    else:
+        unittest.main()
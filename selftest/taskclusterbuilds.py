@@ -0,0 +1,297 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Tests and benchmark for TaskClusterBuilds build discovery using a
+local stand-in serving recorded Taskcluster, Treeherder and hg
+responses.
+
+Run the benchmark with:
+
+    PYTHONPATH=. python selftest/taskclusterbuilds.py --benchmark [revisions] [latency-ms]
+"""
+
+import BaseHTTPServer
+import SocketServer
+import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib
+import uuid
+
+import requests
+import slugid
+
+import builds
+import metadatacache
+import utils
+
+REPO = 'autoland'
+BUILD_PLATFORMS = ['android-api-16', 'android-x86']
+BUILD_TYPES = ['opt', 'debug']
+# (platform, build_type) of the tasks indexed for each revision. The
+# last is not one of the BUILD_PLATFORMS.
+TASKS = [('android-api-16', 'opt'), ('android-api-16', 'debug'),
+         ('android-x86', 'opt'), ('android-api-16-gradle', 'opt')]
+
+
+def record_responses(num_revisions, rng):
+    """Return a tuple of the revisions and a dict mapping request paths
+    to the recorded response bodies for the builds of the revisions."""
+    responses = {}
+    revisions = []
+    pushdate = datetime.datetime(2017, 6, 1, tzinfo=builds.UTC)
+    for i in range(num_revisions):
+        revision = '%040x' % rng.getrandbits(160)
+        revisions.append(revision)
+        pushdate += datetime.timedelta(minutes=10)
+        pushdate_str = pushdate.strftime('%Y%m%d%H%M%S')
+        namespace = 'gecko.v2.%s.revision.%s.mobile' % (REPO, revision)
+        tasks = []
+        for platform, build_type in TASKS:
+            task_id = slugid.encode(uuid.UUID(int=rng.getrandbits(128)))
+            tasks.append({'taskId': task_id,
+                          'namespace': '%s.%s-%s' % (namespace, platform,
+                                                     build_type)})
+            responses['/queue/v1/task/%s' % task_id] = {
+                'workerType': platform,
+                'metadata': {'name': 'build-%s/%s' % (platform, build_type)},
+                'routes': [
+                    'index.gecko.v2.%s.pushdate.%s.%s.mobile.%s-%s' % (
+                        REPO, pushdate.strftime('%Y.%m.%d'), pushdate_str,
+                        platform, build_type),
+                    'index.gecko.v2.%s.revision.%s.mobile.%s-%s' % (
+                        REPO, revision, platform, build_type)]}
+            responses['/queue/v1/task/%s/status' % task_id] = {
+                'status': {'taskId': task_id,
+                           'workerType': platform,
+                           'runs': [{'runId': 0, 'state': 'completed'}]}}
+            responses['/queue/v1/task/%s/runs/0/artifacts' % task_id] = {
+                'artifacts': [{'name': 'public/build/target.apk'},
+                              {'name': 'public/build/target.json'},
+                              {'name': 'public/logs/live_backing.log'}]}
+            job_guid = builds.get_treeherder_job_guid(task_id, 0)
+            responses['/api/project/%s/jobs/?job_guid=%s' % (
+                REPO, urllib.quote(job_guid, safe=''))] = {
+                    'results': [{'job_guid': job_guid, 'tier': 1}]}
+        responses['/index/v1/tasks/%s' % namespace] = {'tasks': tasks}
+        responses['/hg/%s/json-pushes?changeset=%s' % (REPO, revision)] = {
+            str(i): {'changesets': [revision], 'date': 0}}
+        responses['/hg/%s/raw-rev/%s' % (REPO, revision)] = (
+            '--- a/mobile/android/base/file.java\n'
+            '+++ b/mobile/android/base/file.java\n')
+    return revisions, responses
+
+
+class RecordedResponseServer(SocketServer.ThreadingMixIn,
+                             BaseHTTPServer.HTTPServer):
+    """Serve the recorded responses after waiting latency seconds."""
+
+    daemon_threads = True
+
+    def __init__(self, responses, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           RecordedResponseHandler)
+        self.responses = responses
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class RecordedResponseHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency)
+        body = self.server.responses.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        if not isinstance(body, basestring):
+            body = json.dumps(body)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInClient(object):
+    """Minimal Taskcluster Queue and Index and Treeherder client making
+    the requests used by TaskClusterBuilds to the stand-in server."""
+
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+
+    def _get(self, path):
+        r = self.session.get(self.url + path)
+        r.raise_for_status()
+        return r.json()
+
+    def listTasks(self, namespace, payload):
+        return self._get('/index/v1/tasks/%s' % namespace)
+
+    def task(self, task_id):
+        return self._get('/queue/v1/task/%s' % task_id)
+
+    def status(self, task_id):
+        return self._get('/queue/v1/task/%s/status' % task_id)
+
+    def listArtifacts(self, task_id, run_id, query=None):
+        return self._get('/queue/v1/task/%s/runs/%s/artifacts' % (task_id,
+                                                                  run_id))
+
+    def get_jobs(self, project, job_guid=None):
+        return self._get('/api/project/%s/jobs/?job_guid=%s' % (
+            project, urllib.quote(job_guid, safe='')))['results']
+
+
+class StandIn(object):
+    """Direct the Taskcluster, Treeherder and hg requests made by
+    TaskClusterBuilds to a RecordedResponseServer and give each
+    discovery a cold metadata cache."""
+
+    def __init__(self, responses, latency=0):
+        self.server = RecordedResponseServer(responses, latency)
+        self.tmpdir = tempfile.mkdtemp()
+        self.runs = 0
+        self.clients = threading.local()
+        self.saved = (metadatacache.taskcluster_queue,
+                      metadatacache.taskcluster_index,
+                      metadatacache.treeherder_client,
+                      metadatacache._METADATA_CACHE,
+                      utils.CHANGESET_DIRS_DB,
+                      builds.REPO_URLS[REPO])
+        metadatacache.taskcluster_queue = self.client
+        metadatacache.taskcluster_index = self.client
+        metadatacache.treeherder_client = self.client
+        builds.REPO_URLS[REPO] = '%s/hg/%s/' % (self.server.url, REPO)
+
+    def client(self):
+        if not hasattr(self.clients, 'client'):
+            self.clients.client = StandInClient(self.server.url)
+        return self.clients.client
+
+    def reset(self):
+        self.runs += 1
+        metadatacache._METADATA_CACHE = metadatacache.MetadataCache(
+            os.path.join(self.tmpdir, 'metadata-%d.sqlite' % self.runs))
+        utils.CHANGESET_DIRS_DB = os.path.join(
+            self.tmpdir, 'changeset_dirs-%d.sqlite' % self.runs)
+        utils._changeset_dirs_cache.clear()
+        self.server.requests = 0
+
+    def stop(self):
+        (metadatacache.taskcluster_queue,
+         metadatacache.taskcluster_index,
+         metadatacache.treeherder_client,
+         metadatacache._METADATA_CACHE,
+         utils.CHANGESET_DIRS_DB,
+         builds.REPO_URLS[REPO]) = self.saved
+        utils._changeset_dirs_cache.clear()
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+
+def discover(stand_in, revisions, discovery_threads):
+    """Return the task ids and builds for the revisions found using
+    discovery_threads threads and the elapsed time."""
+    stand_in.reset()
+    location = builds.TaskClusterBuilds([REPO], BUILD_TYPES, 'fennec',
+                                        BUILD_PLATFORMS, '.apk', False,
+                                        discovery_threads=discovery_threads)
+    start = time.time()
+    task_ids_by_repo = location._find_task_ids_by_revisions({REPO: revisions})
+    builds_by_repo = location._find_builds_by_task_ids(task_ids_by_repo)
+    elapsed = time.time() - start
+    return task_ids_by_repo[REPO], builds_by_repo[REPO], elapsed
+
+
+class TaskClusterBuildsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.revisions, responses = record_responses(5, random.Random(42))
+        self.stand_in = StandIn(responses)
+
+    def tearDown(self):
+        self.stand_in.stop()
+
+    def test_discovery_preserves_order(self):
+        serial_task_ids, serial_builds, elapsed = discover(
+            self.stand_in, self.revisions, 1)
+        self.assertEqual(len(serial_task_ids),
+                         len(self.revisions) * (len(TASKS) - 1))
+        self.assertEqual([build['revision'] for build in serial_builds],
+                         [revision for revision in self.revisions
+                          for i in range(len(TASKS) - 1)])
+        task_ids, pooled_builds, elapsed = discover(
+            self.stand_in, self.revisions, 4)
+        self.assertEqual(task_ids, serial_task_ids)
+        self.assertEqual(pooled_builds, serial_builds)
+
+    def test_incomplete_artifacts_not_cached(self):
+        self.stand_in.reset()
+        responses = self.stand_in.server.responses
+        path = [path for path in responses
+                if path.endswith('/runs/0/artifacts')][0]
+        task_id = path.split('/')[4]
+        artifacts = responses[path]
+        responses[path] = {}
+        self.assertEqual(list(utils.taskcluster_artifacts(task_id, 0)), [])
+        self.assertEqual(
+            metadatacache.metadata_cache().get(
+                metadatacache.MetadataKind.ARTIFACTS, '%s/0' % task_id),
+            None)
+        responses[path] = artifacts
+        self.assertEqual(list(utils.taskcluster_artifacts(task_id, 0)),
+                         artifacts['artifacts'])
+
+
+def main():
+    num_revisions = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.02
+    revisions, responses = record_responses(num_revisions, random.Random(42))
+    stand_in = StandIn(responses, latency)
+    try:
+        print ('%d revisions, %d tasks per revision, %.0f ms latency' %
+               (num_revisions, len(TASKS), latency * 1000))
+        serial = None
+        for discovery_threads in (1, 4, builds.TaskClusterBuilds.DISCOVERY_THREADS, 16):
+            task_ids, found, elapsed = discover(stand_in, revisions,
+                                                discovery_threads)
+            if serial is None:
+                serial = (task_ids, found)
+            assert (task_ids, found) == serial
+            print ('discovery_threads %2d: %d requests, %d builds, %.2f seconds' %
+                   (discovery_threads, stand_in.server.requests, len(found),
+                    elapsed))
+    finally:
+        stand_in.stop()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--benchmark']:
+        del sys.argv[1]
+        main()
+    else:
+        unittest.main()
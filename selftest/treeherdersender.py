@@ -0,0 +1,177 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Tests for the dispatch of queued Treeherder submissions by
+AutophoneTreeherder.serve_forever using a stand-in Treeherder client.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from thclient import TreeherderJobCollection
+
+import jobs
+from autophonetreeherder import AutophoneTreeherder
+from options import AutophoneOptions
+
+
+class StandInClient(object):
+    """Record the job guids of each post and fail the posts for which
+    respond returns an exception."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.posts = []
+        self.respond = lambda project, guids: None
+
+    def post_collection(self, project, job_collection):
+        guids = [tj.data['job']['job_guid'] for tj in job_collection.data]
+        with self.lock:
+            self.posts.append((project, guids))
+        e = self.respond(project, guids)
+        if e:
+            raise e
+
+
+class StandInResponse(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def json(self):
+        return {}
+
+
+class StandInError(Exception):
+
+    def __init__(self, status_code=None):
+        Exception.__init__(self, 'status %s' % status_code)
+        if status_code:
+            self.response = StandInResponse(status_code)
+
+
+class StandInTreeherder(AutophoneTreeherder):
+
+    def __init__(self, options, jobs, client):
+        AutophoneTreeherder.__init__(self, None, options, jobs)
+        self.stand_in_client = client
+
+    @property
+    def client(self):
+        return self.stand_in_client
+
+
+class TreeherderSenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        # Jobs keeps its database in the current directory.
+        os.chdir(self.tmpdir)
+        self.jobs = jobs.Jobs(None)
+        self.client = StandInClient()
+        options = AutophoneOptions()
+        options.treeherder_url = 'http://treeherder.invalid'
+        options.treeherder_retry_wait = 60
+        options.treeherder_coalesce_max_age = 60
+        options.treeherder_circuit_failures = 2
+        self.treeherder = StandInTreeherder(options, self.jobs, self.client)
+        self.thread = None
+
+    def tearDown(self):
+        if self.thread:
+            self.treeherder.shutdown()
+            self.thread.join()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.treeherder.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def queue(self, project, guid):
+        tjc = TreeherderJobCollection()
+        tj = tjc.get_job()
+        tj.add_project(project)
+        tj.add_job_guid(guid)
+        tjc.add(tj)
+        self.treeherder.queue_request('machine', project, tjc)
+
+    def wait_for(self, predicate, timeout=10):
+        start = time.time()
+        while not predicate():
+            if time.time() - start > timeout:
+                self.fail('timed out waiting for %s' % self.client.posts)
+            time.sleep(0.1)
+
+    def test_post_without_waiting(self):
+        self.queue('mozilla-central', 'guid1')
+        self.queue('mozilla-central', 'guid2')
+        self.start()
+        self.wait_for(lambda: len(self.client.posts) == 1)
+        self.queue('mozilla-central', 'guid3')
+        self.wait_for(lambda: len(self.client.posts) == 2)
+        # Neither post waited coalesce_max_age seconds and the
+        # submissions queued together were posted together.
+        self.assertEqual(self.client.posts,
+                         [('mozilla-central', ['guid1', 'guid2']),
+                          ('mozilla-central', ['guid3'])])
+        self.assertEqual(self.jobs.get_treeherder_queues(), [])
+
+    def test_rejected_submission_is_parked(self):
+        self.client.respond = lambda project, guids: (
+            StandInError(400) if 'bad' in guids else None)
+        self.queue('mozilla-central', 'bad')
+        self.queue('mozilla-central', 'good1')
+        self.queue('mozilla-central', 'bad')
+        self.queue('mozilla-central', 'good2')
+        self.start()
+        self.wait_for(lambda: len(self.client.posts) == 4)
+        time.sleep(2)
+        # The rejected batch is retried one submission at a time. The
+        # rejected submission and the later state of its job are
+        # parked while the rest of the project is posted.
+        self.assertEqual(self.client.posts,
+                         [('mozilla-central', ['bad', 'good1']),
+                          ('mozilla-central', ['bad']),
+                          ('mozilla-central', ['good1']),
+                          ('mozilla-central', ['good2'])])
+        self.assertEqual(len(self.treeherder.parked), 1)
+        self.assertEqual(self.treeherder.backoff, {})
+        self.assertEqual(self.treeherder.consecutive_failures, 0)
+        self.assertEqual(self.jobs.get_treeherder_queues(),
+                         [('mozilla-central', 2, 3)])
+
+    def test_server_failures_open_circuit(self):
+        self.client.respond = lambda project, guids: StandInError(503)
+        self.queue('autoland', 'guid1')
+        self.queue('mozilla-inbound', 'guid2')
+        self.start()
+        self.wait_for(lambda: len(self.client.posts) == 2)
+        # Each failing project is backed off and the second
+        # consecutive failure opens the circuit which holds the
+        # submissions of every project.
+        self.assertEqual(sorted(self.treeherder.backoff),
+                         ['autoland', 'mozilla-inbound'])
+        self.assertTrue(self.treeherder.circuit_open_until > time.time())
+        self.queue('mozilla-central', 'guid3')
+        time.sleep(2)
+        self.assertEqual(len(self.client.posts), 2)
+        # Once the circuit's wait expires a single post is let through
+        # and its success closes the circuit.
+        self.client.respond = lambda project, guids: None
+        with self.treeherder.lock:
+            self.treeherder.circuit_open_until = 0
+        self.wait_for(lambda: len(self.client.posts) == 3)
+        self.assertEqual(self.client.posts[2], ('mozilla-central', ['guid3']))
+        self.assertEqual(self.treeherder.consecutive_failures, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,9 +7,7 @@ import csv
 import json
 import os
 import re
-import time
 import urllib
-import urllib2
 import urlparse
 from math import sqrt
 
@@ -279,58 +277,44 @@ class PerfTest(PhoneTest):
         else:
             encoded_result = json.dumps(result)
             content_type = 'application/json; charset=utf-8'
-        req = urllib2.Request(self._resulturl + 'add/', encoded_result,
-                              {'Content-Type': content_type})
-        max_attempts = 10
-        wait_time = 10
-        for attempt in range(1, max_attempts+1):
-            try:
-                f = urllib2.urlopen(req)
-                f.read()
-                f.close()
-                return
-            except Exception, e:
-                # Retry submission if the exception is due to a
-                # timeout and if we haven't exceeded the maximum
-                # number of attempts.
-                if attempt < max_attempts:
-                    self.loggerdeco.warning('PerfTest.publish_results: '
-                                            'Attempt %d/%d error %s sending '
-                                            'results to server' % (
-                                                attempt, max_attempts,
-                                                e))
-                    time.sleep(wait_time)
-                    continue
-                self.loggerdeco.exception('Error sending results to server')
-                self.worker_subprocess.mailer.send(
-                    '%s attempt %s/%s Error sending %s results for phone %s, '
-                    'build %s' % (utils.host(), attempt, max_attempts,
-                                  self.name, self.phone.id, self.build.id),
-                    'There was an error attempting to send test results '
-                    'to the result server %s.\n'
-                    '\n'
-                    'Host       %s\n'
-                    'Job        %s\n'
-                    'Test       %s\n'
-                    'Phone      %s\n'
-                    'Repository %s\n'
-                    'Build      %s\n'
-                    'Revision   %s\n'
-                    'Exception  %s\n'
-                    'Result     %s\n' %
-                    (self.result_server,
-                     utils.host(),
-                     self.job_url,
-                     self.name,
-                     self.phone.id,
-                     self.build.tree,
-                     self.build.id,
-                     self.build.changeset,
-                     e,
-                     json.dumps(resultdata, sort_keys=True, indent=2)))
-                message = 'Error sending results to phonedash server'
-                self.add_failure(self.name, TestStatus.TEST_UNEXPECTED_FAIL,
-                                 message, TreeherderStatus.EXCEPTION)
+        # Failed submissions are retried with backoff by HttpSessions.
+        http_sessions = utils.http_sessions()
+        try:
+            r = http_sessions.post(self._resulturl + 'add/',
+                                   data=encoded_result,
+                                   headers={'Content-Type': content_type})
+            r.raise_for_status()
+        except Exception, e:
+            self.loggerdeco.exception('Error sending results to server')
+            self.worker_subprocess.mailer.send(
+                '%s Error sending %s results for phone %s, build %s '
+                'after %s attempts' % (utils.host(), self.name, self.phone.id,
+                                       self.build.id, http_sessions.attempts),
+                'There was an error attempting to send test results '
+                'to the result server %s.\n'
+                '\n'
+                'Host       %s\n'
+                'Job        %s\n'
+                'Test       %s\n'
+                'Phone      %s\n'
+                'Repository %s\n'
+                'Build      %s\n'
+                'Revision   %s\n'
+                'Exception  %s\n'
+                'Result     %s\n' %
+                (self.result_server,
+                 utils.host(),
+                 self.job_url,
+                 self.name,
+                 self.phone.id,
+                 self.build.tree,
+                 self.build.id,
+                 self.build.changeset,
+                 e,
+                 json.dumps(resultdata, sort_keys=True, indent=2)))
+            message = 'Error sending results to phonedash server'
+            self.add_failure(self.name, TestStatus.TEST_UNEXPECTED_FAIL,
+                             message, TreeherderStatus.EXCEPTION)
 
     def dump_results(self, starttime=0, tstrt=0, tstop=0,
                      testname='', cache_enabled=True,
@@ -14,11 +14,16 @@ import subprocess
 import tempfile
 import time
 import traceback
+import urllib
 
 from phonetest import PhoneTest, TreeherderStatus, TestStatus, FLASH_PACKAGE
 
 
 class UnitTest(PhoneTest):
+    # Test package members used by all of the harnesses.
+    HARNESS_PATHS = ['bin/', 'certs/', 'config/', 'modules/', 'mozbase/',
+                     'mozinfo.json', 'tools/']
+
     def __init__(self, dm=None, phone=None, options=None,
                  config_file=None, chunk=1, repos=[]):
         PhoneTest.__init__(self, dm=dm, phone=phone, options=options,
@@ -76,6 +81,21 @@ class UnitTest(PhoneTest):
     def get_test_package_names(self):
         return set(self.parms['test_packages'])
 
+    def get_test_package_paths(self):
+        """Return None to extract the test packages completely unless
+        the runtests section of the config lists the
+        test_package_paths needed by the test in which case return
+        them along with the harness support directories and the
+        directory containing the test manifest."""
+        if not self.cfg.has_option('runtests', 'test_package_paths'):
+            return None
+        paths = set(self.cfg.get('runtests', 'test_package_paths').split())
+        paths.update(self.HARNESS_PATHS)
+        manifest_dir = os.path.dirname(self.parms['test_manifest'])
+        if manifest_dir:
+            paths.add(manifest_dir + '/')
+        return paths
+
     def setup_job(self):
         PhoneTest.setup_job(self)
         # Remove the AutophoneCrashProcessor set in PhoneTest.setup_job
@@ -85,6 +105,11 @@ class UnitTest(PhoneTest):
         symbols_path = self.build.symbols
         if symbols_path and not os.path.exists(symbols_path):
             symbols_path = None
+        elif symbols_path and symbols_path.endswith('.zip'):
+            # The harness only accepts a symbols directory or a url
+            # to a symbols zip file which it extracts if a crash
+            # occurs.
+            symbols_path = 'file://' + urllib.pathname2url(symbols_path)
 
         # Check that the device is accessible and that its network is up.
         ping_msg = self.worker_subprocess.ping(test=self, require_ip_address=True)
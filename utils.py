@@ -4,6 +4,9 @@
 
 # get_remote_content modelled on treeherder/etc/common.py
 
+import collections
+import email.utils
+import hashlib
 import json
 import logging
 import math
@@ -12,18 +15,25 @@ import os
 import os.path
 import random
 import re
+import socket
+import sqlite3
 import sys
+import threading
 import time
 import traceback
 import urlparse
 import uuid
 
+from multiprocessing.pool import ThreadPool
+
 import requests
+from requests.packages.urllib3.exceptions import ProtocolError, ReadTimeoutError
 
 import taskcluster
 
 import build_dates
 import builds
+import metadatacache
 
 from sensitivedatafilter import SensitiveDataFilter
 
@@ -73,6 +83,173 @@ def getLogger(name=None):
 
     return logger
 
+
+class HttpSessions(object):
+    """Per process registry of requests Sessions, one for each host, so
+    that connections to the same few hosts are kept alive and reused.
+
+    Requests which fail with a connection error, a timeout or one of
+    RETRY_STATUSES are retried up to attempts times with an
+    exponential backoff of backoff_base * 2**attempt seconds, at most
+    backoff_max, with full jitter. A server's Retry-After is honored
+    if it asks for a longer wait, up to backoff_max.
+
+    The number of requests, failures and retries and the time to the
+    response headers are recorded for each host.
+    """
+
+    ATTEMPTS = 6
+    BACKOFF_BASE = 2
+    BACKOFF_MAX = 120
+    POOL_SIZE = 10
+    TIMEOUT = 60
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, attempts=ATTEMPTS, backoff_base=BACKOFF_BASE,
+                 backoff_max=BACKOFF_MAX, pool_size=POOL_SIZE,
+                 timeout=TIMEOUT):
+        self.attempts = attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pid = None
+        self.sessions = {}
+        self.stats = {}
+
+    def session(self, url):
+        """Return the Session for the host of url."""
+        host = urlparse.urlparse(url).netloc
+        with self.lock:
+            # Sessions and their connections can not be shared with
+            # the worker processes forked from this one.
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.sessions = {}
+                self.stats = {}
+            if host not in self.sessions:
+                session = requests.Session()
+                session.headers['user-agent'] = 'autophone'
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[host] = session
+                self.stats[host] = {'requests': 0, 'failures': 0,
+                                    'retries': 0, 'time': 0.0,
+                                    'max_time': 0.0}
+            return self.sessions[host]
+
+    def _record(self, host, elapsed, failed=False, retried=False):
+        with self.lock:
+            stats = self.stats.get(host)
+            if stats is None:
+                return
+            stats['requests'] += 1
+            stats['time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            if failed:
+                stats['failures'] += 1
+            if retried:
+                stats['retries'] += 1
+
+    def backoff(self, attempt, response=None):
+        """Return the number of seconds to wait before retrying after
+        attempt failed with response. The wait is at most
+        backoff_max seconds whatever the server's Retry-After."""
+        delay = random.uniform(0, min(self.backoff_max,
+                                      self.backoff_base * 2**attempt))
+        retry_after = None
+        if response is not None:
+            retry_after = response.headers.get('retry-after')
+        if retry_after:
+            try:
+                delay = max(delay, int(retry_after))
+            except ValueError:
+                date = email.utils.parsedate_tz(retry_after)
+                if date:
+                    delay = max(delay, email.utils.mktime_tz(date) - time.time())
+        return min(delay, self.backoff_max)
+
+    def request(self, method, url, **kwargs):
+        """Return the requests Response for the request, retrying
+        failed requests. The final failed response is returned while
+        the final connection error or timeout is raised."""
+        logger = getLogger()
+        host = urlparse.urlparse(url).netloc
+        session = self.session(url)
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            last_attempt = attempt == self.attempts - 1
+            start = time.time()
+            response = error = None
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout), error:
+                pass
+            failed = error is not None or \
+                     response.status_code in self.RETRY_STATUSES
+            self._record(host, time.time() - start, failed=failed,
+                         retried=failed and not last_attempt)
+            if not failed:
+                return response
+            if last_attempt:
+                if error:
+                    raise error
+                return response
+            delay = self.backoff(attempt, response)
+            logger.warning('HttpSessions: %s %s: attempt %d/%d: %s: '
+                           'retrying in %.1f seconds',
+                           method, url, attempt + 1, self.attempts,
+                           error or response.status_code, delay)
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def report(self):
+        response = ''
+        with self.lock:
+            for host in sorted(self.stats):
+                stats = self.stats[host]
+                response += ('%s: %d requests, %d failures, %d retries, '
+                             '%.3f mean seconds, %.3f max seconds\n' % (
+                                 host, stats['requests'], stats['failures'],
+                                 stats['retries'],
+                                 stats['time'] / max(1, stats['requests']),
+                                 stats['max_time']))
+        return response
+
+
+_HTTP_SESSIONS = None
+
+
+def http_sessions():
+    """Return the process wide HttpSessions."""
+    global _HTTP_SESSIONS
+
+    if not _HTTP_SESSIONS:
+        _HTTP_SESSIONS = HttpSessions()
+    return _HTTP_SESSIONS
+
+
+def configure_http_sessions(**kwargs):
+    """Replace the process wide HttpSessions with one created with
+    kwargs."""
+    global _HTTP_SESSIONS
+
+    _HTTP_SESSIONS = HttpSessions(**kwargs)
+    return _HTTP_SESSIONS
+
+
 def get_remote_text(url):
     """Return the string containing the contents of a remote url if the
     request is successful, otherwise return None.
@@ -88,18 +265,11 @@ def get_remote_text(url):
             with local_file:
                 return local_file.read()
 
-        while True:
-            r = requests.get(url, headers={'user-agent': 'autophone'})
-            if r.ok:
-                return r.text
-            elif r.status_code != 503:
-                logger.warning("Unable to open url %s : %s",
-                               url, r.reason)
-                return None
-            # Server is too busy. Wait and try again.
-            # See https://bugzilla.mozilla.org/show_bug.cgi?id=1146983#c10
-            logger.warning("HTTP 503 Server Too Busy: url %s", url)
-            time.sleep(60 + random.randrange(0, 30, 1))
+        r = http_sessions().get(url)
+        if r.ok:
+            return r.text
+        logger.warning("Unable to open url %s : %s",
+                       url, r.reason)
     except Exception:
         logger.exception('Unable to open %s', url)
 
@@ -414,11 +584,140 @@ def get_build_data(build_url, builder_type='taskcluster'):
     return build_data
 
 
+# Changesets are immutable, so the directories changed by each
+# changeset are cached in CHANGESET_DIRS_DB which is shared by all of
+# the Autophone processes and in an in-memory LRU of the
+# CHANGESET_DIRS_CACHE_SIZE most recently used changesets.
+CHANGESET_DIRS_DB = 'changeset_dirs.sqlite'
+CHANGESET_DIRS_THREADS = 8
+CHANGESET_DIRS_CACHE_SIZE = 1000
+_changeset_dirs_cache = collections.OrderedDict()
+_changeset_dirs_lock = threading.Lock()
+
+
+def _remember_changeset_dirs(changeset_dirs):
+    with _changeset_dirs_lock:
+        for changeset, dirs in changeset_dirs.iteritems():
+            _changeset_dirs_cache.pop(changeset, None)
+            _changeset_dirs_cache[changeset] = dirs
+        while len(_changeset_dirs_cache) > CHANGESET_DIRS_CACHE_SIZE:
+            _changeset_dirs_cache.popitem(last=False)
+
+
+def _changeset_dirs_conn():
+    conn = sqlite3.connect(CHANGESET_DIRS_DB, timeout=30)
+    conn.execute('create table if not exists changeset_dirs ('
+                 'changeset text primary key, '
+                 'dirs text)')
+    return conn
+
+
+def get_cached_changeset_dirs(changesets):
+    """Return a dict mapping each of the changesets whose directories
+    have been cached to the list of its directories."""
+    logger = getLogger()
+    cached = {}
+    missing = []
+    with _changeset_dirs_lock:
+        for changeset in changesets:
+            dirs = _changeset_dirs_cache.pop(changeset, None)
+            if dirs is None:
+                missing.append(changeset)
+            else:
+                cached[changeset] = _changeset_dirs_cache[changeset] = dirs
+    if not missing:
+        return cached
+    found = {}
+    conn = None
+    try:
+        conn = _changeset_dirs_conn()
+        for changeset in missing:
+            row = conn.execute('select dirs from changeset_dirs '
+                               'where changeset=?', (changeset,)).fetchone()
+            if row:
+                found[changeset] = json.loads(row[0])
+    except sqlite3.Error:
+        logger.exception('get_cached_changeset_dirs')
+    finally:
+        if conn:
+            conn.close()
+    _remember_changeset_dirs(found)
+    cached.update(found)
+    return cached
+
+
+def cache_changeset_dirs(changeset_dirs):
+    """Cache the dict changeset_dirs mapping changesets to the list of
+    their directories."""
+    logger = getLogger()
+    _remember_changeset_dirs(changeset_dirs)
+    conn = None
+    try:
+        conn = _changeset_dirs_conn()
+        conn.executemany('insert or replace into changeset_dirs values (?, ?)',
+                         [(changeset, json.dumps(dirs))
+                          for changeset, dirs in changeset_dirs.iteritems()])
+        conn.commit()
+    except sqlite3.Error:
+        logger.exception('cache_changeset_dirs')
+    finally:
+        if conn:
+            conn.close()
+
+
+def get_diff_dirs(url):
+    """Return the list of directories changed by the diff at url or
+    None if the diff could not be retrieved.
+
+    The diff is read a line at a time and only the file headers are
+    inspected so that the diff is never held in memory.
+    """
+    logger = getLogger()
+
+    def parse(lines):
+        dirs = set()
+        for line in lines:
+            if line.startswith('#') or line.find('/dev/null') != -1:
+                continue
+            if line.startswith('+++ b/') or line.startswith('--- a/'):
+                # skip markers, space and leading slash
+                path = os.path.dirname(line[6:].rstrip('\r\n'))
+                # Note that if the changeset was due to a
+                # change in a top level file or tagging of a
+                # branch, then path will be empty which will
+                # result in all directory restricted tests
+                # running which is alright.
+                dirs.add(path)
+        return list(dirs)
+
+    try:
+        parse_result = urlparse.urlparse(url)
+        if not parse_result.scheme or parse_result.scheme.startswith('file'):
+            with open(parse_result.path) as local_file:
+                return parse(local_file)
+
+        r = http_sessions().get(url, stream=True)
+        try:
+            if r.ok:
+                return parse(r.iter_lines())
+            logger.warning("Unable to open url %s : %s",
+                           url, r.reason)
+        finally:
+            r.close()
+    except Exception:
+        logger.exception('Unable to open %s', url)
+
+    return None
+
+
 def get_changeset_dirs(changeset_url, max_changesets=32):
     """Return a list of the directories changed in this changeset.
 
     If the number of changesets exceeds max_changesets, return []
     which will match any directory defined for a test.
+
+    The diffs of the changesets which have not already been cached
+    are retrieved concurrently.
     """
     logger = getLogger()
     url = changeset_url.replace('rev/', 'json-pushes?changeset=')
@@ -428,7 +727,7 @@ def get_changeset_dirs(changeset_url, max_changesets=32):
         logger.debug('get_changeset_dirs: Could not find pushlog at %s', url)
         return []
 
-    dirs_set = set()
+    all_changesets = []
     for pushid in pushlog:
         logger.debug('get_changeset_dirs: %s: pushid %s', changeset_url, pushid)
         try:
@@ -449,35 +748,44 @@ def get_changeset_dirs(changeset_url, max_changesets=32):
             logger.debug('get_changeset_dirs: Exception getting changesets: %s',
                          traceback.format_exc())
             continue
+        all_changesets.extend(changesets)
+
+    changeset_dirs = get_cached_changeset_dirs(all_changesets)
+    missing = [changeset for changeset in all_changesets
+               if changeset not in changeset_dirs]
+    logger.debug('get_changeset_dirs: %s: %d cached, %d missing',
+                 changeset_url, len(changeset_dirs), len(missing))
+    if missing:
+        #TODO: When Bug 1286353 is fixed, use json-rev for this,
+        #      as this requires retrieving and scanning the whole
+        #      diff.
         base_url = os.path.dirname(changeset_url).replace('rev', 'raw-rev')
-        for changeset in changesets:
-            #TODO: When Bug 1286353 is fixed, use json-rev for this,
-            #      as this requires retrieving and scanning the whole
-            #      diff.
-            url = os.path.join(base_url, changeset)
-            logger.debug('get_changeset_dirs: diff url: %s', url)
-            diff = get_remote_text(url)
-            if diff:
-                for line in diff.splitlines():
-                    if line.startswith('#') or line.find('/dev/null') != -1:
-                        continue
-                    if line.startswith('+++ b/') or line.startswith('--- a/'):
-                        # skip markers, space and leading slash
-                        path = os.path.dirname(line[6:])
-                        # Note that if the changeset was due to a
-                        # change in a top level file or tagging of a
-                        # branch, then path will be empty which will
-                        # result in all directory restricted tests
-                        # running which is alright.
-                        dirs_set.add(path)
-            else:
+        urls = [os.path.join(base_url, changeset) for changeset in missing]
+        pool = ThreadPool(min(len(urls), CHANGESET_DIRS_THREADS))
+        try:
+            results = pool.map(get_diff_dirs, urls)
+        finally:
+            pool.close()
+            pool.join()
+        retrieved = {}
+        for changeset, url, dirs in zip(missing, urls, results):
+            if dirs is None:
                 logger.debug('get_changeset_dirs: Could not find diff for '
                              'revision %s at %s', changeset, url)
-                # We return an empty list here to force the test to be
-                # run, in case the missing diff here contained files
-                # we care about.
-                return []
+            else:
+                retrieved[changeset] = dirs
+        if retrieved:
+            cache_changeset_dirs(retrieved)
+        if len(retrieved) < len(missing):
+            # We return an empty list here to force the test to be
+            # run, in case the missing diff here contained files
+            # we care about.
+            return []
+        changeset_dirs.update(retrieved)
 
+    dirs_set = set()
+    for dirs in changeset_dirs.itervalues():
+        dirs_set.update(dirs)
     dirs = list(dirs_set)
     logger.debug('get_changeset_dirs: %s', dirs)
     return dirs
@@ -560,74 +868,267 @@ def host():
     return os.uname()[1]
 
 
-def urlretrieve(url, dest, max_attempts=3):
+class DownloadError(IOError):
+    pass
+
+
+# Bounds on the size of the chunks read by urlretrieve. The chunk size
+# doubles while chunks arrive quickly and halves when they are slow.
+DOWNLOAD_MIN_CHUNK = 64*1024
+DOWNLOAD_MAX_CHUNK = 4*1024*1024
+DIGEST_SUFFIX = '.sha256'
+
+
+class RateLimiter(object):
+    """Token bucket limiting the combined rate at which the threads
+    sharing it consume bytes to bytes_per_second, allowing bursts of
+    up to one second's worth of bytes."""
+
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        self.lock = threading.Lock()
+        self.allowance = self.rate
+        self.last = time.time()
+
+    def consume(self, nbytes):
+        """Account for nbytes and sleep until they fit the rate."""
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate,
+                                 self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= nbytes
+            wait = -self.allowance / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def _expected_download(response):
+    """Return the expected size and sha256 of the content of the
+    response from the Taskcluster artifact metadata if present."""
+    size = response.headers.get('x-amz-meta-content-length')
+    if size is None and not response.headers.get('content-encoding'):
+        size = response.headers.get('content-length')
+    sha256 = response.headers.get('x-amz-meta-content-sha256')
+    return (int(size) if size is not None else None), sha256
+
+
+def urlretrieve(url, dest, max_attempts=3, rate_limiter=None, progress=None):
     """Downloads the contents of url to the path dest while handling
     partial downloads by retrying the download up to max_attempts
-    times.
+    times. Returns the sha256 hex digest of the contents.
+
+    Failed requests are already retried by HttpSessions, so only a
+    download which fails after its response was received is retried
+    here.
+
+    Retries resume from the end of the partial download using a Range
+    request if the server supports it. If the response carries the
+    size or sha256 of the artifact, such as Taskcluster's
+    x-amz-meta-content-length and x-amz-meta-content-sha256, the
+    download is verified against them and DownloadError is raised if
+    it does not match.
 
     :param url: url to be downloaded.
     :param dest: path where to save downloaded content.
     :param max_attempts: maximum number of attempts to retry partial
         downloads. Defaults to 3.
+    :param rate_limiter: optional object whose consume(nbytes) method
+        is called after each chunk is received to limit the download
+        rate, e.g. a RateLimiter.
+    :param progress: optional callable called after each chunk is
+        received with the number of bytes received and the total
+        number of bytes expected or None if it is not known.
     """
     logger = getLogger()
 
     parse_result = urlparse.urlparse(url)
     if not parse_result.scheme or parse_result.scheme.startswith('file'):
-        local_file = open(parse_result.path)
+        sha256 = hashlib.sha256()
+        local_file = open(parse_result.path, 'rb')
         with local_file:
             with open(dest, 'wb') as dest_file:
                 while True:
-                    chunk = local_file.read(4096)
+                    chunk = local_file.read(DOWNLOAD_MAX_CHUNK)
                     if not chunk:
                         break
+                    sha256.update(chunk)
                     dest_file.write(chunk)
-            return
-
-    for attempt in range(max_attempts):
-        try:
-            r = requests.get(url, stream=True)
-            if not r.ok:
-                r.raise_for_status()
-            with open(dest, 'wb') as dest_file:
-                for chunk in r.iter_content(chunk_size=4096):
-                    dest_file.write(chunk)
-            break
-        except requests.HTTPError, http_error:
-            logger.info("urlretrieve(%s, %s) %s", url, dest, http_error)
-            raise
-        except (requests.ConnectionError, requests.Timeout), e:
-            logger.warning("utils.urlretrieve: %s: Attempt %s: %s",
-                           url, attempt, e)
-            if attempt == max_attempts - 1:
+        return sha256.hexdigest()
+
+    sha256 = hashlib.sha256()
+    received = 0
+    expected_size = expected_sha256 = total = None
+    with open(dest, 'wb') as dest_file:
+        for attempt in range(max_attempts):
+            headers = {}
+            if received:
+                headers['Range'] = 'bytes=%d-' % received
+            r = None
+            try:
+                r = http_sessions().get(url, stream=True, headers=headers)
+                try:
+                    if not r.ok:
+                        r.raise_for_status()
+                    if r.status_code == 206 and not r.headers.get(
+                            'content-range', '').startswith('bytes %d-' % received):
+                        received = 0
+                        raise requests.ConnectionError(
+                            'unexpected Content-Range %s' %
+                            r.headers.get('content-range'))
+                    if r.status_code != 206:
+                        if received:
+                            logger.info('urlretrieve: %s: restarting download '
+                                        'at %d bytes', url, received)
+                        sha256 = hashlib.sha256()
+                        received = 0
+                        dest_file.seek(0)
+                        dest_file.truncate()
+                        expected_size, expected_sha256 = _expected_download(r)
+                        total = expected_size
+                        if (total is None and
+                            not r.headers.get('content-encoding') and
+                            r.headers.get('content-length')):
+                            total = int(r.headers['content-length'])
+                    chunk_size = DOWNLOAD_MIN_CHUNK
+                    while True:
+                        start = time.time()
+                        chunk = r.raw.read(chunk_size, decode_content=True)
+                        if not chunk:
+                            break
+                        sha256.update(chunk)
+                        dest_file.write(chunk)
+                        received += len(chunk)
+                        elapsed = time.time() - start
+                        if elapsed < 0.1:
+                            chunk_size = min(chunk_size*2, DOWNLOAD_MAX_CHUNK)
+                        elif elapsed > 1:
+                            chunk_size = max(chunk_size/2, DOWNLOAD_MIN_CHUNK)
+                        if rate_limiter:
+                            rate_limiter.consume(len(chunk))
+                        if progress:
+                            progress(received, total)
+                finally:
+                    r.close()
+                if expected_size is not None and received < expected_size:
+                    raise requests.ConnectionError(
+                        'received %d of %d bytes' % (received, expected_size))
+                break
+            except requests.HTTPError, http_error:
+                logger.info("urlretrieve(%s, %s) %s", url, dest, http_error)
                 raise
+            except (requests.ConnectionError, requests.Timeout,
+                    ProtocolError, ReadTimeoutError, socket.error), e:
+                logger.warning("utils.urlretrieve: %s: Attempt %s: %s",
+                               url, attempt, e)
+                if r is None or attempt == max_attempts - 1:
+                    raise
+                # Resume from the end of the partial download unless
+                # the content was encoded since the Range would then
+                # apply to the encoded content.
+                if r is not None and r.headers.get('content-encoding'):
+                    received = 0
+
+    digest = sha256.hexdigest()
+    if expected_size is not None and received != expected_size:
+        raise DownloadError('urlretrieve: %s: received %d bytes, expected %d' %
+                            (url, received, expected_size))
+    if expected_sha256 and digest != expected_sha256:
+        raise DownloadError('urlretrieve: %s: sha256 %s, expected %s' %
+                            (url, digest, expected_sha256))
+    return digest
+
+
+def record_digest(path, digest):
+    """Record the sha256 digest, size and modification time of the
+    file at path in a sidecar file so that it need not be verified
+    again."""
+    stat = os.stat(path)
+    with open(path + DIGEST_SUFFIX, 'w') as digest_file:
+        json.dump({'sha256': digest, 'size': stat.st_size,
+                   'mtime': stat.st_mtime}, digest_file)
+
+
+def get_recorded_digest(path):
+    """Return the sha256 digest recorded for the file at path or None
+    if there is no record or the file no longer has the recorded size
+    and modification time."""
+    try:
+        with open(path + DIGEST_SUFFIX) as digest_file:
+            record = json.load(digest_file)
+        stat = os.stat(path)
+        if (record['size'] == stat.st_size and
+            record.get('mtime', stat.st_mtime) == stat.st_mtime):
+            return record['sha256']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def file_digest(path):
+    """Return the sha256 hex digest of the contents of the file at
+    path."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(DOWNLOAD_MAX_CHUNK)
+            if not chunk:
+                break
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def remove_digest(path):
+    if os.path.exists(path + DIGEST_SUFFIX):
+        os.unlink(path + DIGEST_SUFFIX)
 
 
 def get_taskcluster_task_definition(task_id):
-    queue = taskcluster.queue.Queue()
-    task_definition = queue.task(task_id)
-    return task_definition
+    return metadatacache.metadata_cache().memoize(
+        metadatacache.MetadataKind.TASK_DEFINITION, task_id,
+        lambda: metadatacache.taskcluster_queue().task(task_id))
 
 
-def taskcluster_artifacts(task_id, run_id):
+def get_taskcluster_task_status(task_id):
+    return metadatacache.metadata_cache().memoize(
+        metadatacache.MetadataKind.TASK_STATUS, task_id,
+        lambda: metadatacache.taskcluster_queue().status(task_id))
+
+
+def _list_taskcluster_artifacts(task_id, run_id):
+    """Return the list of the artifacts of the run of the task or
+    None if a response is missing its artifacts so that an incomplete
+    listing is not cached."""
     logger = getLogger()
-    queue = taskcluster.queue.Queue()
+    queue = metadatacache.taskcluster_queue()
+    artifacts = []
     response = queue.listArtifacts(task_id, run_id)
     while True:
         if 'artifacts' not in response:
             logger.warning('taskcluster_artifacts: listArtifacts(%s, %s) '
                            'response missing artifacts', task_id, run_id)
-            raise StopIteration
-        artifacts = response['artifacts']
-        for artifact in artifacts:
-            logger.debug('taskcluster_artifacts: %s', artifact)
-            yield artifact
+            return None
+        artifacts.extend(response['artifacts'])
         if 'continuationToken' not in response:
-            raise StopIteration
+            break
         logger.debug('taskcluster_artifacts: continuing listArtifacts(%s, %s)',
                      task_id, run_id)
         response = queue.listArtifacts(task_id, run_id, {
-            'continuationToken': response['continationToken']})
+            'continuationToken': response['continuationToken']})
+    return artifacts
+
+
+def taskcluster_artifacts(task_id, run_id):
+    """Generate the artifacts of the run of the task. The artifacts
+    of a run are cached and should only be requested for completed
+    runs."""
+    logger = getLogger()
+    artifacts = metadatacache.metadata_cache().memoize(
+        metadatacache.MetadataKind.ARTIFACTS, '%s/%s' % (task_id, run_id),
+        lambda: _list_taskcluster_artifacts(task_id, run_id))
+    for artifact in artifacts or []:
+        logger.debug('taskcluster_artifacts: %s', artifact)
+        yield artifact
 
 _AUTOPHONE_PATH = None
 
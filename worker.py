@@ -30,7 +30,7 @@ from logdecorator import LogDecorator
 from phonestatus import PhoneStatus
 from phonetest import PhoneTest, TreeherderStatus, TestStatus, FLASH_PACKAGE
 from process_states import ProcessStates
-from s3 import S3Bucket
+from s3 import S3Bucket, S3UploadIndex
 
 class Crashes(object):
 
@@ -75,6 +75,70 @@ class PhoneTestMessage(object):
         return s
 
 
+class PhoneWorkerStatus(object):
+    """Immutable copy of the status of a PhoneWorker which can be
+    reported by threads other than the one processing the worker's
+    messages without locking."""
+
+    def __init__(self, worker):
+        self.phoneid = worker.phone.id
+        self.serial = worker.phone.serial
+        self.state = worker.state
+        self.debug = worker.options.debug
+        self.last_status = None
+        self.last_status_phone_status = None
+        self.last_status_timestamp = None
+        self.build_id = None
+        self.build_tree = None
+        self.first_status_timestamp = None
+        self.previous_status = None
+        self.previous_status_timestamp = None
+        last_status_msg = worker.last_status_msg
+        if last_status_msg:
+            # The timestamp of last_status_msg is updated in place by
+            # heartbeats so it is copied separately.
+            self.last_status = last_status_msg.short_desc()
+            self.last_status_phone_status = last_status_msg.phone_status
+            self.last_status_timestamp = last_status_msg.timestamp
+            if last_status_msg.build:
+                self.build_id = last_status_msg.build.id
+                self.build_tree = last_status_msg.build.tree
+            self.first_status_timestamp = worker.first_status_of_type.timestamp
+        if worker.last_status_of_previous_type:
+            self.previous_status = worker.last_status_of_previous_type.short_desc()
+            self.previous_status_timestamp = worker.last_status_of_previous_type.timestamp
+
+    def report(self):
+        response = ''
+        now = datetime.datetime.now(tz=pytz.utc).replace(microsecond=0)
+        response += 'phone %s (%s):\n' % (self.phoneid, self.serial)
+        response += '  state %s\n' % self.state
+        response += '  debug level %d\n' % self.debug
+        if not self.last_status:
+            response += '  no updates\n'
+        else:
+            if self.build_id:
+                d = self.build_id
+                d = '%s-%s-%s %s:%s:%s' % (d[0:4], d[4:6], d[6:8],
+                                           d[8:10], d[10:12], d[12:14])
+                response += '  current build: %s %s\n' % (
+                    d,
+                    self.build_tree)
+            else:
+                response += '  no build loaded\n'
+            response += '  last update %s ago:\n    %s\n' % (
+                now - self.last_status_timestamp,
+                self.last_status)
+            response += '  %s for %s\n' % (
+                self.last_status_phone_status,
+                now - self.first_status_timestamp)
+            if self.previous_status:
+                response += '  previous state %s ago:\n    %s\n' % (
+                    now - self.previous_status_timestamp,
+                    self.previous_status)
+        return response
+
+
 class PhoneWorker(object):
 
     """Runs tests on a single phone in a separate process.
@@ -203,34 +267,10 @@ class PhoneWorker(object):
             self.last_status_msg = msg
 
     def status(self):
-        response = ''
-        now = datetime.datetime.now(tz=pytz.utc).replace(microsecond=0)
-        response += 'phone %s (%s):\n' % (self.phone.id, self.phone.serial)
-        response += '  state %s\n' % self.state
-        response += '  debug level %d\n' % self.options.debug
-        if not self.last_status_msg:
-            response += '  no updates\n'
-        else:
-            if self.last_status_msg.build and self.last_status_msg.build.id:
-                d = self.last_status_msg.build.id
-                d = '%s-%s-%s %s:%s:%s' % (d[0:4], d[4:6], d[6:8],
-                                           d[8:10], d[10:12], d[12:14])
-                response += '  current build: %s %s\n' % (
-                    d,
-                    self.last_status_msg.build.tree)
-            else:
-                response += '  no build loaded\n'
-            response += '  last update %s ago:\n    %s\n' % (
-                now - self.last_status_msg.timestamp,
-                self.last_status_msg.short_desc())
-            response += '  %s for %s\n' % (
-                self.last_status_msg.phone_status,
-                now - self.first_status_of_type.timestamp)
-            if self.last_status_of_previous_type:
-                response += '  previous state %s ago:\n    %s\n' % (
-                    now - self.last_status_of_previous_type.timestamp,
-                    self.last_status_of_previous_type.short_desc())
-        return response
+        return self.status_snapshot().report()
+
+    def status_snapshot(self):
+        return PhoneWorkerStatus(self)
 
 class Logcat(object):
     def __init__(self, worker_subprocess):
@@ -1068,13 +1108,35 @@ class PhoneWorkerSubProcess(object):
         self.update_status(phone_status=PhoneStatus.FETCHING,
                            message='%s %s' % (job['tree'], job['build_id']))
         test_package_names = set()
+        test_package_paths = set()
         for t in job['tests']:
             test_package_names.update(t.get_test_package_names())
+            paths = t.get_test_package_paths()
+            if paths is None or test_package_paths is None:
+                # Extract the test packages completely.
+                test_package_paths = None
+            else:
+                test_package_paths.update(paths)
+
+        def progress(event):
+            # The events keep our status fresh during long downloads.
+            if event['event'] == 'progress':
+                if event['total']:
+                    size = '%d/%d' % (event['bytes'], event['total'])
+                else:
+                    size = '%d' % event['bytes']
+                self.update_status(message='%s %s %s %s bytes' % (
+                    job['tree'], job['build_id'], event['artifact'], size))
+            else:
+                self.heartbeat()
+
         cache_response = client.get(
             job['build_url'],
             enable_unittests=job['enable_unittests'],
             test_package_names=test_package_names,
-            builder_type=job['builder_type'])
+            builder_type=job['builder_type'],
+            test_package_paths=test_package_paths,
+            progress=progress)
         client.close()
         if not cache_response['success']:
             self.loggerdeco.warning('Errors occured getting build %s: %s',
@@ -1380,9 +1442,13 @@ class PhoneWorkerSubProcess(object):
         for t in self.tests:
             t.set_worker_subprocess(self)
         if self.options.s3_upload_bucket:
+            upload_index = None
+            if self.options.s3_dedupe_ttl > 0:
+                upload_index = S3UploadIndex(ttl=self.options.s3_dedupe_ttl)
             self.s3_bucket = S3Bucket(self.options.s3_upload_bucket,
                                       self.options.aws_access_key_id,
-                                      self.options.aws_access_key)
+                                      self.options.aws_access_key,
+                                      upload_index=upload_index)
         self.treeherder = AutophoneTreeherder(self,
                                               self.options,
                                               self.jobs,